@@ -1,3 +1,22 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import CarePlan, DiagnosisResult, PatientSubmission
+
+
+@admin.register(PatientSubmission)
+class PatientSubmissionAdmin(admin.ModelAdmin):
+    list_display = ("id", "patient_name", "region", "created_at")
+    search_fields = ("patient_name", "region")
+
+
+@admin.register(DiagnosisResult)
+class DiagnosisResultAdmin(admin.ModelAdmin):
+    list_display = ("id", "status", "phenotype", "region", "created_at")
+    list_filter = ("status", "phenotype")
+    raw_id_fields = ("submission",)
+
+
+@admin.register(CarePlan)
+class CarePlanAdmin(admin.ModelAdmin):
+    list_display = ("id", "phenotype_id", "region", "created_at")
+    list_filter = ("phenotype_id",)
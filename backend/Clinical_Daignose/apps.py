@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class ClinicalDaignoseConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "Clinical_Daignose"
+
+    def ready(self):
+        from .rag_engine import plan_generated
+
+        plan_generated.connect(_record_plan, dispatch_uid="Clinical_Daignose.record_plan")
+
+
+def _record_plan(sender, phenotype_id, region, plan, **kwargs):
+    from .history import get_history_recorder
+
+    get_history_recorder().record_plan(phenotype_id, region, plan)
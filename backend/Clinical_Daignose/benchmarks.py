@@ -0,0 +1,916 @@
+"""
+Micro-benchmarks for the diagnosis pipeline.
+
+Run them with `python manage.py benchmark [name ...]`. Timing metrics end in
+"_us" (lower is better) or "_per_sec" (higher is better); `--save-baseline`
+stores them in BASELINE_PATH and `--check` fails the run when one regresses
+by more than the threshold against that file (see compare_to_baseline()).
+
+Timings depend on the machine, so the baseline also records the host it was
+taken on and its calibrate() time; --check scales the baseline by the ratio
+of this host's calibrate() time to that one before comparing.
+"""
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+from .engine import INPUT_DEFAULTS, PCOSDiagnosticEngine, PatientRecord
+
+# Meets all three criteria with HOMA-IR > 2 -> Insulin-Resistant PCOS, so a
+# care plan is generated for it.
+SAMPLE_PATIENT = {
+    "region": "Pune", "patient_name": "Asha",
+    "cycle_length_days": 50, "cycles_per_year": 5,
+    "total_testosterone": 60, "shbg": 40, "fasting_insulin": 15, "fasting_glucose": 95,
+    "tsh": 2.0, "prolactin": 12, "crp": 1.0,
+    "follicle_count_left": 24, "follicle_count_right": 18,
+    "ovarian_volume_left": 11.0, "ovarian_volume_right": 8.0,
+}
+
+
+# One patient per reachable branch of run_diagnosis()
+BRANCH_PATIENTS = {
+    "review_needed": dict(SAMPLE_PATIENT, tsh=8.0),
+    "not_pcos": dict(
+        SAMPLE_PATIENT, cycle_length_days=28, cycles_per_year=12, total_testosterone=20, shbg=60,
+        follicle_count_left=8, follicle_count_right=8, ovarian_volume_left=6.0, ovarian_volume_right=6.0,
+    ),
+    "insulin_resistant": SAMPLE_PATIENT,
+    "inflammatory": dict(SAMPLE_PATIENT, fasting_insulin=5, crp=4.0),
+    "hyperandrogenic": dict(SAMPLE_PATIENT, fasting_insulin=5),
+    "post_pill": dict(SAMPLE_PATIENT, fasting_insulin=5, total_testosterone=20, shbg=500),
+}
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baselines.json")
+DEFAULT_THRESHOLD = 0.25
+# Baseline entry describing the host that recorded it
+HOST_KEY = "_host"
+
+
+def make_cohort(rows, seed=0):
+    """Random but reproducible patients spread across every branch of the engine."""
+    rng = random.Random(seed)
+    patients = []
+    for _ in range(rows):
+        patients.append({
+            "cycle_length_days": rng.randint(18, 60),
+            "cycles_per_year": rng.randint(3, 14),
+            "total_testosterone": round(rng.uniform(10, 90), 1),
+            "shbg": rng.choice([0, round(rng.uniform(10, 120), 1)]),
+            "fasting_insulin": round(rng.uniform(2, 25), 1),
+            "fasting_glucose": round(rng.uniform(65, 130), 1),
+            "tsh": round(rng.uniform(0.5, 5.5), 2),
+            "prolactin": round(rng.uniform(5, 30), 1),
+            "crp": round(rng.uniform(0.1, 6), 1),
+            "follicle_count_left": rng.randint(4, 30),
+            "follicle_count_right": rng.randint(4, 30),
+            "ovarian_volume_left": round(rng.uniform(4, 14), 1),
+            "ovarian_volume_right": round(rng.uniform(4, 14), 1),
+        })
+    return patients
+
+
+def to_columns(patients):
+    """Pivots a list of patient dicts into the column layout run_batch() expects."""
+    import numpy as np
+
+    return {name: np.array([p[name] for p in patients]) for name in INPUT_DEFAULTS}
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def _best_us(func, number, repeat=5):
+    """Microseconds per call of func(), best of 'repeat' runs of 'number' calls."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+LAB_REPORT_LINES = [
+    "CITY DIAGNOSTICS - HORMONE PROFILE",
+    "Test                          Result   Units      Reference",
+    "Testosterone, Total           1.9      nmol/L     0.3 - 1.7",
+    "SHBG                          32       nmol/L     18 - 144",
+    "Insulin, Fasting              96       pmol/L     < 150",
+    "Glucose, Fasting (Plasma)     5.6      mmol/L     3.9 - 5.5",
+    "TSH (3rd Generation)          2.1      uIU/mL     0.4 - 4.0",
+    "Prolactin                     18.5     ng/mL      4.8 - 23.3",
+    "hs-CRP                        0.42     mg/dL      < 0.3",
+]
+
+
+def make_lab_report_pdf(pages=1, lines=LAB_REPORT_LINES):
+    """A minimal PDF with a text layer, each page holding 'lines' in Courier."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>"]
+    kids = []
+    for _ in range(pages):
+        text = "".join(
+            "({}) '\n".format(line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")) for line in lines
+        )
+        content = f"BT /F1 10 Tf 40 760 Td 14 TL\n{text}ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), pages)
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(pdf)
+
+
+def make_ultrasound_frame(follicles, size=384, mm_per_pixel=0.125, seed=0):
+    """
+    A synthetic ultrasound-like frame: a speckled, darker background, a
+    brighter elliptical ovary and up to 'follicles' dark round follicles
+    2.5-6mm across inside it, none touching. Returns (frame, truth) where
+    truth has the follicles actually placed and the ovary's length and
+    width in mm.
+    """
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    px_per_mm = 1 / mm_per_pixel
+    image = np.full((size, size), 45, np.float32)
+    center = np.array([size / 2, size / 2]) + rng.uniform(-8, 8, 2)
+    semi_axes = np.array([rng.uniform(14, 18), rng.uniform(9.5, 12)]) * px_per_mm
+    angle = rng.uniform(0, 180)
+    cv2.ellipse(image, tuple(center.round().astype(int).tolist()), tuple(semi_axes.round().astype(int).tolist()),
+                angle, 0, 360, 125, -1, cv2.LINE_AA)
+
+    placed = []
+    cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    for _ in range(follicles * 50):
+        if len(placed) == follicles:
+            break
+        radius = rng.uniform(1.25, 3.0) * px_per_mm
+        u, v = rng.uniform(-1, 1, 2) * (semi_axes - radius - 0.8 * px_per_mm)
+        if (u / (semi_axes[0] - radius)) ** 2 + (v / (semi_axes[1] - radius)) ** 2 > 1:
+            continue
+        x, y = center[0] + u * cos - v * sin, center[1] + u * sin + v * cos
+        if all(math.hypot(x - px, y - py) > radius + pr + 1.0 * px_per_mm for px, py, pr in placed):
+            placed.append((x, y, radius))
+    for x, y, radius in placed:
+        cv2.circle(image, (int(round(x)), int(round(y))), int(round(radius)), 18, -1, cv2.LINE_AA)
+
+    # Multiplicative speckle with mean 1, slightly correlated
+    image *= rng.rayleigh(1 / math.sqrt(math.pi / 2), image.shape).astype(np.float32)
+    image = cv2.GaussianBlur(image, (0, 0), 1.0)
+    frame = np.clip(image, 0, 255).astype(np.uint8)
+    return frame, {
+        "follicle_count": len(placed),
+        "ovary_length_mm": 2 * semi_axes[0] * mm_per_pixel,
+        "ovary_width_mm": 2 * semi_axes[1] * mm_per_pixel,
+    }
+
+
+def make_plan_markdown(sections=7, items=6):
+    """A deterministic care plan shaped like the model's output: headings, bold, lists and a table."""
+    lines = ["# Personalized Health Plan for Asha", ""]
+    for i in range(sections):
+        lines += [f"## {i + 1}. **SECTION {i + 1}**", ""]
+        lines += [f"- **Item {j + 1}:** eat *more* fibre, walk 30 minutes after meals and log sleep." for j in range(items)]
+        lines.append("")
+        if i % 3 == 2:
+            lines += ["| Meal | Food | Why |", "| --- | --- | --- |"]
+            lines += [f"| Meal {j + 1} | Millet roti with dal | Low GI, high protein |" for j in range(items)]
+            lines.append("")
+    return "\n".join(lines)
+
+
+def bench_batch_diagnosis(rows=50000):
+    patients = make_cohort(rows)
+    columns = to_columns(patients)
+
+    _, scalar = _timed(lambda: [PCOSDiagnosticEngine(p).run_diagnosis() for p in patients])
+    _, masks = _timed(PCOSDiagnosticEngine.evaluate_batch, columns)
+    _, reports = _timed(PCOSDiagnosticEngine.run_batch, columns)
+
+    return {
+        "rows": rows,
+        "scalar_rows_per_sec": rows / scalar,
+        "evaluate_batch_rows_per_sec": rows / masks,
+        "run_batch_rows_per_sec": rows / reports,
+    }
+
+
+def _dict_request(data):
+    """The API's per-request work before PatientRecord: copy, pop, validate, diagnose."""
+    diagnostic_data = data.copy()
+    diagnostic_data.pop("region", None)
+    diagnostic_data.pop("patient_name", None)
+    for field in INPUT_DEFAULTS:
+        value = diagnostic_data.get(field)
+        if value is None or value == '' or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(field)
+    return PCOSDiagnosticEngine(diagnostic_data).run_diagnosis()
+
+
+def _record_request(data):
+    record, missing_fields, invalid_fields = PatientRecord.parse(data)
+    if record is None:
+        raise ValueError(missing_fields + invalid_fields)
+    return PCOSDiagnosticEngine(record).run_diagnosis()
+
+
+def bench_cohort_screening(rows=50000, workers=None):
+    """
+    screen_file() over a generated CSV registry, in-process and with a pool
+    of 'workers' processes (default: one per CPU).
+    """
+    import csv
+    import tempfile
+
+    from .screening import screen_file
+
+    workers = workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cohort.csv")
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, list(INPUT_DEFAULTS), extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(make_cohort(rows, seed=9))
+        inline = screen_file(path, os.path.join(tmp, "inline.ndjson"), workers=0)
+        pooled = screen_file(path, os.path.join(tmp, "pooled.ndjson"), workers=workers)
+
+    return {
+        "rows": rows,
+        "workers": workers,
+        "inline_rows_per_sec": inline["rows_per_sec"],
+        "pool_rows_per_sec": pooled["rows_per_sec"],
+    }
+
+
+def bench_patient_record(requests=50000):
+    """Per-request validation + diagnosis on a plain dict vs. a PatientRecord."""
+    payloads = [dict(p, region="Pune", patient_name="Asha") for p in make_cohort(requests)]
+
+    _, dict_path = _timed(lambda: [_dict_request(p) for p in payloads])
+    _, record_path = _timed(lambda: [_record_request(p) for p in payloads])
+
+    return {
+        "requests": requests,
+        "dict_path_us": dict_path / requests * 1e6,
+        "record_path_us": record_path / requests * 1e6,
+        "dict_copy_bytes": sys.getsizeof(dict(SAMPLE_PATIENT)),
+        "record_bytes": sys.getsizeof(PatientRecord.parse(SAMPLE_PATIENT)[0]),
+    }
+
+
+def bench_diagnosis_branches(iterations=20000):
+    """run_diagnosis() for one patient per branch, dict input as the views receive it."""
+    return {
+        f"{branch}_us": _best_us(lambda: PCOSDiagnosticEngine(patient).run_diagnosis(), iterations)
+        for branch, patient in BRANCH_PATIENTS.items()
+    }
+
+
+def bench_validation(iterations=50000):
+    """The 13-field validation in pcos_diagnosis_api, on a valid and an invalid payload."""
+    from .views import validate_diagnostic_data
+
+    invalid = dict(SAMPLE_PATIENT, tsh=None, shbg=-1, crp="high")
+    return {
+        "valid_payload_us": _best_us(lambda: validate_diagnostic_data(SAMPLE_PATIENT), iterations),
+        "invalid_payload_us": _best_us(lambda: validate_diagnostic_data(invalid), iterations),
+    }
+
+
+def bench_markdown_render(iterations=50):
+    """
+    Small, typical and large plans through a fresh markdown.markdown() call
+    per plan (how the views used to render), the thread-local sanitizing
+    renderer, and render_markdown() when the plan is already cached.
+    """
+    import markdown
+    from .rendering import get_renderer, render_markdown
+
+    renderer = get_renderer()
+    result = {}
+    for size, sections in (("small", 2), ("typical", 7), ("large", 24)):
+        text = make_plan_markdown(sections)
+        render_markdown(text)
+        result[f"{size}_plan_bytes"] = len(text)
+        result[f"{size}_plan_us"] = _best_us(lambda: markdown.markdown(text, extensions=["extra", "tables"]), iterations)
+        result[f"{size}_renderer_us"] = _best_us(lambda: renderer.reset().convert(text), iterations)
+        result[f"{size}_cached_us"] = _best_us(lambda: render_markdown(text), iterations)
+    return result
+
+
+def bench_lab_report(pages=20, workers=None):
+    """
+    read_lab_report() on a generated 'pages'-page PDF with a text layer, in
+    this process and on a pool of 'workers' processes (default: one per
+    CPU), then re-reading it from the cache. When tesseract is installed,
+    the first page is also rendered to a PNG and OCRed.
+    """
+    import shutil
+    import tempfile
+
+    from .lab_reports import read_lab_report
+    from .plan_cache import MemoryPlanCache
+
+    workers = workers or os.cpu_count() or 1
+    result = {"pages": pages, "workers": workers}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "report.pdf")
+        with open(path, "wb") as f:
+            f.write(make_lab_report_pdf(pages))
+
+        cache = MemoryPlanCache()
+        inline = read_lab_report(path, workers=0, cache=cache)
+        pooled = read_lab_report(path, workers=workers, cache=MemoryPlanCache())
+        assert len(inline["values"]) == 7, inline
+        result.update(
+            inline_pages_per_sec=inline["timings"]["pages_per_sec"],
+            pool_pages_per_sec=pooled["timings"]["pages_per_sec"],
+            text_layer_page_us=inline["timings"]["rasterize"] / pages * 1e6,
+            extract_page_us=inline["timings"]["extract"] / pages * 1e6,
+            cached_us=_best_us(lambda: read_lab_report(path, workers=0, cache=cache), 20),
+        )
+
+        if shutil.which("tesseract"):
+            import pypdfium2 as pdfium
+
+            image = os.path.join(tmp, "report.png")
+            pdf = pdfium.PdfDocument(path)
+            pdf[0].render(scale=300 / 72, grayscale=True).to_pil().save(image)
+            pdf.close()
+            scanned = read_lab_report(image, workers=0, cache=MemoryPlanCache())
+            result.update(
+                ocr_fields_found=len(scanned["values"]),
+                ocr_rasterize_s=scanned["timings"]["rasterize"],
+                ocr_s=scanned["timings"]["ocr"],
+            )
+    return result
+
+
+def bench_ultrasound(patients=64, workers=None, seed=0):
+    """
+    measure_patients() on memory-mapped stacks of synthetic left and right
+    ovary frames (see make_ultrasound_frame()), in this process and on a
+    pool of 'workers' processes (default: one per CPU), with the mean
+    absolute follicle-count error against the generated truth.
+    """
+    import tempfile
+
+    import numpy as np
+
+    from .ultrasound import measure_patients
+
+    workers = workers or os.cpu_count() or 1
+    truth = []
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, "left.npy"), os.path.join(tmp, "right.npy")]
+        for side, path in enumerate(paths):
+            stack = None
+            for i in range(patients):
+                frame, expected = make_ultrasound_frame(4 + (i * 7 + side * 3) % 25, seed=seed + 2 * i + side)
+                if stack is None:
+                    stack = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(patients,) + frame.shape)
+                stack[i] = frame
+                truth.append(expected["follicle_count"])
+            stack.flush()
+            del stack
+
+        inline, inline_s = _timed(measure_patients, *paths, 0)
+        pooled, pooled_s = _timed(measure_patients, *paths, workers)
+    assert inline == pooled
+    counts = [p["follicle_count_left"] for p in inline] + [p["follicle_count_right"] for p in inline]
+
+    return {
+        "patients": patients,
+        "frame_pixels": frame.size,
+        "workers": workers,
+        "inline_frames_per_sec": 2 * patients / inline_s,
+        "pool_frames_per_sec": 2 * patients / pooled_s,
+        "count_error": sum(abs(a - b) for a, b in zip(counts, truth)) / len(truth),
+    }
+
+
+def bench_api_round_trip(requests=100):
+    """
+    Full pcos_diagnosis_api requests through Django's test client, with the
+    care plan generated inline (?plan=sync) by a zero-latency fake model.
+    Every request uses a different region, so neither the plan cache nor
+    idempotent replay short-circuits it.
+    """
+    from unittest.mock import patch
+
+    from django.test import Client, override_settings
+    from django.urls import reverse
+
+    from .fake_llm import FakeModelServer, use_fake_model
+    from .idempotency import IdempotencyStore
+
+    client = Client()
+    url = reverse("pcos_api")
+    counter = iter(range(10 ** 9))
+
+    def post(path, patient):
+        payload = dict(patient, region=f"Region {next(counter)}")
+        response = client.post(path, payload, content_type="application/json")
+        assert response.status_code == 200, response.content
+
+    with override_settings(ALLOWED_HOSTS=["*"], PCOS_RECORD_HISTORY=False), \
+            patch("Clinical_Daignose.idempotency._store", IdempotencyStore(max_entries=1)), \
+            FakeModelServer(reply=make_plan_markdown()) as server, use_fake_model(server):
+        return {
+            "diagnosis_only_us": _best_us(lambda: post(url, BRANCH_PATIENTS["not_pcos"]), requests, repeat=3),
+            "diagnosis_and_plan_us": _best_us(lambda: post(url + "?plan=sync", SAMPLE_PATIENT), requests, repeat=3),
+        }
+
+
+def bench_static_plan_fallback(requests=200):
+    """
+    The rule-only path: ?plan=sync API requests while the model is
+    unavailable, answered with the pre-rendered static plan, and direct
+    fetches of that plan from the static endpoint.
+    """
+    from unittest.mock import patch
+
+    from django.test import Client, override_settings
+    from django.urls import reverse
+
+    from . import rag_engine
+    from .idempotency import IdempotencyStore
+    from .static_plans import get_static_plan_store
+
+    client = Client()
+    url = reverse("pcos_api") + "?plan=sync"
+    static_url = reverse("pcos_static_plan", args=["insulin_resistant"])
+    get_static_plan_store().get("insulin_resistant")
+
+    def post():
+        response = client.post(url, SAMPLE_PATIENT, content_type="application/json")
+        assert "note" in response.json(), response.content
+
+    def fetch():
+        response = client.get(static_url, HTTP_ACCEPT_ENCODING="br, gzip")
+        assert response.status_code == 200, response.status_code
+
+    with override_settings(ALLOWED_HOSTS=["*"], PCOS_RECORD_HISTORY=False), \
+            patch("Clinical_Daignose.idempotency._store", IdempotencyStore(max_entries=1)), \
+            patch.object(rag_engine, "api_key", None), patch.object(rag_engine, "_engine", None):
+        return {
+            "api_fallback_us": _best_us(post, requests, repeat=3),
+            "static_endpoint_us": _best_us(fetch, requests, repeat=3),
+        }
+
+
+def bench_engine_construction(iterations=200):
+    from . import rag_engine
+
+    _, fresh = _timed(lambda: [rag_engine.PCOSRecommendationEngine() for _ in range(iterations)])
+    rag_engine.get_recommendation_engine()
+    _, shared = _timed(lambda: [rag_engine.get_recommendation_engine() for _ in range(iterations)])
+
+    return {
+        "iterations": iterations,
+        "per_request_construction_us": fresh / iterations * 1e6,
+        "shared_engine_lookup_us": shared / iterations * 1e6,
+    }
+
+
+def bench_async_concurrency(requests=200, wsgi_workers=8, latency=0.5):
+    """
+    Load test: 'requests' diagnosed patients against a fake model server with
+    fixed latency, through the sync API on a pool of 'wsgi_workers' threads
+    (like gunicorn sync workers) and through the async API on one event loop.
+    """
+    from django.test import AsyncClient, Client, override_settings
+    from django.urls import reverse
+
+    from .fake_llm import FakeModelServer, use_fake_model
+
+    payloads = [dict(SAMPLE_PATIENT, region=f"Region {i}") for i in range(requests)]
+
+    def post_sync(payload):
+        response = Client().post(reverse("pcos_api") + "?plan=sync", payload, content_type="application/json")
+        assert "recommendation" in response.json(), response.content
+
+    async def post_all_async():
+        client = AsyncClient()
+        try:
+            responses = await asyncio.gather(*(
+                client.post(reverse("pcos_api_async"), payload, content_type="application/json")
+                for payload in payloads
+            ))
+        finally:
+            await engine.aclose()
+        assert all("recommendation" in r.json() for r in responses), responses[0].content
+
+    with override_settings(ALLOWED_HOSTS=["*"], PCOS_RECORD_HISTORY=False), \
+            FakeModelServer(latency=latency) as server, use_fake_model(server) as engine:
+        with ThreadPoolExecutor(max_workers=wsgi_workers) as pool:
+            _, wsgi = _timed(lambda: list(pool.map(post_sync, payloads)))
+        _, asgi = _timed(asyncio.run, post_all_async())
+
+    return {
+        "requests": requests,
+        "model_latency_s": latency,
+        "wsgi_workers": wsgi_workers,
+        "wsgi_requests_per_sec": requests / wsgi,
+        "asgi_requests_per_sec": requests / asgi,
+        "speedup": wsgi / asgi,
+    }
+
+
+def bench_batch_plans(patients=120, regions=4, latency=0.05, concurrency=8):
+    """
+    Care plans for a diagnosed cohort spread over 'regions' regions, from a
+    fake model server with fixed latency: one generate_comprehensive_plan()
+    call per patient on 'concurrency' threads, against generate_plans().
+    """
+    from django.test import override_settings
+
+    from .fake_llm import FakeModelServer, use_fake_model
+    from .views import PHENOTYPE_IDS
+
+    cohort = make_cohort(patients * 2, seed=5)
+    reports = PCOSDiagnosticEngine.run_batch(to_columns(cohort))
+    requests = [
+        (PHENOTYPE_IDS[report["phenotype"]], f"Region {i % regions}", f"Patient {i}")
+        for i, report in enumerate(reports)
+        if report.get("diagnosis") and PHENOTYPE_IDS.get(report["phenotype"]) != "post_pill"
+    ][:patients]
+
+    with override_settings(PCOS_RECORD_HISTORY=False), \
+            FakeModelServer(latency=latency) as server, use_fake_model(server) as engine:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            _, per_patient = _timed(lambda: list(pool.map(lambda r: engine.generate_comprehensive_plan(*r), requests)))
+        per_patient_calls = server.request_count
+        (_, stats), batched = _timed(engine.generate_plans, requests, concurrency)
+
+    return {
+        "patients": len(requests),
+        "distinct_plans": stats["distinct_plans"],
+        "model_latency_s": latency,
+        "per_patient_calls": per_patient_calls,
+        "batched_calls": stats["model_calls"],
+        "per_patient_s": per_patient,
+        "batched_s": batched,
+        "call_reduction": per_patient_calls / max(stats["model_calls"], 1),
+        "speedup": per_patient / batched,
+    }
+
+
+def bench_plan_sections(cities=5, latency=0.2):
+    """
+    One phenotype's care plan for 'cities' cities from a fake model server
+    with fixed per-call latency, with a plan cache: the first city generates
+    every section at once, each further city only the region-dependent ones,
+    and a repeated city is served from the cache.
+    """
+    from django.test import override_settings
+
+    from . import rag_engine
+    from .fake_llm import FakeModelServer, use_fake_model
+    from .plan_cache import MemoryPlanCache
+
+    with override_settings(PCOS_RECORD_HISTORY=False), \
+            FakeModelServer(latency=latency) as server, use_fake_model(server) as engine:
+        engine.plan_cache = MemoryPlanCache()
+        _, cold = _timed(engine.generate_comprehensive_plan, "insulin_resistant", "City 0", "Asha")
+        cold_calls = server.request_count
+        _, new_cities = _timed(lambda: [
+            engine.generate_comprehensive_plan("insulin_resistant", f"City {i}", "Asha") for i in range(1, cities)
+        ])
+        new_city_calls = (server.request_count - cold_calls) / max(cities - 1, 1)
+        cached = _best_us(lambda: engine.generate_comprehensive_plan("insulin_resistant", "City 0", "Meera"), 200)
+
+    return {
+        "sections": len(rag_engine.PLAN_SECTIONS),
+        "model_latency_s": latency,
+        "cold_s": cold,
+        "cold_calls": cold_calls,
+        "cold_over_latency": cold / latency,
+        "new_city_s": new_cities / max(cities - 1, 1),
+        "new_city_calls": new_city_calls,
+        "cached_plan_us": cached,
+    }
+
+
+def make_region_inputs(count, seed=0):
+    """
+    Free-text regions as patients type them: gazetteer places and aliases
+    with random case, spacing, state or country suffixes and one-letter typos.
+    """
+    from .regions import REGIONS_PATH
+
+    with open(REGIONS_PATH, encoding="utf-8") as f:
+        regions = json.load(f)["regions"]
+    places = [
+        (name, entry["label"])
+        for entry in regions.values() if not entry.get("national")
+        for place, aliases in entry["places"].items() for name in [place, *aliases]
+    ]
+    rng = random.Random(seed)
+    inputs = []
+    for _ in range(count):
+        name, label = rng.choice(places)
+        form = rng.randrange(7)
+        if form == 1:
+            name = name.lower()
+        elif form == 2:
+            name = name.upper()
+        elif form == 3:
+            name = f"  {name} "
+        elif form == 4:
+            name = f"{name}, {label}"
+        elif form == 5:
+            name = f"{name}, India"
+        elif form == 6 and len(name) >= 8:
+            i = rng.randrange(1, len(name) - 1)
+            name = name[:i] + rng.choice("aeiou") + name[i + 1:]
+        inputs.append(name)
+    return inputs
+
+
+def bench_region_canonicalization(patients=2000, seed=0):
+    """
+    Distinct care-plan prompts for a sample of free-text regions across
+    every phenotype, as typed and after canonical_region(), and the cost
+    of a lookup (uncached, and from the memo).
+    """
+    from .rag_engine import get_recommendation_engine
+    from .regions import RegionIndex
+    from .views import PHENOTYPE_IDS
+
+    index = RegionIndex()
+    engine = get_recommendation_engine()
+
+    rng = random.Random(seed)
+    phenotypes = sorted(pid for pid in set(PHENOTYPE_IDS.values()) if engine.get_phenotype_rules(pid))
+    requests = [(rng.choice(phenotypes), region) for region in make_region_inputs(patients, seed)]
+
+    def prompts(canonical):
+        distinct = set()
+        for phenotype_id, region in requests:
+            region = canonical(region)
+            distinct.update(engine.build_section_prompts(engine.get_phenotype_rules(phenotype_id, region), region))
+        return distinct
+
+    raw_prompts = prompts(lambda region: region)
+    canonical_prompts = prompts(index.canonical)
+    regions = [region for _, region in requests]
+    lookups = iter(range(10 ** 9))
+
+    return {
+        "patients": patients,
+        "raw_distinct_regions": len(set(regions)),
+        "canonical_distinct_regions": len({index.canonical(region) for region in regions}),
+        "matched_share": sum(index.resolve(region) is not None for region in regions) / patients,
+        "raw_prompts": len(raw_prompts),
+        "canonical_prompts": len(canonical_prompts),
+        "prompt_reduction": len(raw_prompts) / len(canonical_prompts),
+        "lookup_us": _best_us(lambda: index._canonical(regions[next(lookups) % patients]), patients),
+        "cached_lookup_us": _best_us(lambda: index.canonical(regions[next(lookups) % patients]), patients),
+    }
+
+
+class _SlowSink:
+    """
+    Line-buffered text stream over a pipe drained at roughly 'bytes_per_sec',
+    standing in for stdout read by a log shipper or container runtime: once
+    the pipe buffer is full, writers block until the reader catches up.
+    """
+
+    def __init__(self, bytes_per_sec=2_000_000, chunk=4096):
+        import threading
+
+        read_fd, write_fd = os.pipe()
+        self.stream = os.fdopen(write_fd, "w", buffering=1)
+        self._reader = threading.Thread(target=self._drain, args=(read_fd, chunk, chunk / bytes_per_sec), daemon=True)
+        self._reader.start()
+
+    @staticmethod
+    def _drain(read_fd, chunk, pause):
+        with os.fdopen(read_fd, "rb", buffering=0) as pipe:
+            while pipe.read(chunk):
+                time.sleep(pause)
+
+    def close(self):
+        self.stream.close()
+        self._reader.join()
+
+
+def bench_request_logging(threads=8, lines=2000):
+    """
+    Time a request thread spends emitting one log line while 'threads'
+    request threads log at once to a slow stdout (_SlowSink): the old
+    print() of the payload, a synchronous JSON StreamHandler, and the
+    AsyncQueueHandler the app now logs through.
+    """
+    import logging
+
+    from .logs import AsyncQueueHandler, JsonFormatter
+
+    def per_call_us(emit):
+        def worker(_):
+            spent = 0.0
+            for _ in range(lines):
+                start = time.perf_counter()
+                emit()
+                spent += time.perf_counter() - start
+            return spent
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            return sum(pool.map(worker, range(threads))) / (threads * lines) * 1e6
+
+    def logged(make_handler):
+        sink = _SlowSink()
+        handler = make_handler(sink.stream)
+        handler.setFormatter(JsonFormatter())
+        logger = logging.Logger("benchmark")
+        logger.addHandler(handler)
+        fields = {"fields": dict(SAMPLE_PATIENT, plan_mode="sync")}
+        try:
+            return per_call_us(lambda: logger.info("Diagnosis served", extra=fields))
+        finally:
+            handler.close()
+            sink.close()
+
+    sink = _SlowSink()
+    try:
+        print_us = per_call_us(lambda: print("Received data:", SAMPLE_PATIENT, file=sink.stream))
+    finally:
+        sink.close()
+
+    return {
+        "threads": threads,
+        "print_us": print_us,
+        "sync_handler_us": logged(logging.StreamHandler),
+        "async_handler_us": logged(
+            lambda stream: AsyncQueueHandler(logging.StreamHandler(stream), max_pending=threads * lines)
+        ),
+    }
+
+
+# Cold-start budgets (cumulative microseconds under `python -X importtime`),
+# and modules that must stay out of a plain import of the views.
+IMPORT_TIME_BUDGET_US = {
+    "Clinical_Daignose.engine": 50_000,
+    "Clinical_Daignose.rag_engine": 50_000,
+    "Clinical_Daignose.views": 400_000,
+}
+LAZY_MODULES = ("google.generativeai", "httpx", "numpy", "pypdfium2", "PIL", "pytesseract", "cv2")
+
+
+def measure_imports(module="Clinical_Daignose.views"):
+    """
+    Imports 'module' in a fresh interpreter (after django.setup()) under
+    `-X importtime`. Returns ({module: cumulative_us}, stdout).
+    """
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE="PCOS_Intelligence.settings")
+    code = f"import django; django.setup(); import sys; sys.stdout.flush(); print('--'); import {module}"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=backend_dir, env=env, capture_output=True, text=True, check=True,
+    )
+
+    timings = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        timings[name.strip()] = int(cumulative)
+    return timings, proc.stdout.split("--\n", 1)[1]
+
+
+def bench_import_time():
+    timings, stdout = measure_imports()
+    result = {module: f"{timings.get(module, 0) / 1000:.1f} ms (budget {budget / 1000:.0f} ms)"
+              for module, budget in IMPORT_TIME_BUDGET_US.items()}
+    result["lazy_modules_loaded"] = ", ".join(m for m in LAZY_MODULES if m in timings) or "none"
+    result["stdout_bytes"] = len(stdout)
+    return result
+
+
+def _direction(metric):
+    if metric.endswith("_per_sec"):
+        return 1
+    if metric.endswith("_us"):
+        return -1
+    return 0
+
+
+def calibrate():
+    """
+    Microseconds for a fixed workload that does not use this project's code.
+    Its ratio between two hosts is how much faster one runs Python code.
+    """
+    rng = random.Random(0)
+    values = [rng.random() for _ in range(2000)]
+
+    def work():
+        total = 0.0
+        for value in sorted(values):
+            total += math.sqrt(value) * value
+        return json.dumps({"total": total, "values": values[:100]})
+
+    return _best_us(work, 50, repeat=11)
+
+
+def host_info(calibration_us):
+    """Baseline HOST_KEY entry for this machine."""
+    return {
+        "calibration_us": calibration_us,
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def load_baseline(path=BASELINE_PATH):
+    """{benchmark: {metric: value}} from 'path', or {} if there is none yet."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results, path=BASELINE_PATH, host=None):
+    """
+    Merges the timing metrics of 'results' ({benchmark: {metric: value}})
+    into 'path', along with 'host' (see host_info()) if given.
+    """
+    baseline = load_baseline(path)
+    for name, metrics in results.items():
+        timings = {metric: value for metric, value in metrics.items() if _direction(metric)}
+        if timings:
+            baseline[name] = timings
+    if host is not None:
+        baseline[HOST_KEY] = host
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare_to_baseline(results, baseline, threshold=DEFAULT_THRESHOLD, calibration_us=None):
+    """
+    Returns one message per timing metric in 'results' that is more than
+    'threshold' (a fraction) worse than its baseline value. Metrics without
+    a baseline are skipped. When 'calibration_us' (this host's calibrate())
+    and the baseline host's are both known, the baseline values are first
+    scaled by their ratio.
+    """
+    scale = 1.0
+    baseline_calibration = baseline.get(HOST_KEY, {}).get("calibration_us")
+    if calibration_us and baseline_calibration:
+        scale = calibration_us / baseline_calibration
+
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            direction = _direction(metric)
+            expected = baseline.get(name, {}).get(metric)
+            if not direction or not expected:
+                continue
+            expected *= scale ** -direction
+            change = (value - expected) / expected * direction
+            if change < -threshold:
+                regressions.append(f"{name}.{metric}: {value:,.1f} vs baseline {expected:,.1f} ({-change:.0%} worse)")
+    return regressions
+
+
+BENCHMARKS = {
+    "diagnosis_branches": bench_diagnosis_branches,
+    "validation": bench_validation,
+    "markdown_render": bench_markdown_render,
+    "api_round_trip": bench_api_round_trip,
+    "lab_report": bench_lab_report,
+    "ultrasound": bench_ultrasound,
+    "static_plan_fallback": bench_static_plan_fallback,
+    "batch_diagnosis": bench_batch_diagnosis,
+    "cohort_screening": bench_cohort_screening,
+    "patient_record": bench_patient_record,
+    "engine_construction": bench_engine_construction,
+    "async_concurrency": bench_async_concurrency,
+    "batch_plans": bench_batch_plans,
+    "plan_sections": bench_plan_sections,
+    "region_canonicalization": bench_region_canonicalization,
+    "request_logging": bench_request_logging,
+    "import_time": bench_import_time,
+}
@@ -0,0 +1,185 @@
+"""
+Incremental parsing and chunked diagnosis for the bulk API.
+
+Patients are read from the request body one at a time (JSON array or
+NDJSON), diagnosed CHUNK_SIZE at a time through the batch engine and
+yielded back as NDJSON lines, so memory use does not grow with the batch.
+"""
+import codecs
+import json
+
+from .engine import INPUT_DEFAULTS, PCOSDiagnosticEngine
+
+CHUNK_SIZE = 500
+READ_SIZE = 64 * 1024
+# A patient object is well under 1 KB; an array element that still does not
+# parse once this much of it has arrived is malformed, not incomplete, and
+# NDJSON lines are limited to the same size.
+MAX_ELEMENT_CHARS = 64 * 1024
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonlines")
+
+
+def _iter_text(stream):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while True:
+        block = stream.read(READ_SIZE)
+        if not block:
+            break
+        yield decoder.decode(block)
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def _reject_constant(name):
+    raise ValueError(f"{name} is not a valid JSON number")
+
+
+def _check_line_length(line):
+    if len(line) > MAX_ELEMENT_CHARS:
+        raise ValueError(f"NDJSON lines are limited to {MAX_ELEMENT_CHARS} characters")
+
+
+def iter_ndjson(stream):
+    decoder = json.JSONDecoder(parse_constant=_reject_constant)
+    buffer = ""
+    for text in _iter_text(stream):
+        buffer += text
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            _check_line_length(line)
+            if line.strip():
+                yield decoder.decode(line)
+        _check_line_length(buffer)
+    if buffer.strip():
+        yield decoder.decode(buffer)
+
+
+# iter_json_array() states: what the next non-space character may be
+_OPEN, _FIRST, _VALUE, _NEXT = range(4)
+
+
+def iter_json_array(stream):
+    decoder = json.JSONDecoder(parse_constant=_reject_constant)
+    buffer = ""
+    state = _OPEN
+    for text in _iter_text(stream):
+        buffer += text
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos == len(buffer):
+                break
+            char = buffer[pos]
+            if state == _OPEN:
+                if char != "[":
+                    raise ValueError("Request body must be a JSON array or NDJSON")
+                state = _FIRST
+                pos += 1
+            elif state == _NEXT:
+                if char == "]":
+                    return
+                if char != ",":
+                    raise ValueError(f"Malformed JSON array: expected ',' or ']' but found {char!r}")
+                state = _VALUE
+                pos += 1
+            elif state == _FIRST and char == "]":
+                return
+            else:
+                try:
+                    item, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError as e:
+                    if len(buffer) - pos > MAX_ELEMENT_CHARS:
+                        raise ValueError(f"Malformed JSON array element: {e.msg}") from e
+                    break  # Element continues in the next block
+                state = _NEXT
+                yield item
+        buffer = buffer[pos:]
+    raise ValueError("Malformed JSON array: unexpected end of body")
+
+
+def iter_patients(stream, content_type=""):
+    """Yields patient dicts from a JSON array or NDJSON request body."""
+    if content_type.split(";")[0].strip() in NDJSON_CONTENT_TYPES:
+        return iter_ndjson(stream)
+
+    # Sniff the first byte: '[' is a JSON array, anything else NDJSON.
+    head = stream.read(1)
+    while head and head.isspace():
+        head = stream.read(1)
+    rest = _Prepend(head, stream)
+    return iter_json_array(rest) if head == b"[" else iter_ndjson(rest)
+
+
+class _Prepend:
+    """File-like wrapper that replays already-consumed bytes before the stream."""
+
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        if self.head:
+            head, self.head = self.head, b""
+            return head
+        return self.stream.read(size)
+
+
+def _diagnose_chunk(chunk, record):
+    valid = [(index, patient) for index, patient, error in chunk if error is None]
+    reports = []
+    if valid:
+        columns = {name: [patient[name] for _, patient in valid] for name in INPUT_DEFAULTS}
+        reports = PCOSDiagnosticEngine.run_batch(columns)
+    reports = iter(reports)
+
+    for index, patient, error in chunk:
+        if error is not None:
+            yield {"index": index, "error": error}
+        else:
+            line = {
+                "index": index,
+                "patient_name": patient.get("patient_name", "Patient"),
+                "region": patient["region"],
+                "diagnosis": next(reports),
+            }
+            if record is not None:
+                record(patient, line["region"], line["patient_name"], line["diagnosis"])
+            yield line
+
+
+def diagnose_stream(patients, validate, chunk_size=None, record=None):
+    """
+    Validates and diagnoses 'patients' chunk by chunk, yielding one NDJSON
+    line per patient. 'validate' returns an error message or None; 'record',
+    if given, is called as record(patient, region, patient_name, report)
+    for every diagnosed patient.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    chunk = []
+    count = 0
+    patients = iter(patients)
+    while True:
+        try:
+            patient = next(patients)
+        except StopIteration:
+            break
+        except ValueError as e:
+            # Malformed body: flush what was parsed, then report where it broke.
+            for line in _diagnose_chunk(chunk, record):
+                yield json.dumps(line) + "\n"
+            yield json.dumps({"index": count, "error": f"Invalid request body: {e}"}) + "\n"
+            return
+
+        error = validate(patient) if isinstance(patient, dict) else "Each patient must be a JSON object"
+        chunk.append((count, patient, error))
+        count += 1
+        if len(chunk) >= chunk_size:
+            for line in _diagnose_chunk(chunk, record):
+                yield json.dumps(line) + "\n"
+            chunk = []
+
+    for line in _diagnose_chunk(chunk, record):
+        yield json.dumps(line) + "\n"
@@ -1,10 +1,151 @@
+import math
+import operator
+import os
+import threading
+from collections import namedtuple
+
+from .rules import (
+    DIAGNOSIS, PHENOTYPE_CODE, PHENOTYPE_MATCH, REVIEW_NEEDED, load_rules,
+)
+
+# The 13 diagnostic inputs and the value each helper falls back to when a
+# key is missing from the patient dict.
+INPUT_DEFAULTS = {
+    "cycle_length_days": 28,
+    "cycles_per_year": 12,
+    "total_testosterone": 0,
+    "shbg": 1,
+    "fasting_insulin": 0,
+    "fasting_glucose": 0,
+    "tsh": 0,
+    "prolactin": 0,
+    "crp": 0,
+    "follicle_count_left": 0,
+    "follicle_count_right": 0,
+    "ovarian_volume_left": 0,
+    "ovarian_volume_right": 0,
+}
+
+
+class PatientRecord(namedtuple("PatientRecord", INPUT_DEFAULTS, defaults=INPUT_DEFAULTS.values())):
+    """
+    Fixed-schema patient: exactly the 13 INPUT_DEFAULTS fields, stored in
+    that order in a tuple (no per-instance __dict__). PCOSDiagnosticEngine
+    unpacks a record in one step, so a request needs no dict copy and no
+    per-field .get() with defaults.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, data):
+        """
+        Validates and copies the 13 fields of 'data' (a dict, DRF's
+        request.data or a QueryDict) in one pass. Returns (record,
+        missing_fields, invalid_fields); record is None unless both lists
+        are empty. Form-encoded values arrive as strings and are converted
+        to numbers; other keys (region, patient_name, ...) are ignored.
+        """
+        # Fast path: every field present and already a finite, non-negative
+        # number (NaN fails both comparisons)
+        try:
+            values = _pick_fields(data)
+        except KeyError:
+            pass
+        else:
+            for value in values:
+                if value.__class__ not in _NUMBER_TYPES or not 0 <= value < math.inf:
+                    break
+            else:
+                return _new_tuple(cls, values), [], []
+
+        from_form = hasattr(data, "getlist")
+        values = []
+        missing_fields = []
+        invalid_fields = []
+        for name in cls._fields:
+            value = data.get(name)
+            if value is None or value == '':
+                missing_fields.append(name)
+                continue
+            if from_form and isinstance(value, str):
+                value = _form_number(value)
+            if not isinstance(value, (int, float)) or not 0 <= value < math.inf:
+                invalid_fields.append(name)
+            values.append(value)
+
+        if missing_fields or invalid_fields:
+            return None, missing_fields, invalid_fields
+        return _new_tuple(cls, values), missing_fields, invalid_fields
+
+    def get(self, name, default=None):
+        """dict-style access, for code written against patient dicts."""
+        return getattr(self, name, default)
+
+
+_pick_fields = operator.itemgetter(*INPUT_DEFAULTS)
+_new_tuple = tuple.__new__
+_NUMBER_TYPES = frozenset((int, float))
+
+
+def _form_number(value):
+    """The number in a form-encoded value, or None unless it is a finite number."""
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            number = float(value)
+        except ValueError:
+            return None
+        return number if math.isfinite(number) else None
+
+
+# Thresholds, criteria and the phenotype tree live in this file so they can
+# be tuned without code changes; PCOS_DIAGNOSTIC_RULES points at another copy.
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "diagnostic_rules.json")
+
+_rule_plan = None
+_rule_plan_lock = threading.Lock()
+
+
+def get_rule_plan():
+    """Returns the compiled rules, loading them on first use."""
+    global _rule_plan
+    if _rule_plan is None:
+        with _rule_plan_lock:
+            if _rule_plan is None:
+                _rule_plan = load_rules(os.getenv("PCOS_DIAGNOSTIC_RULES", RULES_PATH), INPUT_DEFAULTS)
+    return _rule_plan
+
+
+def _label_combinations(masks, entries):
+    """
+    Encodes each row's set of true (id, label) entries as a bitmask and
+    returns (codes, label_lists) with label_lists[code] the labels in order.
+    """
+    import numpy as np
+
+    codes = np.zeros(len(masks[DIAGNOSIS]), dtype=np.int64)
+    for bit, (name, _) in enumerate(entries):
+        codes |= masks[name].astype(np.int64) << bit
+    label_lists = [
+        [label for bit, (_, label) in enumerate(entries) if code >> bit & 1]
+        for code in range(2 ** len(entries))
+    ]
+    return codes, label_lists
+
+
 class PCOSDiagnosticEngine:
-    def __init__(self, data):
+    def __init__(self, data, rules=None):
         """
-        Input 'data' is a dictionary containing extracted values from
-        OCR (Blood) and Computer Vision (Ultrasound).
+        Input 'data' is a dictionary (or a PatientRecord) containing
+        extracted values from OCR (Blood, see lab_reports.py) and Computer
+        Vision (Ultrasound, see ultrasound.py).
+        'rules' is a compiled RulePlan; the default is get_rule_plan().
         """
         self.data = data
+        self.rules = rules or get_rule_plan()
+        self._values = None
         self.diagnosis_report = {
             "criteria_met": [],
             "diagnosis": False,
@@ -12,153 +153,173 @@ class PCOSDiagnosticEngine:
             "lifestyle_protocol": "Generic Healthy Living"
         }
 
+    def values(self):
+        """Every input, derived value and rule outcome, evaluated once per engine."""
+        if self._values is None:
+            evaluate = self.rules.evaluate_record if isinstance(self.data, PatientRecord) else self.rules.evaluate
+            self._values = evaluate(self.data)
+        return self._values
+
+    def value(self, name):
+        return self.values()[self.rules.slots[name]]
+
     # --- 1. HELPER CALCULATORS ---
     def calculate_fai(self):
-        """Calculates Free Androgen Index = (Total T / SHBG) * 100"""
-        try:
-            t = self.data.get('total_testosterone', 0)
-            shbg = self.data.get('shbg', 1) # Avoid div by zero
-            return (t / shbg) * 100
-        except:
-            return 0
+        """Free Androgen Index = (Total T / SHBG) * 100"""
+        return self.value("fai")
 
     def calculate_homa_ir(self):
-        """Calculates Insulin Resistance = (Insulin * Glucose) / 405"""
-        try:
-            ins = self.data.get('fasting_insulin', 0)
-            glu = self.data.get('fasting_glucose', 0)
-            return (ins * glu) / 405
-        except:
-            return 0
+        """Insulin Resistance = (Insulin * Glucose) / 405"""
+        return self.value("homa_ir")
 
     # --- 2. ROTTERDAM CRITERIA CHECKS ---
-    
     def check_irregular_periods(self):
         # Criterion A: Oligo-anovulation
-        cycle_days = self.data.get('cycle_length_days', 28)
-        cycles_per_year = self.data.get('cycles_per_year', 12)
-        
-        if cycle_days > 35 or cycle_days < 21 or cycles_per_year < 8:
-            return True
-        return False
+        return self.value("irregular_periods")
 
     def check_hyperandrogenism(self):
         # Criterion B: High Male Hormones (Biochemical)
-        t_level = self.data.get('total_testosterone', 0)
-        fai = self.calculate_fai()
-        
-        # Thresholds: T > 45 ng/dL OR FAI > 5%
-        if t_level > 45 or fai > 5.0:
-            return True
-        return False
+        return self.value("hyperandrogenism")
 
     def check_polycystic_morphology(self):
         # Criterion C: Ultrasound findings (2023 Guidelines)
-        # Note: Checks the worst ovary
-        follicles = max(self.data.get('follicle_count_left', 0), self.data.get('follicle_count_right', 0))
-        volume = max(self.data.get('ovarian_volume_left', 0), self.data.get('ovarian_volume_right', 0))
-        
-        # Thresholds: FNPO >= 20 OR Volume > 10ml
-        if follicles >= 20 or volume > 10.0:
-            return True
-        return False
+        return self.value("polycystic_morphology")
 
     # --- 3. SAFETY & EXCLUSION LOGIC ---
     def check_exclusions(self):
-        alerts = []
-        if self.data.get('tsh', 0) > 4.5:
-            alerts.append("High TSH (Possible Hypothyroidism)")
-        if self.data.get('prolactin', 0) > 25:
-            alerts.append("High Prolactin (Hyperprolactinemia)")
-        return alerts
+        values = self.values()
+        slots = self.rules.slots
+        return [label for name, label in self.rules.exclusions if values[slots[name]]]
 
     # --- 4. MAIN EXECUTION ---
     def run_diagnosis(self):
-        # Step 1: Check Exclusion
-        alerts = self.check_exclusions()
-        if alerts:
-            return {"status": "Review Needed", "alerts": alerts}
-
-        # Step 2: Check 3 Criteria
-        c1 = self.check_irregular_periods()
-        c2 = self.check_hyperandrogenism()
-        c3 = self.check_polycystic_morphology()
-        
-        criteria_list = []
-        if c1: criteria_list.append("Oligo-anovulation (Irregular Cycles)")
-        if c2: criteria_list.append("Hyperandrogenism (High Hormones)")
-        if c3: criteria_list.append("Polycystic Morphology (Ultrasound)")
-
-        # Rotterdam Rule: Must meet 2 out of 3
-        is_pcos = len(criteria_list) >= 2
-        
-        self.diagnosis_report["diagnosis"] = is_pcos
-        self.diagnosis_report["criteria_met"] = criteria_list
-
-        if is_pcos:
-            self.determine_phenotype()
-        
-        return self.diagnosis_report
+        """
+        Exclusions first (any alert means "Review Needed"), then the Rotterdam
+        rule: min_criteria (2 out of 3) criteria met means PCOS, and the
+        phenotype tree picks the root cause. The whole check is one call into
+        the compiled rules.
+        """
+        diagnose = self.rules.diagnose_record if isinstance(self.data, PatientRecord) else self.rules.diagnose
+        report = diagnose(self.data)
+        if "status" not in report:
+            self.diagnosis_report = report
+        return report
 
     # --- 5. PHENOTYPING ENGINE (ROOT CAUSE) ---
     def determine_phenotype(self):
-        homa = self.calculate_homa_ir()
-        inflammation = self.data.get('crp', 0)
-        androgens = self.check_hyperandrogenism()
-        morphology = self.check_polycystic_morphology()
-
-        # Logic Tree for Phenotypes
-        if homa > 2.0:
-            self.diagnosis_report["phenotype"] = "Insulin-Resistant PCOS"
-            self.diagnosis_report["lifestyle_protocol"] = "Protocol A: Low-GI Diet + Inositol + Strength Training"
-        
-        elif inflammation > 3.0: # High CRP
-             self.diagnosis_report["phenotype"] = "Inflammatory PCOS"
-             self.diagnosis_report["lifestyle_protocol"] = "Protocol D: Gluten/Dairy Free + Anti-inflammatory Support"
-
-        elif androgens and not homa > 2.0:
-            self.diagnosis_report["phenotype"] = "Hyperandrogenic PCOS"
-            self.diagnosis_report["lifestyle_protocol"] = "Protocol B: Spearmint Tea + Zinc + Stress Management"
-
-        elif morphology and not androgens and not homa > 2.0:
-            # Often caused by stopping birth control
-            self.diagnosis_report["phenotype"] = "Post-Pill / Mild PCOS"
-            self.diagnosis_report["lifestyle_protocol"] = "Protocol C: Nutrient Repletion (Mg, Zinc, B6)"
-        
-        else:
-            self.diagnosis_report["phenotype"] = "Adrenal/Unspecified PCOS"
-            self.diagnosis_report["lifestyle_protocol"] = "Protocol E: Sleep Hygiene + Cortisol Regulation (Yoga/Meditation)"
+        # First matching branch of the rules' phenotype tree
+        phenotype, protocol = self.rules.phenotypes[self.value(PHENOTYPE_MATCH)]
+        self.diagnosis_report["phenotype"] = phenotype
+        self.diagnosis_report["lifestyle_protocol"] = protocol
+
+    # --- 6. BATCH MODE (COLUMNAR COHORTS) ---
+    @staticmethod
+    def evaluate_batch(columns, rules=None):
+        """
+        Vectorised version of run_diagnosis() for a whole cohort, driven by
+        the same compiled rules.
+
+        'columns' maps each of the INPUT_DEFAULTS keys to an equal-length
+        array-like; missing columns take the same default as the scalar path.
+        Returns a dict of NumPy arrays: the derived values, one boolean mask
+        per criterion/exclusion, 'criteria_count', 'review_needed',
+        'diagnosis' and 'phenotype_code' (index into rules.phenotypes, -1
+        where no PCOS diagnosis was made).
+        """
+        import numpy as np
+
+        rules = rules or get_rule_plan()
+        arrays = {}
+        size = None
+        for name in INPUT_DEFAULTS:
+            if name in columns:
+                arrays[name] = np.asarray(columns[name])
+                if size is None:
+                    size = arrays[name].shape[0]
+                elif arrays[name].shape[0] != size:
+                    raise ValueError(f"Column '{name}' has {arrays[name].shape[0]} rows, expected {size}")
+        if size is None:
+            size = 0
+        for name, default in INPUT_DEFAULTS.items():
+            if name not in arrays:
+                arrays[name] = np.full(size, default)
+
+        values = rules.evaluate_columns(arrays)
+        return {
+            name: values[name]
+            for name, op, _ in rules.steps
+            if op != "input" and not name.startswith("_") and name != PHENOTYPE_MATCH
+        }
+
+    @classmethod
+    def run_batch(cls, columns, rules=None):
+        """
+        Runs evaluate_batch() and returns one report per row, identical to
+        what run_diagnosis() returns for the same patient.
+        """
+        rules = rules or get_rule_plan()
+        masks = cls.evaluate_batch(columns, rules)
+
+        # Only 2**n alert and criteria combinations exist, so the label lists
+        # are built once and copied into each report.
+        alert_code, alert_lists = _label_combinations(masks, rules.exclusions)
+        criteria_code, criteria_lists = _label_combinations(masks, rules.criteria)
+
+        reports = []
+        for review, alerts, criteria, diagnosis, code in zip(
+            masks[REVIEW_NEEDED].tolist(),
+            alert_code.tolist(),
+            criteria_code.tolist(),
+            masks[DIAGNOSIS].tolist(),
+            masks[PHENOTYPE_CODE].tolist(),
+        ):
+            if review:
+                reports.append({"status": "Review Needed", "alerts": list(alert_lists[alerts])})
+                continue
+            if code >= 0:
+                phenotype, protocol = rules.phenotypes[code]
+            else:
+                phenotype, protocol = "Unknown", "Generic Healthy Living"
+            reports.append({
+                "criteria_met": list(criteria_lists[criteria]),
+                "diagnosis": diagnosis,
+                "phenotype": phenotype,
+                "lifestyle_protocol": protocol,
+            })
+        return reports
 
 # ==========================================
 # TEST RUN (What happens when a user uploads)
 # ==========================================
 
-# Simulating data extracted from PDF and Image
-user_data = {
-    # History
-    "cycle_length_days": 50,      # Irregular
-    "cycles_per_year": 5,         # Irregular
+if __name__ == "__main__":
+    import json
+
+    # Simulating data extracted from PDF and Image
+    user_data = {
+        # History
+        "cycle_length_days": 50,      # Irregular
+        "cycles_per_year": 5,         # Irregular
     
-    # Blood (OCR Extracted)
-    "total_testosterone": 30,     # High (Threshold > 45)
-    "shbg": 45,
-    "fasting_insulin": 8,        # High
-    "fasting_glucose": 85,
-    "tsh": 8.5,                   # Normal
-    "prolactin": 15,              # Normal
-    "crp": 1.2,                   # Normal
+        # Blood (OCR Extracted)
+        "total_testosterone": 30,     # High (Threshold > 45)
+        "shbg": 45,
+        "fasting_insulin": 8,        # High
+        "fasting_glucose": 85,
+        "tsh": 8.5,                   # Normal
+        "prolactin": 15,              # Normal
+        "crp": 1.2,                   # Normal
     
-    # Ultrasound (AI Extracted)
-    "follicle_count_left": 18,    # High (Threshold >= 20)
-    "follicle_count_right": 15,
-    "ovarian_volume_left": 8.5,  # High (Threshold > 10)
-    "ovarian_volume_right": 7.0
-}
+        # Ultrasound (AI Extracted)
+        "follicle_count_left": 18,    # High (Threshold >= 20)
+        "follicle_count_right": 15,
+        "ovarian_volume_left": 8.5,  # High (Threshold > 10)
+        "ovarian_volume_right": 7.0
+    }
 
-# Run the Engine
-engine = PCOSDiagnosticEngine(user_data)
-result = engine.run_diagnosis()
+    # Run the Engine
+    engine = PCOSDiagnosticEngine(user_data)
+    result = engine.run_diagnosis()
 
-# Print Results
-import json
-print(json.dumps(result, indent=4))
\ No newline at end of file
+    # Print Results
+    print(json.dumps(result, indent=4))
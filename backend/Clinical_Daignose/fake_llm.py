@@ -0,0 +1,208 @@
+"""
+A minimal, Gemini-compatible model server for tests and load tests.
+
+It answers `POST /v1beta/models/<model>:generateContent` on 127.0.0.1 after
+a configurable delay, speaking just enough HTTP/1.1 (with keep-alive) for
+both the google-generativeai REST transport and httpx.
+`:streamGenerateContent` sends the reply in 'stream_chunks' pieces,
+'chunk_delay' seconds apart, as a chunked JSON array (or SSE with alt=sse).
+
+Faults can be injected per request: 'faults' is a sequence of ERROR (answer
+503), SLOW (wait 'slow_latency' extra seconds) or None, consumed one per
+request in arrival order; once it runs out, 'error_rate' and 'slow_rate'
+pick faults at random (seeded with 'seed').
+"""
+import asyncio
+import json
+import random
+import threading
+from contextlib import contextmanager
+
+DEFAULT_REPLY = "# Care Plan\n\n1. **DIAGNOSIS EXPLAINED**\n- Placeholder plan from the fake model server."
+
+ERROR = "error"
+SLOW = "slow"
+
+UNAVAILABLE_BODY = json.dumps(
+    {"error": {"code": 503, "message": "Injected fault", "status": "UNAVAILABLE"}}
+).encode("utf-8")
+
+
+class FakeModelServer:
+    def __init__(self, latency=0.0, reply=DEFAULT_REPLY, stream_chunks=4, chunk_delay=0.0,
+                 faults=(), error_rate=0.0, slow_rate=0.0, slow_latency=5.0, seed=0):
+        self.latency = latency
+        self.reply = reply
+        self.stream_chunks = stream_chunks
+        self.chunk_delay = chunk_delay
+        self.faults = list(faults)
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.request_count = 0
+        self.error_count = 0
+        self._random = random.Random(seed)
+        self.url = None
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, "127.0.0.1", 0, backlog=1024)
+            )
+            port = self._server.sockets[0].getsockname()[1]
+            self.url = f"http://127.0.0.1:{port}"
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="fake-model-server", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        async def shutdown():
+            self._server.close()
+            await self._server.wait_closed()
+            # Drop idle keep-alive connections still waiting for a request.
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def response_body(self, path, payload, text=None):
+        return {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": self.reply if text is None else text}]},
+                "finishReason": "STOP",
+                "index": 0,
+            }]
+        }
+
+    def next_fault(self):
+        if self.faults:
+            return self.faults.pop(0)
+        if self.error_rate and self._random.random() < self.error_rate:
+            return ERROR
+        if self.slow_rate and self._random.random() < self.slow_rate:
+            return SLOW
+        return None
+
+    def reply_chunks(self):
+        size = max(1, -(-len(self.reply) // self.stream_chunks))
+        return [self.reply[i:i + size] for i in range(0, len(self.reply), size)]
+
+    async def _write_stream(self, writer, path, payload):
+        sse = "alt=sse" in path
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n"
+            + (b"Content-Type: text/event-stream\r\n\r\n" if sse else b"Content-Type: application/json\r\n\r\n")
+        )
+        pieces = self.reply_chunks()
+        for i, text in enumerate(pieces):
+            item = json.dumps(self.response_body(path, payload, text))
+            if sse:
+                data = f"data: {item}\r\n\r\n"
+            else:
+                data = ("[" if i == 0 else ",") + item + ("]" if i == len(pieces) - 1 else "")
+            data = data.encode("utf-8")
+            writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+            await writer.drain()
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                self.request_count += 1
+                fault = self.next_fault()
+                if self.latency or fault == SLOW:
+                    await asyncio.sleep(self.latency + (self.slow_latency if fault == SLOW else 0))
+
+                if fault == ERROR:
+                    self.error_count += 1
+                    writer.write(
+                        b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n"
+                        + f"Content-Length: {len(UNAVAILABLE_BODY)}\r\n\r\n".encode("latin-1")
+                        + UNAVAILABLE_BODY
+                    )
+                    await writer.drain()
+                    continue
+
+                payload = json.loads(body) if body else {}
+                if ":streamGenerateContent" in path:
+                    await self._write_stream(writer, path, payload)
+                    if headers.get("connection", "").lower() == "close":
+                        break
+                    continue
+
+                data = json.dumps(self.response_body(path, payload)).encode("utf-8")
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1")
+                    + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+@contextmanager
+def use_fake_model(server):
+    """
+    Points both the SDK (sync) and httpx (async) model paths at 'server' and
+    swaps in a fresh, cache-less shared engine for the duration.
+    """
+    from unittest.mock import patch
+
+    from . import rag_engine
+
+    genai = rag_engine.get_genai()
+    try:
+        with patch.object(rag_engine, "api_key", "fake-key"), \
+                patch.object(rag_engine, "LLM_ENDPOINT", server.url), \
+                patch.object(rag_engine, "build_plan_cache", lambda: None):
+            rag_engine.configure_sdk(genai)
+            engine = rag_engine.PCOSRecommendationEngine()
+            with patch.object(rag_engine, "_engine", engine):
+                yield engine
+    finally:
+        if rag_engine.api_key:
+            rag_engine.configure_sdk(genai)
+        else:
+            genai.configure()
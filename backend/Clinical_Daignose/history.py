@@ -0,0 +1,253 @@
+"""
+Persisted diagnosis history.
+
+Views hand each diagnosis (and rag_engine each freshly generated care plan)
+to a HistoryRecorder, which only puts it on an in-memory queue. A single
+daemon thread drains the queue and writes whole batches with bulk_create,
+so the request path never waits on the database. If the queue is full the
+record is dropped and counted rather than blocking the request. Records
+are checked and truncated to the column sizes before they are queued, and a
+batch the database rejects is retried row by row, so one bad record cannot
+lose the rest of its batch.
+
+Settings:
+    PCOS_RECORD_HISTORY    Django setting; set to False to disable recording
+"""
+import base64
+import logging
+import math
+import queue
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .engine import INPUT_DEFAULTS
+from .plan_cache import make_key
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+MAX_PENDING = 10000
+
+_DIAGNOSIS = "diagnosis"
+_PLAN = "plan"
+
+# Column sizes in models.py
+_NAME_CHARS = 100
+_REGION_CHARS = 100
+_PHENOTYPE_CHARS = 50
+
+
+def input_hash(diagnostic_data, region):
+    """Hash of the 13 diagnostic inputs and the region, independent of key order or int/float form."""
+    return make_key(
+        region.strip().lower(),
+        *(float(diagnostic_data.get(name, default)) for name, default in INPUT_DEFAULTS.items())
+    )
+
+
+def _status(diagnosis_result):
+    from .models import DiagnosisResult
+
+    if diagnosis_result.get("status") == "Review Needed":
+        return DiagnosisResult.STATUS_REVIEW
+    if diagnosis_result.get("diagnosis"):
+        return DiagnosisResult.STATUS_DIAGNOSED
+    return DiagnosisResult.STATUS_NOT_PCOS
+
+
+class HistoryRecorder:
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING, start=True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._stop = threading.Event()
+        self._thread = None
+        if start:
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+
+    def record_diagnosis(self, diagnostic_data, region, patient_name, diagnosis_result):
+        try:
+            inputs = {name: float(diagnostic_data.get(name, default)) for name, default in INPUT_DEFAULTS.items()}
+        except (TypeError, ValueError):
+            inputs = {}
+        if not inputs or not all(math.isfinite(value) for value in inputs.values()):
+            logger.warning("Not recording a diagnosis with non-numeric or non-finite inputs")
+            return
+        self._put((
+            _DIAGNOSIS, inputs, (region or "")[:_REGION_CHARS], (patient_name or "")[:_NAME_CHARS],
+            diagnosis_result, timezone.now()
+        ))
+
+    def record_plan(self, phenotype_id, region, plan):
+        self._put((_PLAN, phenotype_id[:_PHENOTYPE_CHARS], (region or "")[:_REGION_CHARS], plan, timezone.now()))
+
+    def _put(self, item):
+        if not getattr(settings, "PCOS_RECORD_HISTORY", True):
+            return
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning("History queue is full; %d records dropped so far", self.dropped)
+
+    def flush(self):
+        """Writes everything queued so far; returns the number of records written."""
+        written = 0
+        while True:
+            batch = self._take(block=False)
+            if not batch:
+                return written
+            written += self._save(batch)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _take(self, block):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval) if block else self._queue.get_nowait())
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._take(block=True)
+            if not batch:
+                continue
+            try:
+                self._save(batch)
+            finally:
+                close_old_connections()
+
+    def _save(self, batch):
+        """Writes 'batch', falling back to one record at a time if it fails; returns the number written."""
+        try:
+            self._write(batch)
+            return len(batch)
+        except Exception:
+            if len(batch) == 1:
+                logger.exception("Failed to write a history record")
+                return 0
+            logger.warning("Failed to write %d history records; retrying one at a time", len(batch), exc_info=True)
+        return sum(self._save([item]) for item in batch)
+
+    def _write(self, batch):
+        from .models import CarePlan, DiagnosisResult, PatientSubmission
+
+        diagnoses = [item[1:] for item in batch if item[0] == _DIAGNOSIS]
+        plans = {}
+        for _, phenotype_id, region, plan, created_at in (item for item in batch if item[0] == _PLAN):
+            content_hash = make_key(plan)
+            plans[content_hash] = CarePlan(
+                phenotype_id=phenotype_id,
+                region=region,
+                content_hash=content_hash,
+                markdown=plan,
+                created_at=created_at
+            )
+
+        with transaction.atomic():
+            submissions = PatientSubmission.objects.bulk_create([
+                PatientSubmission(
+                    patient_name=patient_name,
+                    region=region,
+                    input_hash=input_hash(inputs, region),
+                    created_at=created_at,
+                    **inputs
+                )
+                for inputs, region, patient_name, _, created_at in diagnoses
+            ])
+            DiagnosisResult.objects.bulk_create([
+                DiagnosisResult(
+                    submission=submission,
+                    status=_status(result),
+                    phenotype=result.get("phenotype", "") if result.get("diagnosis") else "",
+                    lifestyle_protocol=result.get("lifestyle_protocol", "") if result.get("diagnosis") else "",
+                    criteria_met=result.get("criteria_met", []),
+                    alerts=result.get("alerts", []),
+                    region=submission.region,
+                    created_at=submission.created_at
+                )
+                for submission, (_, _, _, result, _) in zip(submissions, diagnoses)
+            ])
+            if plans:
+                CarePlan.objects.bulk_create(plans.values(), ignore_conflicts=True)
+
+
+def encode_cursor(created_at, pk):
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{pk}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor(); raises ValueError for anything malformed."""
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(pk)
+    except (UnicodeError, TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def list_diagnoses(phenotype=None, region=None, status=None, since=None, until=None,
+                   cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    One page of DiagnosisResult rows, newest first, plus the cursor for the
+    next page (None on the last page). Pages are keyset-paginated on
+    (created_at, id), so each page is an index range scan however deep the
+    client has paged.
+    """
+    from django.db.models import Q
+
+    from .models import DiagnosisResult
+
+    rows = DiagnosisResult.objects.select_related("submission").order_by("-created_at", "-id")
+    if phenotype:
+        rows = rows.filter(phenotype=phenotype)
+    if region:
+        rows = rows.filter(region=region)
+    if status:
+        rows = rows.filter(status=status)
+    if since:
+        rows = rows.filter(created_at__gte=since)
+    if until:
+        rows = rows.filter(created_at__lt=until)
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        rows = rows.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    page = list(rows[:limit + 1])
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1].created_at, page[-1].pk)
+    return page, next_cursor
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_history_recorder():
+    """Returns the process-wide HistoryRecorder, starting its writer thread on first use."""
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = HistoryRecorder()
+    return _recorder
@@ -0,0 +1,150 @@
+"""
+Idempotent handling of repeated diagnosis submissions.
+
+A double click, a retry or a page refresh resubmits exactly the same lab
+values. Requests are keyed on a hash of the normalised inputs, region and
+patient name (see history.input_hash), and:
+
+  * a request whose key is already being computed waits for that
+    computation instead of starting its own (single-flight);
+  * a finished result is replayed for PCOS_IDEMPOTENCY_TTL seconds
+    (default 300) from a bounded in-process LRU
+    (PCOS_IDEMPOTENCY_MAX_ENTRIES, default 1024).
+
+Failed computations are not stored; every waiter sees the same exception,
+and the next retry computes afresh.
+"""
+import os
+import threading
+
+from .history import input_hash
+from .plan_cache import MemoryPlanCache, make_key
+
+DEFAULT_TTL = 5 * 60
+DEFAULT_MAX_ENTRIES = 1024
+
+# How a result was obtained, as returned by IdempotencyStore.run()
+COMPUTED = "computed"
+COALESCED = "coalesced"
+REPLAYED = "replayed"
+
+
+def request_key(diagnostic_data, region, patient_name, *variant):
+    """Idempotency key for one submission; 'variant' separates e.g. plan modes."""
+    return make_key(input_hash(diagnostic_data, region), patient_name, *variant)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class IdempotencyStore:
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.results = MemoryPlanCache(ttl=ttl, max_entries=max_entries)
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, compute, keep=None):
+        """
+        Returns (result, how), where 'how' is COMPUTED, COALESCED or REPLAYED.
+        If 'keep' is given, a result is only stored when keep(result) is true.
+        """
+        result, call, leader = self._join(key)
+        if result is not None:
+            return result, REPLAYED
+        if not leader:
+            return self._wait(call), COALESCED
+
+        try:
+            call.result = compute()
+        except Exception as e:
+            call.error = e
+            raise
+        else:
+            self._keep(key, call.result, keep)
+        finally:
+            self._release(key, call)
+        return call.result, COMPUTED
+
+    async def arun(self, key, compute, keep=None):
+        """
+        run() for async views: 'compute' is a coroutine function, and
+        waiting for another request's computation happens off the event loop.
+        Sync and async requests for the same key share one computation.
+        """
+        import asyncio
+
+        from asgiref.sync import sync_to_async
+
+        result, call, leader = self._join(key)
+        if result is not None:
+            return result, REPLAYED
+        if not leader:
+            return await sync_to_async(self._wait, thread_sensitive=False)(call), COALESCED
+
+        try:
+            call.result = await compute()
+        except asyncio.CancelledError:
+            call.error = RuntimeError("The request computing this result was cancelled")
+            raise
+        except Exception as e:
+            call.error = e
+            raise
+        else:
+            self._keep(key, call.result, keep)
+        finally:
+            self._release(key, call)
+        return call.result, COMPUTED
+
+    def _join(self, key):
+        """(stored result or None, call, whether this request computes it)."""
+        result = self.results.get(key)
+        if result is not None:
+            return result, None, False
+
+        with self._lock:
+            # Re-check under the lock: the leader may have just finished
+            result = self.results.get(key)
+            if result is not None:
+                return result, None, False
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        return None, call, leader
+
+    @staticmethod
+    def _wait(call):
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _keep(self, key, result, keep):
+        if keep is None or keep(result):
+            self.results.set(key, result)
+
+    def _release(self, key, call):
+        with self._lock:
+            del self._calls[key]
+        call.done.set()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_idempotency_store():
+    """Returns the process-wide IdempotencyStore."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = IdempotencyStore(
+                    ttl=float(os.getenv("PCOS_IDEMPOTENCY_TTL", DEFAULT_TTL)),
+                    max_entries=int(os.getenv("PCOS_IDEMPOTENCY_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+                )
+    return _store
@@ -0,0 +1,184 @@
+"""
+Background care-plan generation backed by a local SQLite queue.
+
+The diagnosis API enqueues a plan job and returns straight away; a small,
+fixed pool of worker threads per process claims pending jobs from the
+SQLite file and stores the generated markdown (or the error) on the row.
+Several worker processes can share one file: claims are atomic, and a job
+whose worker died is picked up again once its lease expires.
+
+Settings (environment variables):
+    PCOS_PLAN_JOB_DB       path of the SQLite file
+    PCOS_PLAN_WORKERS      worker threads per process (default 4)
+    PCOS_PLAN_JOB_TTL      seconds finished jobs are kept (default 1 day)
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+DEFAULT_WORKERS = 4
+DEFAULT_JOB_TTL = 24 * 60 * 60
+LEASE_SECONDS = 10 * 60
+POLL_INTERVAL = 1.0
+# Pause after a store error (e.g. "database is locked") before trying again
+ERROR_BACKOFF = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteJobStore:
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS plan_jobs ("
+                " id TEXT PRIMARY KEY, status TEXT NOT NULL,"
+                " phenotype_id TEXT NOT NULL, region TEXT NOT NULL, patient_name TEXT NOT NULL,"
+                " result TEXT, error TEXT,"
+                " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS plan_jobs_queue ON plan_jobs (status, created_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self, phenotype_id, region, patient_name):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._connect().execute(
+            "INSERT INTO plan_jobs (id, status, phenotype_id, region, patient_name, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, PENDING, phenotype_id, region, patient_name, now, now),
+        )
+        return job_id
+
+    def get(self, job_id):
+        row = self._connect().execute("SELECT * FROM plan_jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def claim_next(self):
+        """Atomically marks the oldest runnable job as running and returns it."""
+        now = time.time()
+        row = self._connect().execute(
+            "UPDATE plan_jobs SET status = ?, updated_at = ? WHERE id = ("
+            " SELECT id FROM plan_jobs"
+            " WHERE status = ? OR (status = ? AND updated_at < ?)"
+            " ORDER BY created_at LIMIT 1)"
+            " RETURNING *",
+            (RUNNING, now, PENDING, RUNNING, now - LEASE_SECONDS),
+        ).fetchone()
+        return dict(row) if row else None
+
+    def finish(self, job_id, result=None, error=None):
+        self._connect().execute(
+            "UPDATE plan_jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+            (FAILED if error else DONE, result, error, time.time(), job_id),
+        )
+
+    def purge(self, older_than):
+        self._connect().execute(
+            "DELETE FROM plan_jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (DONE, FAILED, older_than),
+        )
+
+
+class PlanJobQueue:
+    """Fixed pool of daemon threads draining a SQLiteJobStore."""
+
+    def __init__(self, store, generate, workers=DEFAULT_WORKERS, job_ttl=DEFAULT_JOB_TTL):
+        self.store = store
+        self.generate = generate
+        self.job_ttl = job_ttl
+        self._wakeup = threading.Semaphore(0)
+        self._stop = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"plan-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, phenotype_id, region, patient_name):
+        job_id = self.store.create(phenotype_id, region, patient_name)
+        self._wakeup.release()
+        return job_id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def stop(self):
+        self._stop.set()
+        for _ in self._threads:
+            self._wakeup.release()
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                self._run_next()
+            except Exception:
+                # A job whose result could not be stored is retried once its
+                # lease expires.
+                logger.exception("Plan worker failed; retrying in %s s", ERROR_BACKOFF)
+                self._stop.wait(ERROR_BACKOFF)
+
+    def _run_next(self):
+        job = self.store.claim_next()
+        if job is None:
+            self._wakeup.acquire(timeout=POLL_INTERVAL)
+            return
+        try:
+            plan = self.generate(job["phenotype_id"], job["region"], job["patient_name"])
+        except Exception as e:
+            self.store.finish(job["id"], error=str(e))
+        else:
+            self.store.finish(job["id"], result=plan)
+        self.store.purge(time.time() - self.job_ttl)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_plan_queue():
+    """Returns the process-wide PlanJobQueue, starting its workers on first use."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                from .rag_engine import LLM_ERROR_PREFIXES, get_recommendation_engine
+
+                def generate(phenotype_id, region, patient_name):
+                    plan = get_recommendation_engine().generate_comprehensive_plan(
+                        phenotype_id=phenotype_id,
+                        region=region,
+                        user_name=patient_name
+                    )
+                    if plan.startswith(LLM_ERROR_PREFIXES):
+                        raise RuntimeError(plan)
+                    return plan
+
+                default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan_jobs.sqlite3")
+                _queue = PlanJobQueue(
+                    SQLiteJobStore(os.getenv("PCOS_PLAN_JOB_DB", default_path)),
+                    generate,
+                    workers=int(os.getenv("PCOS_PLAN_WORKERS", DEFAULT_WORKERS)),
+                    job_ttl=float(os.getenv("PCOS_PLAN_JOB_TTL", DEFAULT_JOB_TTL)),
+                )
+    return _queue
@@ -0,0 +1,385 @@
+"""
+Blood values for PCOSDiagnosticEngine from lab-report PDFs and images.
+
+A report goes through four stages, each timed in the result (and added to
+pcos_stage_seconds as lab_<stage>):
+
+  hash       sha256 of the file; a report seen before is answered from the
+             cache (build_plan_cache() backend) without opening it
+  rasterize  PDF pages that carry a text layer are read as text; scanned
+             pages and images are rendered at OCR_DPI
+  ocr        Tesseract on the rendered pages
+  extract    the seven blood values and their units, converted to the
+             units the diagnostic rules use (see ANALYTES)
+
+Pages are rasterized and recognized in parallel on a process pool of
+PCOS_OCR_WORKERS processes (default: one per CPU). A worker that dies
+breaks the pool; the broken pool is dropped and the next report starts a
+new one. Rasterized pages are limited to MAX_PIXELS
+(PCOS_LAB_REPORT_MAX_PIXELS): larger images are rejected before they are
+decoded, and PDF pages are rendered at a lower DPI instead. pypdfium2,
+Pillow and pytesseract are only imported where pages are read, and the
+tesseract binary must be on PATH for scanned pages.
+"""
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .metrics import observe_stage, record_cache
+from .plan_cache import build_plan_cache, make_key
+
+logger = logging.getLogger(__name__)
+
+# Unset or 0: one worker per CPU
+OCR_WORKERS = int(os.getenv("PCOS_OCR_WORKERS", "0")) or os.cpu_count() or 1
+OCR_DPI = int(os.getenv("PCOS_OCR_DPI", "300"))
+MAX_PAGES = int(os.getenv("PCOS_LAB_REPORT_MAX_PAGES", "20"))
+MAX_BYTES = int(os.getenv("PCOS_LAB_REPORT_MAX_BYTES", str(20 * 1024 * 1024)))
+# An A3 page at 300 DPI is about 17.4 million pixels
+MAX_PIXELS = int(os.getenv("PCOS_LAB_REPORT_MAX_PIXELS", str(40_000_000)))
+
+# A page with at least this many non-blank characters in its text layer is
+# not OCRed.
+MIN_TEXT_CHARS = 20
+
+# Bump when extraction changes so cached results are not reused.
+EXTRACTOR_VERSION = 1
+
+PDF = "pdf"
+IMAGE = "image"
+TEXT_LAYER = "text"
+OCR = "ocr"
+
+# field -> (label pattern, lines to skip, unit the rules use, {unit: factor to that unit})
+ANALYTES = {
+    "total_testosterone": (
+        r"\btestosterone\b", r"\b(?:free|bio-?available|calculated)\b",
+        "ng/dL", {"ng/dl": 1, "nmol/l": 28.84, "ng/ml": 100, "pg/ml": 0.1},
+    ),
+    "shbg": (
+        r"\bshbg\b|sex\s*hormone[\s-]*binding\s*globulin", None,
+        "nmol/L", {"nmol/l": 1},
+    ),
+    "fasting_insulin": (
+        r"\binsulin\b", r"resistance|\blike\b|\bigf\b|antibod|post|\bpp\b|\bhours?\b|\bhrs?\b",
+        "uIU/mL", {"uiu/ml": 1, "miu/l": 1, "mu/l": 1, "uu/ml": 1, "pmol/l": 1 / 6.0},
+    ),
+    "fasting_glucose": (
+        r"\bglucose\b|\bfbs\b|\bfpg\b|blood\s*sugar",
+        r"post|\bpp\b|random|\bhours?\b|\bhrs?\b|tolerance|urine|hba1c|\bmean\b|average",
+        "mg/dL", {"mg/dl": 1, "mmol/l": 18.016},
+    ),
+    "tsh": (
+        r"\btsh\b|thyroid[\s-]*stimulating\s*hormone", None,
+        "mIU/L", {"miu/l": 1, "uiu/ml": 1, "mu/l": 1},
+    ),
+    "prolactin": (
+        r"\bprolactin\b|\bprl\b", r"macro",
+        "ng/mL", {"ng/ml": 1, "ug/l": 1, "miu/l": 1 / 21.2, "mu/l": 1 / 21.2},
+    ),
+    "crp": (
+        r"\b(?:hs-?)?crp\b|c[\s-]*reactive\s*protein", None,
+        "mg/L", {"mg/l": 1, "mg/dl": 10},
+    ),
+}
+
+_LABELS = {
+    field: (re.compile(label, re.I), re.compile(skip, re.I) if skip else None)
+    for field, (label, skip, _, _) in ANALYTES.items()
+}
+_UNIT = re.compile(r"(?<![a-z])(" + "|".join(sorted(
+    {re.escape(unit) for _, _, _, units in ANALYTES.values() for unit in units}, key=len, reverse=True
+)) + r")(?![a-z])")
+_NUMBER = re.compile(r"(?<![\w.])[<>]?\s*(\d+(?:[.,]\d+)?)(?![\w%])")
+_LETTERS_IN_PARENS = re.compile(r"\([^)]*[A-Za-z][^)]*\)")
+
+
+def _normalise_units(line):
+    line = line.lower().replace("µ", "u").replace("μ", "u").replace("mcg", "ug")
+    return re.sub(r"\s*/\s*", "/", line)
+
+
+def _find_value(line, match, units):
+    """
+    (reported number, unit or None) for an analyte label matched in 'line'.
+    The unit is the one written right after the number; a unit that is not
+    one of 'units' makes the value unreadable, (None, None).
+    """
+    rest = _LETTERS_IN_PARENS.sub(" ", line[match.end():])
+    number = _NUMBER.search(rest)
+    if number is None:
+        return None, None
+    unit = _UNIT.match(_normalise_units(rest[number.end():]).lstrip())
+    if unit is not None and unit.group(1) not in units:
+        return None, None
+    return float(number.group(1).replace(",", ".")), unit.group(1) if unit else None
+
+
+def extract_values(pages):
+    """
+    Finds the ANALYTES in the text of each page. Returns {field: detail},
+    where detail has the converted 'value', the 'reported' number and
+    'unit' (None when the line gave no unit and the rules' unit was
+    assumed), and the 1-based 'page' and source 'line'. Insulin and
+    glucose prefer lines that mention fasting.
+    """
+    found = {}
+    for page_number, text in enumerate(pages, 1):
+        for line in text.splitlines():
+            for field, (label, skip) in _LABELS.items():
+                match = label.search(line)
+                if match is None or (skip is not None and skip.search(line)):
+                    continue
+                if field in found and not (field.startswith("fasting_") and "fast" in line.lower()
+                                           and "fast" not in found[field]["line"].lower()):
+                    continue
+                _, _, rules_unit, factors = ANALYTES[field]
+                reported, unit = _find_value(line, match, factors)
+                if reported is None:
+                    continue
+                found[field] = {
+                    "value": round(reported * factors[unit] if unit else reported, 3),
+                    "reported": reported,
+                    "unit": unit,
+                    "rules_unit": rules_unit,
+                    "page": page_number,
+                    "line": line.strip(),
+                }
+    return {field: found[field] for field in ANALYTES if field in found}
+
+
+def sniff_kind(path):
+    with open(path, "rb") as f:
+        return PDF if f.read(5) == b"%PDF-" else IMAGE
+
+
+def _open_image(path):
+    """Opens an image with Pillow, raising ValueError if it is over MAX_PIXELS."""
+    from PIL import Image
+
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    try:
+        image = Image.open(path)
+    except Image.DecompressionBombError:
+        raise ValueError(f"Pages are limited to {MAX_PIXELS} pixels") from None
+    _check_pixels(image)
+    return image
+
+
+def _check_pixels(image):
+    if image.width * image.height > MAX_PIXELS:
+        image.close()
+        raise ValueError(f"Pages are limited to {MAX_PIXELS} pixels")
+
+
+def render_scale(width, height, dpi=OCR_DPI):
+    """pypdfium2 scale for a page of 'width' x 'height' points: 'dpi', or less to stay within MAX_PIXELS."""
+    return min(dpi / 72, math.sqrt(MAX_PIXELS / max(width * height, 1)))
+
+
+def count_pages(path, kind):
+    if kind == PDF:
+        import pypdfium2 as pdfium
+
+        pdf = pdfium.PdfDocument(path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+    with _open_image(path) as image:
+        return getattr(image, "n_frames", 1)
+
+
+def read_page(path, kind, index, dpi=OCR_DPI):
+    """
+    Returns (text, source, rasterize_seconds, ocr_seconds) for one page;
+    runs in a worker process.
+    """
+    started = time.perf_counter()
+    if kind == PDF:
+        import pypdfium2 as pdfium
+
+        pdf = pdfium.PdfDocument(path)
+        try:
+            page = pdf[index]
+            text = page.get_textpage().get_text_bounded()
+            if len("".join(text.split())) >= MIN_TEXT_CHARS:
+                return text, TEXT_LAYER, time.perf_counter() - started, 0.0
+            image = page.render(scale=render_scale(*page.get_size(), dpi), grayscale=True).to_pil()
+        finally:
+            pdf.close()
+    else:
+        with _open_image(path) as source:
+            source.seek(index)
+            _check_pixels(source)
+            image = source.convert("L")
+
+    rasterized = time.perf_counter()
+    import pytesseract
+
+    text = pytesseract.image_to_string(image)
+    return text, OCR, rasterized - started, time.perf_counter() - rasterized
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_ocr_pool():
+    """
+    Process-wide pool of OCR_WORKERS processes, started on first use.
+    Workers are spawned rather than forked from the (threaded) server.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=OCR_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _reset_ocr_pool(pool):
+    """Drops 'pool', whose worker died, so the next get_ocr_pool() starts a new one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_lab_report_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = build_plan_cache()
+    return _cache
+
+
+def read_lab_report(path, workers=None, cache=None):
+    """
+    Extracts the blood values from the PDF or image at 'path'. Pages are
+    read on the shared OCR pool, or in this process with workers=0;
+    'cache' defaults to the shared lab-report cache.
+
+    Returns a dict: sha256, pages, values ({field: number in the rules'
+    unit}), details (see extract_values()), missing fields, the source of
+    each page ("text" or "ocr"), per-page errors, timings (seconds per
+    stage, total and pages_per_sec) and whether the result was cached.
+    Raises ValueError for files that are not a readable PDF or image, or
+    have more than MAX_PAGES pages.
+    """
+    cache = cache if cache is not None else get_lab_report_cache()
+    started = time.perf_counter()
+    sha256 = file_sha256(path)
+    hashed = time.perf_counter()
+    timings = {"hash": hashed - started}
+    observe_stage("lab_hash", timings["hash"])
+
+    key = make_key("lab_report", EXTRACTOR_VERSION, sha256)
+    cached = cache.get(key) if cache else None
+    if cache:
+        record_cache("lab_report", cached is not None)
+    if cached is not None:
+        result = json.loads(cached)
+        timings["total"] = time.perf_counter() - started
+        result.update(timings=timings, cached=True)
+        return result
+
+    kind = sniff_kind(path)
+    try:
+        pages = count_pages(path, kind)
+    except Exception as e:
+        raise ValueError(f"Not a readable PDF or image: {e}") from None
+    if pages > MAX_PAGES:
+        raise ValueError(f"Reports are limited to {MAX_PAGES} pages ({pages} given)")
+
+    if workers == 0:
+        futures = [_Done(read_page, path, kind, index) for index in range(pages)]
+    else:
+        pool = get_ocr_pool() if workers is None else ProcessPoolExecutor(max_workers=workers)
+        try:
+            futures = [pool.submit(read_page, path, kind, index) for index in range(pages)]
+        except BrokenProcessPool:
+            if workers is not None:
+                raise
+            _reset_ocr_pool(pool)
+            pool = get_ocr_pool()
+            futures = [pool.submit(read_page, path, kind, index) for index in range(pages)]
+
+    texts, sources, errors = [], [], []
+    timings.update(rasterize=0.0, ocr=0.0)
+    for index, future in enumerate(futures):
+        try:
+            text, source, rasterize_seconds, ocr_seconds = future.result()
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool) and workers is None:
+                _reset_ocr_pool(pool)
+            logger.warning("Could not read page %d of a lab report: %s", index + 1, e)
+            text, source, rasterize_seconds, ocr_seconds = "", None, 0.0, 0.0
+            errors.append({"page": index + 1, "error": str(e) or type(e).__name__})
+        texts.append(text)
+        sources.append(source)
+        timings["rasterize"] += rasterize_seconds
+        timings["ocr"] += ocr_seconds
+    if workers:
+        pool.shutdown()
+    read = time.perf_counter()
+
+    details = extract_values(texts)
+    timings["extract"] = time.perf_counter() - read
+    for stage in ("rasterize", "ocr", "extract"):
+        observe_stage("lab_" + stage, timings[stage])
+
+    result = {
+        "sha256": sha256,
+        "pages": pages,
+        "values": {field: detail["value"] for field, detail in details.items()},
+        "details": details,
+        "missing": [field for field in ANALYTES if field not in details],
+        "page_sources": sources,
+        "errors": errors,
+    }
+    if cache and not errors:
+        cache.set(key, json.dumps(result))
+
+    timings["total"] = time.perf_counter() - started
+    timings["pages_per_sec"] = pages / (read - hashed) if read > hashed else 0.0
+    result.update(timings=timings, cached=False)
+    return result
+
+
+class _Done:
+    """A finished call with the Future.result() interface, for workers=0."""
+
+    def __init__(self, func, *args):
+        try:
+            self._value, self._error = func(*args), None
+        except Exception as e:
+            self._value, self._error = None, e
+
+    def result(self):
+        if self._error is not None:
+            raise self._error
+        return self._value
@@ -0,0 +1,128 @@
+"""
+Structured, non-blocking logging for the Clinical_Daignose loggers.
+
+Wired up through Django's LOGGING setting (see PCOS_Intelligence.settings):
+
+    logger.info("Diagnosis served", extra={"fields": {"region": region, "patient_name": name}})
+
+  * SamplingFilter keeps only a fraction of DEBUG/INFO records
+    (PCOS_LOG_SAMPLE_RATE, default 1.0); warnings and errors are always kept.
+  * AsyncQueueHandler only puts the record on a bounded in-memory queue; a
+    QueueListener thread formats and writes it, so the request thread never
+    waits on stderr. If the queue is full the record is dropped and counted.
+  * JsonFormatter writes one JSON object per line and replaces the values
+    of patient identifiers and lab results in "fields" with "[REDACTED]".
+"""
+import copy
+import json
+import logging
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Patient identifiers and the 13 lab inputs (engine.INPUT_DEFAULTS); listed
+# here because logging is configured before the app is importable
+DEFAULT_REDACTED_FIELDS = (
+    "patient_name", "user_name",
+    "cycle_length_days", "cycles_per_year", "total_testosterone", "shbg",
+    "fasting_insulin", "fasting_glucose", "tsh", "prolactin", "crp",
+    "follicle_count_left", "follicle_count_right", "ovarian_volume_left", "ovarian_volume_right",
+)
+REDACTED = "[REDACTED]"
+
+MAX_PENDING = 10000
+
+
+def redact(value, fields):
+    """Copy of 'value' with every dict entry whose key is in 'fields' replaced by REDACTED."""
+    if isinstance(value, dict):
+        return {key: REDACTED if key in fields else redact(item, fields) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item, fields) for item in value]
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, redact_fields=DEFAULT_REDACTED_FIELDS):
+        super().__init__()
+        self.redact_fields = frozenset(redact_fields)
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(redact(fields, self.redact_fields))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Passes a 'rate' fraction of records below WARNING, and every record at WARNING or above."""
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = float(rate)
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    QueueHandler with its own bounded queue and listener thread. The
+    formatter set on it (e.g. by dictConfig) is used by the writing
+    handler on the listener thread, not by the request thread.
+    """
+
+    def __init__(self, target=None, max_pending=MAX_PENDING):
+        super().__init__(queue.Queue(maxsize=max_pending))
+        self.target = target or logging.StreamHandler()
+        self.dropped = 0
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # The record stays in-process: merge the arguments now (they may be
+        # mutated after the call returns) but leave formatting to the listener.
+        # Like QueueHandler.prepare, work on a copy (other handlers still see
+        # the caller's record) and keep the traceback as text rather than
+        # holding its frames alive on the queue.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = (self.formatter or logging.Formatter()).formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Blocks until everything queued so far has been written."""
+        if self.listener._thread is not None:
+            self.listener.stop()
+            self.target.flush()
+            self.listener.start()
+
+    def close(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+        self.target.close()
+        super().close()
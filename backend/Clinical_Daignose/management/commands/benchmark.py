@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from Clinical_Daignose.benchmarks import (
+    BASELINE_PATH, BENCHMARKS, DEFAULT_THRESHOLD, HOST_KEY, calibrate, compare_to_baseline, host_info, load_baseline,
+    save_baseline,
+)
+
+
+class Command(BaseCommand):
+    help = "Runs the Clinical_Daignose micro-benchmarks and prints their results."
+
+    def add_arguments(self, parser):
+        parser.add_argument("names", nargs="*", help=f"Benchmarks to run (default: all). Choices: {', '.join(BENCHMARKS)}")
+        parser.add_argument("--baseline", default=BASELINE_PATH, help="JSON baseline file (default: %(default)s)")
+        parser.add_argument("--save-baseline", action="store_true", help="Store this run's timings as the baseline")
+        parser.add_argument("--check", action="store_true", help="Fail if a timing regressed beyond --threshold")
+        parser.add_argument(
+            "--threshold", type=float, default=DEFAULT_THRESHOLD,
+            help="Allowed regression as a fraction of the baseline, after scaling it to this host (default: %(default)s)"
+        )
+
+    def handle(self, *args, **options):
+        names = options["names"] or list(BENCHMARKS)
+        unknown = [name for name in names if name not in BENCHMARKS]
+        if unknown:
+            raise CommandError(f"Unknown benchmark(s): {', '.join(unknown)}")
+
+        results = {}
+        for name in names:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            results[name] = BENCHMARKS[name]()
+            for key, value in results[name].items():
+                if isinstance(value, float):
+                    value = f"{value:,.1f}"
+                self.stdout.write(f"  {key}: {value}")
+
+        if not (options["save_baseline"] or options["check"]):
+            return
+        calibration_us = calibrate()
+        baseline = load_baseline(options["baseline"])
+        recorded = baseline.get(HOST_KEY, {}).get("calibration_us")
+        self.stdout.write(f"Calibration: {calibration_us:,.1f} us" + (
+            f" (baseline host: {recorded:,.1f} us)" if recorded and not options["save_baseline"] else ""
+        ))
+
+        if options["save_baseline"]:
+            save_baseline(results, options["baseline"], host=host_info(calibration_us))
+            self.stdout.write(f"Baseline saved to {options['baseline']}")
+
+        if options["check"]:
+            regressions = compare_to_baseline(results, baseline, options["threshold"], calibration_us)
+            if regressions:
+                raise CommandError("Performance regressions:\n  " + "\n  ".join(regressions))
+            self.stdout.write(self.style.SUCCESS(f"No regressions beyond {options['threshold']:.0%}"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from Clinical_Daignose.protocols import ProtocolSnapshot
+from Clinical_Daignose.rag_engine import get_recommendation_engine
+from Clinical_Daignose.static_plans import STATIC_PLAN_DIR, build_static_plans
+
+
+class Command(BaseCommand):
+    help = "Renders the static fallback care plan of every phenotype into precompressed HTML artifacts."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default=STATIC_PLAN_DIR, help="Artifact directory (default: %(default)s)")
+
+    def handle(self, *args, **options):
+        try:
+            snapshot = ProtocolSnapshot.load(get_recommendation_engine().json_path)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Cannot load protocols: {e}")
+
+        manifest = build_static_plans(snapshot, options["output"])
+        for phenotype_id, sizes in manifest["plans"].items():
+            self.stdout.write(
+                f"  {phenotype_id}: {sizes['identity']:,} bytes, gzip {sizes['gzip']:,}, br {sizes['br']:,}"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"Built {len(manifest['plans'])} static plans (protocols {manifest['protocols_version']}) "
+            f"in {options['output']}"
+        ))
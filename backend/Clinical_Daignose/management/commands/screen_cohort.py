@@ -0,0 +1,54 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Clinical_Daignose.screening import CHUNK_SIZE, screen_file
+
+
+class Command(BaseCommand):
+    help = (
+        "Diagnoses every row of a CSV or Parquet registry (the 13 lab/ultrasound fields as columns) "
+        "in parallel and writes one NDJSON result line per row."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="CSV or Parquet (.parquet/.pq) file")
+        parser.add_argument("--output", help="NDJSON output file (default: <input>.screening.ndjson)")
+        parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per CPU; 0 = none)")
+        parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Rows per chunk (default: %(default)s)")
+        parser.add_argument("--id-column", help="Column copied into each result line as 'id'")
+        parser.add_argument("--resume", action="store_true", help="Continue from the checkpoint of an interrupted run")
+
+    def handle(self, *args, **options):
+        input_path = options["input"]
+        output_path = options["output"] or os.path.splitext(input_path)[0] + ".screening.ndjson"
+        if not os.path.isfile(input_path):
+            raise CommandError(f"No such file: {input_path}")
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1")
+
+        def progress(rows, seconds):
+            sys.stderr.write(f"\r  {rows:,} rows screened ({seconds:.1f}s)")
+            sys.stderr.flush()
+
+        try:
+            summary = screen_file(
+                input_path, output_path,
+                workers=options["workers"],
+                chunk_size=options["chunk_size"],
+                id_column=options["id_column"],
+                resume=options["resume"],
+                progress=progress if options["verbosity"] > 0 else None,
+            )
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        if options["verbosity"] > 0:
+            sys.stderr.write("\n")
+
+        if summary["resumed_from"]:
+            self.stdout.write(f"Resumed after row {summary['resumed_from']:,}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Screened {summary['rows']:,} rows ({summary['diagnosed']:,} diagnosed, {summary['errors']:,} errors) "
+            f"into {output_path} in {summary['seconds']:.1f}s, {summary['rows_per_sec']:,.0f} rows/s"
+        ))
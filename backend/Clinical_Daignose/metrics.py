@@ -0,0 +1,308 @@
+"""
+In-process request metrics, served in the Prometheus text format at /metrics.
+
+Code under measurement only calls the helpers at the bottom of this module:
+
+    with timed("diagnosis"):            # pcos_stage_seconds{stage="diagnosis"}
+        ...
+    with in_flight("llm"):              # pcos_in_flight{kind="llm"}
+        ...
+    record_cache("plan", hit)           # pcos_cache_requests_total / pcos_cache_hit_ratio
+    record_llm_error("timeout")         # pcos_llm_errors_total{kind="timeout"}
+
+Each metric keeps its values per worker process, so with several workers
+Prometheus should scrape each one (or sum them) like any other
+multi-process exporter.
+
+Settings:
+    PCOS_METRICS    Django setting; set to False to make every helper a no-op
+                    and /metrics return 404
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+# Seconds; spans a sub-millisecond diagnosis up to a slow model call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """[(suffix, label_values, extra_label, value)] for render()."""
+        with self._lock:
+            return [("", labels, "", value) for labels, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.label_names, labels, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # Per-bucket counts, then the +Inf bucket, sum and count
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, *labels):
+        series = self._values.get(labels)
+        return series[-1] if series else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._values.items())
+        for labels, series in items:
+            cumulative = 0
+            for bound, hits in zip(self.buckets + (float("inf"),), series):
+                cumulative += hits
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                samples.append(("_bucket", labels, f'le="{le}"', cumulative))
+            samples.append(("_sum", labels, "", series[-2]))
+            samples.append(("_count", labels, "", series[-1]))
+        return samples
+
+
+class HitRatio(_Metric):
+    """Gauge derived at scrape time from a ('cache', 'result') counter."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, counter):
+        super().__init__(name, documentation, labels=("cache",))
+        self.counter = counter
+
+    def samples(self):
+        totals = {}
+        for _, (cache, result), _, value in self.counter.samples():
+            hits, requests = totals.get(cache, (0, 0))
+            totals[cache] = (hits + (value if result == "hit" else 0), requests + value)
+        return [("", (cache,), "", hits / requests) for cache, (hits, requests) in sorted(totals.items()) if requests]
+
+
+REQUEST_SECONDS = Histogram("pcos_request_seconds", "Time spent in an instrumented view.", labels=("view",))
+STAGE_SECONDS = Histogram(
+    "pcos_stage_seconds",
+    "Time spent in each request stage (validation, diagnosis, prompt, llm, markdown).",
+    labels=("stage",)
+)
+CACHE_REQUESTS = Counter(
+    "pcos_cache_requests_total", "Lookups in the plan and idempotency caches.", labels=("cache", "result")
+)
+CACHE_HIT_RATIO = HitRatio("pcos_cache_hit_ratio", "Hits / lookups per cache since the worker started.", CACHE_REQUESTS)
+LLM_CALLS = Counter("pcos_llm_calls_total", "Calls made to the model.", labels=("mode",))
+LLM_ERRORS = Counter("pcos_llm_errors_total", "Model calls that produced no plan.", labels=("kind",))
+LLM_FALLBACKS = Counter("pcos_llm_fallbacks_total", "Responses served with a fallback instead of a generated plan.")
+IN_FLIGHT = Gauge("pcos_in_flight", "Requests and model calls currently in progress.", labels=("kind",))
+
+REGISTRY = (
+    REQUEST_SECONDS, STAGE_SECONDS, CACHE_REQUESTS, CACHE_HIT_RATIO,
+    LLM_CALLS, LLM_ERRORS, LLM_FALLBACKS, IN_FLIGHT,
+)
+
+
+# PCOS_METRICS, read once: attribute access on django.conf.settings costs
+# more than recording a sample
+_enabled = None
+
+
+def enabled():
+    global _enabled
+    if _enabled is None:
+        _enabled = getattr(settings, "PCOS_METRICS", True)
+    return _enabled
+
+
+def _forget_enabled(setting, **kwargs):
+    global _enabled
+    if setting == "PCOS_METRICS":
+        _enabled = None
+
+
+setting_changed.connect(_forget_enabled)
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    """Clears every metric (for tests)."""
+    for metric in REGISTRY:
+        metric.clear()
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class _InFlight:
+    __slots__ = ("labels",)
+
+    def __init__(self, labels):
+        self.labels = labels
+
+    def __enter__(self):
+        IN_FLIGHT.inc(*self.labels)
+        return self
+
+    def __exit__(self, *exc_info):
+        IN_FLIGHT.dec(*self.labels)
+
+
+class _NoOp:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+
+_NOOP = _NoOp()
+
+
+def timed(stage):
+    """Context manager adding its duration to pcos_stage_seconds{stage=...}."""
+    return _Timer(STAGE_SECONDS, (stage,)) if enabled() else _NOOP
+
+
+def observe_stage(stage, seconds):
+    """Adds a duration measured elsewhere (e.g. in a worker process) to pcos_stage_seconds."""
+    if enabled():
+        STAGE_SECONDS.observe(seconds, stage)
+
+
+def in_flight(kind):
+    """Context manager counting itself in pcos_in_flight{kind=...} while it runs."""
+    return _InFlight((kind,)) if enabled() else _NOOP
+
+
+def record_cache(cache, hit):
+    if enabled():
+        CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
+
+
+def record_llm_call(mode):
+    if enabled():
+        LLM_CALLS.inc(mode)
+
+
+def record_llm_error(kind):
+    if enabled():
+        LLM_ERRORS.inc(kind)
+
+
+def record_llm_fallback():
+    if enabled():
+        LLM_FALLBACKS.inc()
+
+
+def instrument_view(name):
+    """Decorator timing a sync or async view in pcos_request_seconds and counting it in pcos_in_flight."""
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if not enabled():
+                    return await view(request, *args, **kwargs)
+                with _InFlight(("request",)), _Timer(REQUEST_SECONDS, (name,)):
+                    return await view(request, *args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not enabled():
+                return view(request, *args, **kwargs)
+            with _InFlight(("request",)), _Timer(REQUEST_SECONDS, (name,)):
+                return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,73 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:18
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CarePlan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phenotype_id', models.CharField(max_length=50)),
+                ('region', models.CharField(max_length=100)),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('markdown', models.TextField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['phenotype_id', 'region'], name='careplan_phenotype_region'), models.Index(fields=['created_at'], name='careplan_created')],
+            },
+        ),
+        migrations.CreateModel(
+            name='PatientSubmission',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patient_name', models.CharField(blank=True, max_length=100)),
+                ('region', models.CharField(max_length=100)),
+                ('input_hash', models.CharField(max_length=64)),
+                ('cycle_length_days', models.IntegerField()),
+                ('cycles_per_year', models.IntegerField()),
+                ('total_testosterone', models.FloatField()),
+                ('shbg', models.FloatField()),
+                ('fasting_insulin', models.FloatField()),
+                ('fasting_glucose', models.FloatField()),
+                ('tsh', models.FloatField()),
+                ('prolactin', models.FloatField()),
+                ('crp', models.FloatField()),
+                ('follicle_count_left', models.IntegerField()),
+                ('follicle_count_right', models.IntegerField()),
+                ('ovarian_volume_left', models.FloatField()),
+                ('ovarian_volume_right', models.FloatField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['input_hash'], name='submission_input_hash'), models.Index(fields=['created_at', 'id'], name='submission_created')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DiagnosisResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('review_needed', 'Review Needed'), ('diagnosed', 'PCOS'), ('not_pcos', 'Not PCOS')], max_length=20)),
+                ('phenotype', models.CharField(blank=True, max_length=100)),
+                ('lifestyle_protocol', models.CharField(blank=True, max_length=200)),
+                ('criteria_met', models.JSONField(default=list)),
+                ('alerts', models.JSONField(default=list)),
+                ('region', models.CharField(max_length=100)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('submission', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='diagnosis', to='Clinical_Daignose.patientsubmission')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at', 'id'], name='diagnosis_created'), models.Index(fields=['phenotype', 'created_at', 'id'], name='diagnosis_phenotype'), models.Index(fields=['region', 'created_at', 'id'], name='diagnosis_region')],
+            },
+        ),
+    ]
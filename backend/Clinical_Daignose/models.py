@@ -1,3 +1,83 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class PatientSubmission(models.Model):
+    """The 13 diagnostic inputs of one submitted lab panel."""
+
+    patient_name = models.CharField(max_length=100, blank=True)
+    region = models.CharField(max_length=100)
+    # Hash of the normalised inputs + region, for finding repeat submissions
+    input_hash = models.CharField(max_length=64)
+
+    # ---- History ----
+    cycle_length_days = models.IntegerField()
+    cycles_per_year = models.IntegerField()
+
+    # ---- Blood ----
+    total_testosterone = models.FloatField()
+    shbg = models.FloatField()
+    fasting_insulin = models.FloatField()
+    fasting_glucose = models.FloatField()
+    tsh = models.FloatField()
+    prolactin = models.FloatField()
+    crp = models.FloatField()
+
+    # ---- Ultrasound ----
+    follicle_count_left = models.IntegerField()
+    follicle_count_right = models.IntegerField()
+    ovarian_volume_left = models.FloatField()
+    ovarian_volume_right = models.FloatField()
+
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["input_hash"], name="submission_input_hash"),
+            models.Index(fields=["created_at", "id"], name="submission_created"),
+        ]
+
+
+class DiagnosisResult(models.Model):
+    STATUS_REVIEW = "review_needed"
+    STATUS_DIAGNOSED = "diagnosed"
+    STATUS_NOT_PCOS = "not_pcos"
+    STATUS_CHOICES = [
+        (STATUS_REVIEW, "Review Needed"),
+        (STATUS_DIAGNOSED, "PCOS"),
+        (STATUS_NOT_PCOS, "Not PCOS"),
+    ]
+
+    submission = models.OneToOneField(PatientSubmission, on_delete=models.CASCADE, related_name="diagnosis")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES)
+    phenotype = models.CharField(max_length=100, blank=True)
+    lifestyle_protocol = models.CharField(max_length=200, blank=True)
+    criteria_met = models.JSONField(default=list)
+    alerts = models.JSONField(default=list)
+    # Copied from the submission so cohort queries don't need a join
+    region = models.CharField(max_length=100)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        # Every index ends in (created_at, id) to serve the keyset-paginated listing
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="diagnosis_created"),
+            models.Index(fields=["phenotype", "created_at", "id"], name="diagnosis_phenotype"),
+            models.Index(fields=["region", "created_at", "id"], name="diagnosis_region"),
+        ]
+
+
+class CarePlan(models.Model):
+    """A distinct generated care plan (shared by every patient it was served to)."""
+
+    phenotype_id = models.CharField(max_length=50)
+    region = models.CharField(max_length=100)
+    content_hash = models.CharField(max_length=64, unique=True)
+    markdown = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["phenotype_id", "region"], name="careplan_phenotype_region"),
+            models.Index(fields=["created_at"], name="careplan_created"),
+        ]
@@ -0,0 +1,163 @@
+"""
+Content-addressed cache for generated care plans.
+
+Plans are keyed on a hash of the rendered prompt (with the patient's name
+replaced by a placeholder), so every patient with the same phenotype, region
+and rule set shares one generated plan. Backends are chosen with the
+PCOS_PLAN_CACHE_BACKEND environment variable:
+
+    memory  - per-process LRU (default)
+    django  - Django's cache framework (PCOS_PLAN_CACHE_ALIAS, default "default")
+    sqlite  - shared SQLite file (PCOS_PLAN_CACHE_PATH)
+    none    - disabled
+
+PCOS_PLAN_CACHE_TTL (seconds) and PCOS_PLAN_CACHE_MAX_ENTRIES bound every backend.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 1024
+
+
+def make_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class MemoryPlanCache:
+    """Thread-safe in-process LRU with per-entry expiry."""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoPlanCache:
+    """Delegates to a Django cache alias; eviction is left to that backend."""
+
+    def __init__(self, alias="default", ttl=DEFAULT_TTL):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def _cache(self):
+        from django.core.cache import caches
+
+        return caches[self.alias]
+
+    def get(self, key):
+        return self._cache.get(f"pcos_plan:{key}")
+
+    def set(self, key, value):
+        self._cache.set(f"pcos_plan:{key}", value, timeout=self.ttl)
+
+
+class SQLitePlanCache:
+    """
+    File-backed cache shared by every worker on the host. Each thread keeps
+    its own connection; least recently used rows are evicted past max_entries.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS plan_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS plan_cache_accessed ON plan_cache (accessed_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            row = conn.execute("SELECT value, expires_at FROM plan_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                conn.execute("DELETE FROM plan_cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE plan_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO plan_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now),
+            )
+            conn.execute(
+                "DELETE FROM plan_cache WHERE key IN ("
+                " SELECT key FROM plan_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM plan_cache")
+
+
+def build_plan_cache(backend=None):
+    """Creates the cache backend selected by the PCOS_PLAN_CACHE_* environment variables."""
+    backend = (backend or os.getenv("PCOS_PLAN_CACHE_BACKEND", "memory")).lower()
+    ttl = float(os.getenv("PCOS_PLAN_CACHE_TTL", DEFAULT_TTL))
+    max_entries = int(os.getenv("PCOS_PLAN_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+
+    if backend == "none":
+        return None
+    if backend == "memory":
+        return MemoryPlanCache(ttl=ttl, max_entries=max_entries)
+    if backend == "django":
+        return DjangoPlanCache(alias=os.getenv("PCOS_PLAN_CACHE_ALIAS", "default"), ttl=ttl)
+    if backend == "sqlite":
+        default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan_cache.sqlite3")
+        return SQLitePlanCache(os.getenv("PCOS_PLAN_CACHE_PATH", default_path), ttl=ttl, max_entries=max_entries)
+    raise ValueError(f"Unknown PCOS_PLAN_CACHE_BACKEND: {backend}")
@@ -0,0 +1,186 @@
+"""
+Indexed, hot-reloading store for pcos_protocols.json.
+
+The file is validated once per change and compiled into ProtocolRule objects
+indexed by (phenotype_id, region, language), with the prompt fragments that
+never change between requests (joined supplement stack, avoid list, ...)
+rendered up front. Lookups are dict hits against an immutable snapshot.
+When the file's mtime changes, a background thread builds a new snapshot
+and swaps it in; requests keep using the old one until then, and an invalid
+file never replaces a valid snapshot.
+
+Entries may carry optional "region" and/or "language" keys to define
+variants of a phenotype protocol; lookups fall back to the generic entry.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RELOAD_CHECK_INTERVAL = 2.0
+
+# field -> expected type, for the optional top-level fields of an entry
+OPTIONAL_FIELDS = {
+    "clinical_goal": str,
+    "dietary_focus": str,
+    "lifestyle_avoids": list,
+    "supplement_rules": dict,
+    "exercise_rules": dict,
+    "region": str,
+    "language": str,
+}
+
+
+class ProtocolSchemaError(ValueError):
+    pass
+
+
+def variant_key(value):
+    """Normalises a region/language for indexing; None means 'any'."""
+    return value.strip().lower() if value else None
+
+
+class ProtocolRule:
+    """One compiled protocol entry with its static prompt fragments pre-rendered."""
+
+    __slots__ = (
+        "phenotype_id", "name", "region", "language", "clinical_goal", "dietary_focus",
+        "supplements", "supplement_benefit", "avoids", "exercise_focus", "raw",
+    )
+
+    def __init__(self, raw):
+        supps = raw.get("supplement_rules", {})
+        self.raw = raw
+        self.phenotype_id = raw["phenotype_id"]
+        self.name = raw["name"]
+        self.region = variant_key(raw.get("region"))
+        self.language = variant_key(raw.get("language"))
+        self.clinical_goal = raw.get("clinical_goal", "Health Improvement")
+        self.dietary_focus = raw.get("dietary_focus", "Balanced Diet")
+        self.supplements = ", ".join(supps.get("core_stack", []))
+        self.supplement_benefit = supps.get("specific_benefit", "General Health")
+        self.avoids = ", ".join(raw.get("lifestyle_avoids", []))
+        self.exercise_focus = raw.get("exercise_rules", {}).get("focus", "")
+
+
+def validate_protocols(data):
+    """Returns the list of schema problems in a parsed protocols file (empty if valid)."""
+    if not isinstance(data, list):
+        return ["top level must be a list of protocol entries"]
+
+    errors = []
+    for i, entry in enumerate(data):
+        where = f"entry {i}"
+        if not isinstance(entry, dict):
+            errors.append(f"{where}: must be an object")
+            continue
+        for field in ("phenotype_id", "name"):
+            if not isinstance(entry.get(field), str) or not entry.get(field):
+                errors.append(f"{where}: '{field}' must be a non-empty string")
+        for field, expected in OPTIONAL_FIELDS.items():
+            if field in entry and not isinstance(entry[field], expected):
+                errors.append(f"{where}: '{field}' must be a {expected.__name__}")
+        if isinstance(entry.get("lifestyle_avoids"), list) and not all(isinstance(v, str) for v in entry["lifestyle_avoids"]):
+            errors.append(f"{where}: 'lifestyle_avoids' must contain only strings")
+        supps = entry.get("supplement_rules")
+        if isinstance(supps, dict):
+            stack = supps.get("core_stack", [])
+            if not isinstance(stack, list) or not all(isinstance(v, str) for v in stack):
+                errors.append(f"{where}: 'supplement_rules.core_stack' must be a list of strings")
+            if not isinstance(supps.get("specific_benefit", ""), str):
+                errors.append(f"{where}: 'supplement_rules.specific_benefit' must be a string")
+    return errors
+
+
+class ProtocolSnapshot:
+    """Immutable, indexed view of one version of the protocols file."""
+
+    def __init__(self, data=(), version="", mtime=None):
+        self.rules = list(data)
+        self.version = version
+        self.mtime = mtime
+        self.index = {}
+        for raw in self.rules:
+            rule = ProtocolRule(raw)
+            key = (rule.phenotype_id, rule.region, rule.language)
+            if key in self.index:
+                raise ProtocolSchemaError(f"duplicate protocol variant {key}")
+            self.index[key] = rule
+
+    @classmethod
+    def load(cls, path):
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, "rb") as f:
+            content = f.read()
+        data = json.loads(content)
+        errors = validate_protocols(data)
+        if errors:
+            raise ProtocolSchemaError(f"{path}: " + "; ".join(errors))
+        return cls(data, version=hashlib.sha256(content).hexdigest()[:16], mtime=mtime)
+
+    def get(self, phenotype_id, region=None, language=None):
+        region, language = variant_key(region), variant_key(language)
+        index = self.index
+        return (
+            index.get((phenotype_id, region, language))
+            or index.get((phenotype_id, region, None))
+            or index.get((phenotype_id, None, language))
+            or index.get((phenotype_id, None, None))
+        )
+
+
+class ProtocolStore:
+    def __init__(self, path, check_interval=RELOAD_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._next_check = time.monotonic() + check_interval
+        self._reloading = threading.Lock()
+        self._failed_mtime = None
+        try:
+            self.snapshot = ProtocolSnapshot.load(path)
+        except FileNotFoundError:
+            logger.error("Protocol file not found: %s", path)
+            self.snapshot = ProtocolSnapshot()
+
+    @property
+    def rules(self):
+        return self.snapshot.rules
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    def get(self, phenotype_id, region=None, language=None):
+        self._maybe_reload()
+        return self.snapshot.get(phenotype_id, region, language)
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime in (self.snapshot.mtime, self._failed_mtime):
+            return
+        if self._reloading.acquire(blocking=False):
+            threading.Thread(target=self._reload, name="protocol-reload", daemon=True).start()
+
+    def _reload(self):
+        mtime = None
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            self.snapshot = ProtocolSnapshot.load(self.path)
+            logger.info("Reloaded protocols from %s (version %s)", self.path, self.snapshot.version)
+        except (OSError, ValueError) as e:
+            logger.error("Keeping previous protocols; reload failed: %s", e)
+            # Don't retry the same broken file on every check.
+            self._failed_mtime = mtime
+        finally:
+            self._reloading.release()
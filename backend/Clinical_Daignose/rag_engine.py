@@ -1,117 +1,611 @@
 import os
-import json
-import google.generativeai as genai
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
-from dotenv import load_dotenv
+from django.dispatch import Signal
 
-# --- DEBUGGING: FIND THE KEY ---
+from .metrics import in_flight, record_cache, record_llm_call, record_llm_error, timed
+from .plan_cache import build_plan_cache, make_key
+from .protocols import ProtocolStore
+from .regions import canonical_region
+from .resilience import CircuitBreaker, CircuitOpenError, call_with_deadline, call_with_deadline_async
+
+# Importing this module has no side effects: the .env file is read and the
+# google.generativeai SDK (slow to import) is loaded and configured the first
+# time a plan actually needs the model.
+
+logger = logging.getLogger(__name__)
 
 # Folder where THIS script is located
 base_path = os.path.dirname(os.path.abspath(__file__))
 env_path = os.path.join(base_path, ".env")
 
-print(f"🔍 Looking for .env file at: {env_path}")
+# Filled in by load_settings()
+api_key = None
+# Model REST endpoint; override to point at a proxy or a local fake server.
+LLM_ENDPOINT = None
+_settings_loaded = False
+
+_genai = None
+_genai_lock = threading.Lock()
+
+
+def load_settings():
+    """Loads the app's .env file and the model settings; later calls are no-ops."""
+    global api_key, LLM_ENDPOINT, _settings_loaded
+    if _settings_loaded:
+        return
+    if os.path.exists(env_path):
+        from dotenv import load_dotenv
+        load_dotenv(env_path)
+    if api_key is None:
+        api_key = os.getenv("GOOGLE_API_KEY")
+    if LLM_ENDPOINT is None:
+        LLM_ENDPOINT = os.getenv("PCOS_LLM_ENDPOINT", "https://generativelanguage.googleapis.com")
+    if not api_key:
+        logger.warning("GOOGLE_API_KEY is not set; care plans cannot be generated.")
+    _settings_loaded = True
+
+
+def configure_sdk(genai):
+    if api_key:
+        genai.configure(api_key=api_key, transport='rest', client_options={"api_endpoint": LLM_ENDPOINT})
+
+
+def get_genai():
+    """Imports and configures google.generativeai on first use."""
+    global _genai
+    if _genai is None:
+        with _genai_lock:
+            if _genai is None:
+                load_settings()
+                import google.generativeai as genai
+                configure_sdk(genai)
+                _genai = genai
+    return _genai
+
+
+# Max keep-alive connections to the model backend per worker process.
+HTTP_POOL_SIZE = int(os.getenv("PCOS_HTTP_POOL_SIZE", "32"))
+
+# Max concurrent connections for the async path, which is meant to keep
+# hundreds of generations in flight on a single event loop.
+ASYNC_HTTP_POOL_SIZE = int(os.getenv("PCOS_ASYNC_HTTP_POOL_SIZE", "512"))
+
+# Per-call deadline and hedging for model calls (see resilience.py).
+LLM_TIMEOUT = float(os.getenv("PCOS_LLM_TIMEOUT", "60"))
+LLM_HEDGE_AFTER = float(os.getenv("PCOS_LLM_HEDGE_AFTER", "0"))
+
+# Model calls fail fast once PCOS_LLM_BREAKER_ERROR_RATE of the last
+# PCOS_LLM_BREAKER_WINDOW calls failed, until PCOS_LLM_BREAKER_COOLDOWN
+# seconds have passed.
+LLM_BREAKER_ERROR_RATE = float(os.getenv("PCOS_LLM_BREAKER_ERROR_RATE", "0.5"))
+LLM_BREAKER_WINDOW = int(os.getenv("PCOS_LLM_BREAKER_WINDOW", "20"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("PCOS_LLM_BREAKER_COOLDOWN", "30"))
+
+# Max section model calls generate_plans() has in flight at once.
+BATCH_CONCURRENCY = int(os.getenv("PCOS_BATCH_CONCURRENCY", "8"))
+
+MODEL_NAME = 'gemini-flash-latest'
+
+# Bump when the prompt wording changes so cached plans are not reused.
+PROMPT_VERSION = 2
+
+# The plan is generated as independent sections, concurrently, and each is
+# cached under its own prompt. Only the food sections use the region, so the
+# rest are generated once per phenotype and shared by every city.
+PLAN_SECTIONS = (
+    ("diagnosis", "1. **DIAGNOSIS EXPLAINED**\n"
+                  "- Explain {rule.name} simply."),
+    ("red_list", '2. **THE "RED LIST" (AVOID)**\n'
+                 "- Identify 5 common {region} foods she must STRICTLY AVOID.\n"
+                 "- Explain WHY."),
+    ("green_list", '3. **THE "GREEN LIST" (EAT)**\n'
+                   "- Create a {region} Cuisine Meal Plan (Breakfast, Lunch, Dinner).\n"
+                   "- Focus: {rule.dietary_focus}."),
+    ("movement", "4. **MOVEMENT PLAN**\n"
+                 "- 7-Day Workout Schedule.\n"
+                 "- Explain why."),
+    ("supplements", "5. **SUPPLEMENT STACK**\n"
+                    "- Recommend: {rule.supplements}\n"
+                    "- Benefit: {rule.supplement_benefit}"),
+    ("warnings", "6. **LIFESTYLE WARNINGS**\n"
+                 "- Warn about: {rule.avoids}"),
+)
+
+SECTION_PROMPT = """
+ACT AS: A Senior PCOS Specialist.
+PATIENT: {patient}.
+DIAGNOSIS: {rule.name}
+
+TASK: Write one section of a Personalized Health Plan, starting with its
+heading as given below. Do not write any other section.
+
+{section}
 
-# Check if .env exists
-if os.path.exists(env_path):
-    print("✅ File found! Loading variables...")
-    load_dotenv(env_path)
-else:
-    print("❌ ERROR: .env file NOT found.")
-    print("📂 Files actually in this folder:")
-    for f in os.listdir(base_path):
-        print("   -", f)
+TONE: Empathetic, motivating.
+Refer to the patient only as {placeholder}.
+"""
 
-# Load API key
-api_key = os.getenv("GOOGLE_API_KEY")
-print("🔑 API Key Loaded:", "YES" if api_key else "NO")
+SECTION_SEPARATOR = "\n\n"
 
+# Section model calls in flight at once across all plans; sized like the
+# model's connection pool.
+SECTION_CONCURRENCY = int(os.getenv("PCOS_SECTION_CONCURRENCY", str(HTTP_POOL_SIZE)))
 
+# Stands in for the patient's name in the prompt, so the generated plan can
+# be cached and shared between patients and the name filled in afterwards.
+PATIENT_PLACEHOLDER = "[[PATIENT_NAME]]"
 
-# api_key = "PASTE_YOUR_KEY_HERE_DIRECTLY"
+LLM_ERROR_PREFIXES = ("Error:", "AI Error:")
+
+# Sent with phenotype_id, region and plan (still holding PATIENT_PLACEHOLDER)
+# whenever a plan is assembled with at least one newly generated section;
+# plans served wholly from the cache do not send it.
+plan_generated = Signal()
+
+
+def request_options(timeout):
+    # No SDK-level retries: they would outlive the deadline and hide
+    # failures from the circuit breaker.
+    return {"timeout": timeout, "retry": None}
+
+
+_section_executor = None
+_section_executor_lock = threading.Lock()
+
+
+def _get_section_executor():
+    global _section_executor
+    if _section_executor is None:
+        with _section_executor_lock:
+            if _section_executor is None:
+                _section_executor = ThreadPoolExecutor(max_workers=SECTION_CONCURRENCY, thread_name_prefix="plan-section")
+    return _section_executor
 
-if api_key:
-    genai.configure(api_key=api_key, transport='rest')
 
 class PCOSRecommendationEngine:
-    def __init__(self, json_filename="F:\project\PCOS\PCOS_Intelligence\Clinical_Daignose\pcos_protocols.json"):
+    def __init__(self, json_filename="pcos_protocols.json"):
         self.json_path = os.path.join(base_path, json_filename)
-        self.rules = self._load_rules()
-        self.model = genai.GenerativeModel('gemini-flash-latest') 
+        load_settings()
+        self.protocols = ProtocolStore(self.json_path)
+        self.plan_cache = build_plan_cache()
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._async_clients = weakref.WeakKeyDictionary()
+        self.breaker = CircuitBreaker(
+            error_rate=LLM_BREAKER_ERROR_RATE,
+            window=LLM_BREAKER_WINDOW,
+            min_calls=max(LLM_BREAKER_WINDOW // 2, 1),
+            cooldown=LLM_BREAKER_COOLDOWN,
+        )
 
-    def _load_rules(self):
-        try:
-            with open(self.json_path, 'r') as f:
-                #print(f"✅ Rules loaded from: {json_filename}")
-                return json.load(f)
-        except FileNotFoundError:
-            print(f"❌ ERROR: JSON not found at: {self.json_path}")
-            return []
-
-    def get_phenotype_rules(self, phenotype_id):
-        for rule in self.rules:
-            if rule["phenotype_id"] == phenotype_id:
-                return rule
-        return None
+    @property
+    def model(self):
+        """The GenerativeModel, built on first use so cached plans never load the SDK."""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    model = get_genai().GenerativeModel(MODEL_NAME)
+                    if api_key:
+                        self._attach_pooled_client(model)
+                    self._model = model
+        return self._model
+
+    def _attach_pooled_client(self, model):
+        """
+        Builds the REST client up front and widens its connection pool, so
+        concurrent requests reuse keep-alive connections instead of the
+        requests default of 10 (extra connections are dropped after use).
+        """
+        from google.generativeai import client as genai_client
+        from requests.adapters import HTTPAdapter
+
+        client = genai_client.get_default_generative_client()
+        session = getattr(getattr(client, "_transport", None), "_session", None)
+        if session is not None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        model._client = client
+
+    @property
+    def rules(self):
+        """The raw protocol entries of the current protocols snapshot."""
+        return self.protocols.rules
+
+    def get_phenotype_rules(self, phenotype_id, region=None, language=None):
+        """Compiled ProtocolRule for the phenotype (region/language variant if one exists)."""
+        return self.protocols.get(phenotype_id, region, language)
+
+    def _check_circuit(self):
+        if not self.breaker.allow():
+            raise CircuitOpenError("model calls suspended after repeated failures")
+
+    def _call_failed(self, error, mode):
+        """Records a failed model call and returns the error text handed back to callers."""
+        if isinstance(error, CircuitOpenError):
+            kind = "circuit_open"
+        else:
+            self.breaker.record(False)
+            kind = "timeout" if isinstance(error, TimeoutError) or "timeout" in type(error).__name__.lower() else "exception"
+        record_llm_error(kind)
+        logger.warning("Model call failed: %s", error, extra={"fields": {"mode": mode, "kind": kind}})
+        return f"AI Error: {str(error)}"
 
     def _call_gemini(self, prompt):
-        print("   --> AI is generating report... (Please wait)")
+        logger.debug("Requesting care plan from the model", extra={"fields": {"mode": "sync"}})
+        try:
+            if not api_key:
+                record_llm_error("missing_key")
+                return "Error: API Key is missing."
+            self._check_circuit()
+            record_llm_call("sync")
+            with timed("llm"), in_flight("llm"):
+                text = call_with_deadline(
+                    lambda timeout: self.model.generate_content(prompt, request_options=request_options(timeout)).text,
+                    LLM_TIMEOUT,
+                    LLM_HEDGE_AFTER
+                )
+            self.breaker.record(True)
+            return text
+        except Exception as e:
+            return self._call_failed(e, "sync")
+
+    def _call_gemini_stream(self, prompt):
+        """Yields the response text chunk by chunk; on failure yields one error string and stops."""
+        logger.debug("Requesting care plan from the model", extra={"fields": {"mode": "stream"}})
+        if not api_key:
+            record_llm_error("missing_key")
+            yield "Error: API Key is missing."
+            return
+        settled = False
         try:
-            if not api_key: return "Error: API Key is missing."
-            response = self.model.generate_content(prompt)
-            return response.text
+            self._check_circuit()
+            record_llm_call("stream")
+            with timed("llm"), in_flight("llm"):
+                for chunk in self.model.generate_content(prompt, stream=True, request_options=request_options(LLM_TIMEOUT)):
+                    if not settled:
+                        # The model is answering; the client may stop reading at any point
+                        self.breaker.record(True)
+                        settled = True
+                    if chunk.parts:
+                        yield chunk.text
         except Exception as e:
-            return f"AI Error: {str(e)}"
+            settled = True
+            yield self._call_failed(e, "stream")
+        finally:
+            if not settled:
+                # Closed or interrupted before the first chunk: free a half-open probe
+                self.breaker.release()
+
+    def _get_async_client(self):
+        """One pooled httpx.AsyncClient per event loop (clients cannot cross loops)."""
+        import asyncio
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                base_url=LLM_ENDPOINT,
+                headers={"x-goog-api-key": api_key},
+                limits=httpx.Limits(max_connections=ASYNC_HTTP_POOL_SIZE, max_keepalive_connections=ASYNC_HTTP_POOL_SIZE),
+                timeout=httpx.Timeout(None, connect=10.0),
+            )
+            self._async_clients[loop] = client
+        return client
+
+    async def aclose(self):
+        """
+        Closes the running event loop's HTTP client. Await it before a loop
+        the caller created (asyncio.run, a test) finishes.
+        """
+        import asyncio
+
+        client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    async def _generate_async(self, prompt, timeout):
+        response = await self._get_async_client().post(
+            f"/v1beta/models/{MODEL_NAME}:generateContent",
+            json={"contents": [{"role": "user", "parts": [{"text": prompt}]}]},
+            timeout=timeout,
+        )
+        response.raise_for_status()
+        candidate = response.json()["candidates"][0]
+        return "".join(part.get("text", "") for part in candidate["content"]["parts"])
+
+    async def _call_gemini_async(self, prompt):
+        """Non-blocking equivalent of _call_gemini, calling the REST API directly."""
+        settled = False
+        try:
+            if not api_key:
+                record_llm_error("missing_key")
+                return "Error: API Key is missing."
+            self._check_circuit()
+            record_llm_call("async")
+            with timed("llm"), in_flight("llm"):
+                text = await call_with_deadline_async(
+                    lambda timeout: self._generate_async(prompt, timeout),
+                    LLM_TIMEOUT,
+                    LLM_HEDGE_AFTER
+                )
+            self.breaker.record(True)
+            settled = True
+            return text
+        except Exception as e:
+            settled = True
+            return self._call_failed(e, "async")
+        finally:
+            if not settled:
+                # Cancelled (CancelledError is a BaseException): free a half-open probe
+                self.breaker.release()
+
+    def _prepare_sections(self, phenotype_id, region):
+        """
+        Returns [(prompt, cache_key, cached_text)] for each of PLAN_SECTIONS,
+        or raises LookupError for unknown phenotypes.
+        """
+        rule = self.get_phenotype_rules(phenotype_id, region)
+        if not rule:
+            raise LookupError(f"Error: Phenotype ID '{phenotype_id}' not found.")
+
+        with timed("prompt"):
+            prompts = self.build_section_prompts(rule, region)
+            keys = [make_key(PROMPT_VERSION, MODEL_NAME, prompt) for prompt in prompts]
+        if not self.plan_cache:
+            return [(prompt, key, None) for prompt, key in zip(prompts, keys)]
+        parts = []
+        for prompt, key in zip(prompts, keys):
+            text = self.plan_cache.get(key)
+            record_cache("plan", text is not None)
+            parts.append((prompt, key, text))
+        return parts
+
+    def _cache_section(self, key, text):
+        if self.plan_cache and not text.startswith(LLM_ERROR_PREFIXES):
+            self.plan_cache.set(key, text)
+
+    def _generate_section(self, prompt, key):
+        text = self._call_gemini(prompt)
+        self._cache_section(key, text)
+        return text
+
+    async def _generate_section_async(self, prompt, key):
+        from asgiref.sync import sync_to_async
+
+        text = await self._call_gemini_async(prompt)
+        # Cache backends may block (SQLite) or be sync-only (Django's database cache)
+        await sync_to_async(self._cache_section)(key, text)
+        return text
+
+    def _generate_sections(self, parts, indexes):
+        """
+        {index: text} for the sections of 'parts' at 'indexes', generated
+        concurrently (the first on this thread) and cached as they complete.
+        """
+        if not indexes:
+            return {}
+        executor = _get_section_executor()
+        futures = {index: executor.submit(self._generate_section, *parts[index][:2]) for index in indexes[1:]}
+        texts = {indexes[0]: self._generate_section(*parts[indexes[0]][:2])}
+        for index, future in futures.items():
+            texts[index] = future.result()
+        return texts
+
+    def _assemble(self, parts, generated, phenotype_id, region):
+        """
+        The plan from the cached sections in 'parts' and the 'generated'
+        ones ({index: text}), or the first error among them.
+        """
+        texts = [generated.get(index, text) for index, (_, _, text) in enumerate(parts)]
+        for text in texts:
+            if text.startswith(LLM_ERROR_PREFIXES):
+                return text
+        plan = SECTION_SEPARATOR.join(texts)
+        if generated:
+            plan_generated.send(sender=type(self), phenotype_id=phenotype_id, region=region, plan=plan)
+        return plan
+
+    def _shared_plan(self, phenotype_id, region):
+        """The plan for the phenotype and region with PATIENT_PLACEHOLDER still in it."""
+        region = canonical_region(region)
+        try:
+            parts = self._prepare_sections(phenotype_id, region)
+        except LookupError as e:
+            return str(e)
+
+        missing = [index for index, (_, _, text) in enumerate(parts) if text is None]
+        return self._assemble(parts, self._generate_sections(parts, missing), phenotype_id, region)
 
     def generate_comprehensive_plan(self, phenotype_id, region="India", user_name="User"):
-            
-            rule_set = self.get_phenotype_rules(phenotype_id)
-            if not rule_set: 
-                return f"Error: Phenotype ID '{phenotype_id}' not found."
-
-            # Load Rules safely using .get(...) with parentheses
-            goal = rule_set.get('clinical_goal', 'Health Improvement')
-            focus = rule_set.get('dietary_focus', 'Balanced Diet')
-            avoids = rule_set.get('lifestyle_avoids', [])
-            
-            # --- THIS WAS THE ERROR LINE ---
-            supps = rule_set.get('supplement_rules', {}) 
-            # -------------------------------
-
-            prompt = f"""
-            ACT AS: A Senior PCOS Specialist.
-            PATIENT: {user_name} ({region}).
-            DIAGNOSIS: {rule_set['name']}
-            
-            TASK: Write a Personalized Health Plan.
-            
-            1. **DIAGNOSIS EXPLAINED**
-            - Explain {rule_set['name']} simply.
-
-            2. **THE "RED LIST" (AVOID)**
-            - Identify 5 common {region} foods she must STRICTLY AVOID.
-            - Explain WHY.
-
-            3. **THE "GREEN LIST" (EAT)**
-            - Create a {region} Cuisine Meal Plan (Breakfast, Lunch, Dinner).
-            - Focus: {focus}.
-
-            4. **MOVEMENT PLAN**
-            - 7-Day Workout Schedule.
-            - Explain why.
-
-            5. **SUPPLEMENT STACK**
-            - Recommend: {', '.join(supps.get('core_stack', []))}
-            - Benefit: {supps.get('specific_benefit', 'General Health')}
-
-            6. **LIFESTYLE WARNINGS**
-            - Warn about: {', '.join(avoids)}
-
-            TONE: Empathetic, motivating.
-            """
-            
-            return self._call_gemini(prompt)
+        return self._shared_plan(phenotype_id, region).replace(PATIENT_PLACEHOLDER, user_name)
+
+    def generate_plans(self, requests, max_concurrency=BATCH_CONCURRENCY):
+        """
+        Plans for many patients at once. 'requests' is an iterable of
+        (phenotype_id, region, user_name). Patients sharing a phenotype,
+        canonical region and protocols version get one plan, and each section is
+        generated once for the whole batch (so the region-free sections
+        are shared across regions), with at most 'max_concurrency' model
+        calls in flight. Each copy is personalised with the patient's name.
+
+        Returns (plans, stats): plans in request order, and a dict with
+        the number of patients, distinct plans, model calls made and
+        elapsed seconds.
+        """
+        started = time.perf_counter()
+        version = self.protocols.version
+        requests = [(phenotype_id, canonical_region(region), user_name) for phenotype_id, region, user_name in requests]
+        groups = {}
+        for phenotype_id, region, _ in requests:
+            groups.setdefault((phenotype_id, region, version), None)
+
+        # Cache key -> prompt of every section not cached yet
+        prompts = {}
+        for group in groups:
+            try:
+                groups[group] = self._prepare_sections(*group[:2])
+            except LookupError as e:
+                groups[group] = str(e)
+                continue
+            for prompt, key, text in groups[group]:
+                if text is None:
+                    prompts.setdefault(key, prompt)
+
+        workers = max(min(max_concurrency, len(prompts)), 1)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="plan-batch") as pool:
+            generated = dict(zip(prompts, pool.map(self._generate_section, prompts.values(), prompts)))
+
+        for group, parts in groups.items():
+            if isinstance(parts, list):
+                texts = {index: generated[key] for index, (_, key, text) in enumerate(parts) if text is None}
+                groups[group] = self._assemble(parts, texts, *group[:2])
+
+        plans = [
+            groups[(phenotype_id, region, version)].replace(PATIENT_PLACEHOLDER, user_name)
+            for phenotype_id, region, user_name in requests
+        ]
+        stats = {
+            "patients": len(requests),
+            "distinct_plans": len(groups),
+            "model_calls": len(prompts),
+            "seconds": time.perf_counter() - started,
+        }
+        logger.info("Batch plans generated", extra={"fields": stats})
+        return plans, stats
+
+    def stream_comprehensive_plan(self, phenotype_id, region="India", user_name="User"):
+        """
+        Yields the plan markdown as it is generated. A cached plan is
+        yielded in one piece. Otherwise the first missing section streams
+        from the model while the others are generated alongside it, and
+        each later section is yielded, in order, once it is ready; a
+        failed section ends the stream with its error.
+        """
+        region = canonical_region(region)
+        try:
+            parts = self._prepare_sections(phenotype_id, region)
+        except LookupError as e:
+            yield str(e)
+            return
+
+        missing = [index for index, (_, _, text) in enumerate(parts) if text is None]
+        if not missing:
+            yield self._assemble(parts, {}, phenotype_id, region).replace(PATIENT_PLACEHOLDER, user_name)
+            return
+
+        executor = _get_section_executor()
+        futures = {index: executor.submit(self._generate_section, *parts[index][:2]) for index in missing[1:]}
+        generated = {}
+
+        def generate():
+            for index, (prompt, key, text) in enumerate(parts):
+                if index:
+                    yield SECTION_SEPARATOR
+                if index == missing[0]:
+                    chunks = []
+                    for chunk in self._call_gemini_stream(prompt):
+                        chunks.append(chunk)
+                        yield chunk
+                    text = "".join(chunks)
+                    if chunks and chunks[-1].startswith(LLM_ERROR_PREFIXES):
+                        return
+                    self._cache_section(key, text)
+                    generated[index] = text
+                elif text is None:
+                    text = generated[index] = futures[index].result()
+                    yield text
+                    if text.startswith(LLM_ERROR_PREFIXES):
+                        return
+                else:
+                    yield text
+
+        try:
+            yield from personalise_stream(generate(), user_name)
+        finally:
+            for future in futures.values():
+                future.cancel()
+        if len(generated) == len(missing):
+            self._assemble(parts, generated, phenotype_id, region)
+
+    async def generate_comprehensive_plan_async(self, phenotype_id, region="India", user_name="User"):
+        import asyncio
+
+        from asgiref.sync import sync_to_async
+
+        region = canonical_region(region)
+        try:
+            parts = await sync_to_async(self._prepare_sections)(phenotype_id, region)
+        except LookupError as e:
+            return str(e)
+
+        missing = [index for index, (_, _, text) in enumerate(parts) if text is None]
+        texts = await asyncio.gather(*(self._generate_section_async(*parts[index][:2]) for index in missing))
+        plan = self._assemble(parts, dict(zip(missing, texts)), phenotype_id, region)
+        return plan.replace(PATIENT_PLACEHOLDER, user_name)
+
+    def build_section_prompts(self, rule, region):
+        """
+        Renders one prompt per PLAN_SECTIONS entry, with PATIENT_PLACEHOLDER
+        in place of the name, for a region from canonical_region(). Only
+        the sections that use the region mention it.
+        """
+        prompts = []
+        for _, instructions in PLAN_SECTIONS:
+            patient = f"{PATIENT_PLACEHOLDER} ({region})" if "{region}" in instructions else PATIENT_PLACEHOLDER
+            prompts.append(SECTION_PROMPT.format(
+                patient=patient,
+                rule=rule,
+                section=instructions.format(rule=rule, region=region),
+                placeholder=PATIENT_PLACEHOLDER,
+            ))
+        return prompts
+
+
+def personalise_stream(chunks, user_name):
+    """
+    Replaces PATIENT_PLACEHOLDER in a stream of text chunks, holding back any
+    trailing text that could be the start of a placeholder split across chunks.
+    """
+    pending = ""
+    for chunk in chunks:
+        pending = (pending + chunk).replace(PATIENT_PLACEHOLDER, user_name)
+        hold = 0
+        for size in range(len(PATIENT_PLACEHOLDER) - 1, 0, -1):
+            if pending.endswith(PATIENT_PLACEHOLDER[:size]):
+                hold = size
+                break
+        if len(pending) > hold:
+            yield pending[:len(pending) - hold]
+            pending = pending[len(pending) - hold:]
+    if pending:
+        yield pending
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_recommendation_engine():
+    """
+    Returns the process-wide PCOSRecommendationEngine, creating it on first use.
+    The engine only holds read-only rules and the model client, so one instance
+    is shared by every request thread in the worker.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = PCOSRecommendationEngine()
+    return _engine
+
 
 if __name__ == "__main__":
-    engine = PCOSRecommendationEngine()
+    engine = get_recommendation_engine()
     print(engine.generate_comprehensive_plan("insulin_resistant", "Pune, Maharashtra", "Prachi"))
\ No newline at end of file
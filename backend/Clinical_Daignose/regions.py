@@ -0,0 +1,217 @@
+"""
+Canonical plan regions for the free-text "City / Region" input.
+
+The region only matters to a care plan through its food sections, so
+"Pune", "pune ", "Pune, Maharashtra", "PUNE", "Poona" and "Mumbai" should
+all get the same plan. regions.json (PCOS_REGIONS_PATH) is a small offline
+gazetteer that groups places into cuisine regions (an Indian state, the
+Northeast, or a country), each with the label used in the prompt.
+
+A region is resolved by normalising it (case, accents, punctuation and
+spacing) and looking it up, in order:
+
+  exact    every comma-separated part, as a whole, in a dict of every
+           place, region and alias name
+  partial  runs of words inside a part ("Kothrud Pune", "Pune India"),
+           longest first, for names of at least MIN_PARTIAL_CHARS
+  fuzzy    each part against a character trie of the same names, within
+           1 edit for names of 5-7 characters and 2 from 8 on
+           ("Banglore"); a tie between different regions is no match
+
+A match on a national region ("India") only wins when no part names
+something more specific. Text that matches nothing keeps its own words,
+tidied, so case and spacing variants still share one plan.
+canonical_region() reads at most MAX_REGION_CHARS (the size of the region
+form field and columns) and memoizes the most recent CACHE_SIZE inputs.
+Partial matches only try runs as long as the longest gazetteer name, and
+fuzzy matching skips parts too long to be within reach of any name, so
+lookups stay cheap whatever the input.
+"""
+import json
+import os
+import re
+import string
+import threading
+import unicodedata
+from functools import lru_cache
+
+REGIONS_PATH = os.getenv(
+    "PCOS_REGIONS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "regions.json")
+)
+CACHE_SIZE = 4096
+MAX_REGION_CHARS = 100
+
+MIN_PARTIAL_CHARS = 4
+MIN_FUZZY_CHARS = 5
+
+EXACT = "exact"
+PARTIAL = "partial"
+FUZZY = "fuzzy"
+
+_NOT_WORD = re.compile(r"[\W_]+")
+_PART_SEPARATORS = re.compile(r"[,;/|()]+")
+
+
+class RegionGazetteerError(ValueError):
+    pass
+
+
+def normalise(text):
+    """Lowercase words without accents or punctuation, single-spaced."""
+    text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return " ".join(_NOT_WORD.sub(" ", text.casefold()).split())
+
+
+def max_edits(name):
+    if len(name) < MIN_FUZZY_CHARS:
+        return 0
+    return 1 if len(name) < 8 else 2
+
+
+class Region:
+    __slots__ = ("key", "label", "national", "place", "match")
+
+    def __init__(self, key, label, national, place, match):
+        self.key = key
+        self.label = label
+        self.national = national
+        self.place = place
+        self.match = match
+
+    def __repr__(self):
+        return f"Region({self.key!r}, place={self.place!r}, match={self.match!r})"
+
+
+class RegionTrie:
+    """Character trie over normalised names with bounded edit-distance search."""
+
+    def __init__(self):
+        self._root = {}
+
+    def insert(self, name, value):
+        node = self._root
+        for char in name:
+            node = node.setdefault(char, {})
+        node[None] = value
+
+    def search(self, name, max_distance):
+        """[(distance, value)] for every name within 'max_distance' edits (Levenshtein) of 'name'."""
+        found = []
+        first_row = list(range(len(name) + 1))
+        stack = [(child, char, first_row) for char, child in self._root.items() if char is not None]
+        while stack:
+            node, char, above = stack.pop()
+            row = [above[0] + 1]
+            for i in range(1, len(name) + 1):
+                row.append(min(row[i - 1] + 1, above[i] + 1, above[i - 1] + (name[i - 1] != char)))
+            if row[-1] <= max_distance and None in node:
+                found.append((row[-1], node[None]))
+            if min(row) <= max_distance:
+                stack.extend((child, next_char, row) for next_char, child in node.items() if next_char is not None)
+        return found
+
+
+class RegionIndex:
+    def __init__(self, path=REGIONS_PATH):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        self.path = path
+        self.version = data.get("version")
+        self.labels = {}
+        # normalised name -> (region key, place name)
+        self._names = {}
+        self._trie = RegionTrie()
+        self._national = set()
+
+        for key, entry in data["regions"].items():
+            label = entry.get("label")
+            if not isinstance(label, str) or not label:
+                raise RegionGazetteerError(f"{path}: region '{key}' needs a label")
+            self.labels[key] = label
+            if entry.get("national"):
+                self._national.add(key)
+            self._add(label, key, label)
+            for alias in entry.get("aliases", []):
+                self._add(alias, key, label)
+            for place, aliases in entry.get("places", {}).items():
+                for name in [place, *aliases]:
+                    self._add(name, key, place)
+
+        for name, value in self._names.items():
+            self._trie.insert(name, value)
+        self._max_words = max(len(name.split()) for name in self._names)
+        self._max_chars = max(len(name) for name in self._names)
+        self.canonical = lru_cache(maxsize=CACHE_SIZE)(self._canonical)
+
+    def _add(self, name, key, place):
+        name = normalise(name)
+        existing = self._names.get(name)
+        if existing is not None and existing[0] != key:
+            raise RegionGazetteerError(f"{self.path}: '{name}' is listed under both '{existing[0]}' and '{key}'")
+        self._names.setdefault(name, (key, place))
+
+    def _region(self, value, match):
+        key, place = value
+        return Region(key, self.labels[key], key in self._national, place, match)
+
+    def _lookup(self, part):
+        """Region for one normalised part of the input, or None."""
+        value = self._names.get(part)
+        if value is not None:
+            return self._region(value, EXACT)
+
+        words = part.split()
+        for size in range(min(len(words) - 1, self._max_words), 0, -1):
+            for start in range(len(words) - size + 1):
+                name = " ".join(words[start:start + size])
+                if len(name) >= MIN_PARTIAL_CHARS and name in self._names:
+                    return self._region(self._names[name], PARTIAL)
+
+        distance = max_edits(part)
+        if distance and len(part) <= self._max_chars + distance:
+            found = self._trie.search(part, distance)
+            if found:
+                best = min(d for d, _ in found)
+                closest = {value for d, value in found if d == best}
+                if len({key for key, _ in closest}) == 1:
+                    return self._region(min(closest), FUZZY)
+        return None
+
+    def resolve(self, text):
+        """The Region that 'text' names, or None."""
+        national = None
+        for part in _PART_SEPARATORS.split(text or ""):
+            part = normalise(part)
+            if not part:
+                continue
+            region = self._lookup(part)
+            if region is not None and not region.national:
+                return region
+            national = national or region
+        return national
+
+    def _canonical(self, text):
+        region = self.resolve(text)
+        if region is not None:
+            return region.label
+        return string.capwords(" ".join((text or "").split()))
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_region_index():
+    """Returns the process-wide RegionIndex over REGIONS_PATH, loading it on first use."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = RegionIndex()
+    return _index
+
+
+def canonical_region(text):
+    """The region a plan is generated for: a gazetteer label, or the tidied input."""
+    return get_region_index().canonical((text or "")[:MAX_REGION_CHARS])
@@ -0,0 +1,100 @@
+"""
+Markdown -> HTML for care plans.
+
+Plans come from a language model, so their markdown is untrusted. The
+renderer is python-markdown with the same "extra" and "tables" extensions
+the views always used, made safe inside the pipeline instead of by cleaning
+up the HTML afterwards:
+
+  * raw HTML blocks and inline tags are not passed through; they come out
+    as escaped text;
+  * after everything else has run, each element keeps only the attributes
+    in ALLOWED_ATTRIBUTES, and href/src values whose scheme is not in
+    ALLOWED_SCHEMES are removed.
+
+Building a Markdown instance (and its extensions) is the expensive part of
+a conversion, so each thread keeps one and resets it between documents.
+Rendered HTML is memoized by a hash of the markdown in a bounded LRU
+(PCOS_MARKDOWN_CACHE_ENTRIES, default 512), so a cached or replayed plan is
+rendered once per worker.
+
+The JSON APIs return this HTML by default; clients that render markdown
+themselves can ask for it with ?plan_format=markdown.
+"""
+import html
+import os
+import re
+import threading
+
+from .plan_cache import MemoryPlanCache, make_key
+
+HTML = "html"
+MARKDOWN = "markdown"
+PLAN_FORMATS = (HTML, MARKDOWN)
+
+ALLOWED_ATTRIBUTES = frozenset({"href", "src", "alt", "title", "align", "id", "class"})
+URL_ATTRIBUTES = ("href", "src")
+ALLOWED_SCHEMES = frozenset({"http", "https", "mailto"})
+
+CACHE_TTL = 24 * 60 * 60
+CACHE_MAX_ENTRIES = int(os.getenv("PCOS_MARKDOWN_CACHE_ENTRIES", "512"))
+
+_SCHEME = re.compile(r"^([a-z][a-z0-9+.\-]*):")
+# Browsers ignore these anywhere in a URL scheme ("java\tscript:")
+_IGNORED_URL_CHARS = re.compile(r"[\x00-\x20\x7f]+")
+
+
+def is_safe_url(url):
+    """True for relative URLs and absolute ones with a scheme in ALLOWED_SCHEMES."""
+    match = _SCHEME.match(_IGNORED_URL_CHARS.sub("", html.unescape(url)).lower())
+    return match is None or match.group(1) in ALLOWED_SCHEMES
+
+
+def _safe_extension():
+    from markdown.extensions import Extension
+    from markdown.treeprocessors import Treeprocessor
+
+    class AttributeSanitizer(Treeprocessor):
+        def run(self, root):
+            for element in root.iter():
+                for name, value in list(element.attrib.items()):
+                    if name not in ALLOWED_ATTRIBUTES or (name in URL_ATTRIBUTES and not is_safe_url(value)):
+                        del element.attrib[name]
+
+    class SafeMarkdown(Extension):
+        def extendMarkdown(self, md):
+            md.preprocessors.deregister("html_block", strict=False)
+            md.inlinePatterns.deregister("html", strict=False)
+            # After 'unescape' (priority 0), so backslash escapes cannot hide a scheme
+            md.treeprocessors.register(AttributeSanitizer(md), "sanitize_attributes", -10)
+
+    return SafeMarkdown()
+
+
+_local = threading.local()
+
+
+def get_renderer():
+    """This thread's Markdown instance."""
+    renderer = getattr(_local, "renderer", None)
+    if renderer is None:
+        import markdown
+
+        renderer = _local.renderer = markdown.Markdown(
+            extensions=["extra", "tables", _safe_extension()],
+            extension_configs={"tables": {"use_align_attribute": True}},
+        )
+    return renderer
+
+
+_cache = MemoryPlanCache(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES)
+
+
+def render_markdown(text):
+    """Sanitized HTML for a markdown document."""
+    key = make_key(text)
+    rendered = _cache.get(key)
+    if rendered is None:
+        rendered = get_renderer().reset().convert(text)
+        _cache.set(key, rendered)
+    return rendered
@@ -0,0 +1,171 @@
+"""
+Failure handling for calls to the model backend.
+
+  * Every call gets a deadline, passed down to the HTTP transport as its
+    timeout (PCOS_LLM_TIMEOUT seconds, default 60).
+  * Optionally, if a call has not finished after PCOS_LLM_HEDGE_AFTER
+    seconds (default 0 = off), an identical second call is started and
+    whichever succeeds first wins, trimming the latency tail at the cost of
+    some duplicate calls.
+  * A CircuitBreaker watches the outcome of recent calls. Once too many of
+    them fail it opens, and calls fail immediately (so callers can serve a
+    fallback) until a cool-down has passed and a probe call succeeds.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULT_TIMEOUT = 60.0
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens when at least 'min_calls' of the last 'window' calls were made and
+    'error_rate' or more of them failed. After 'cooldown' seconds one probe
+    call is let through (half-open); its outcome closes or re-opens the
+    circuit.
+    """
+
+    def __init__(self, error_rate=0.5, window=20, min_calls=10, cooldown=30.0):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a call may be made now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, success):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if success:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if (self.state == CLOSED and len(self._outcomes) >= self.min_calls
+                    and failures >= self.error_rate * len(self._outcomes)):
+                self._open()
+
+    def release(self):
+        """
+        Ends an allowed call that finished without an outcome (cancelled, or
+        abandoned by its caller), so a half-open circuit can probe again.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-hedge")
+    return _executor
+
+
+def call_with_deadline(func, timeout=DEFAULT_TIMEOUT, hedge_after=0):
+    """
+    Returns func(timeout), where 'func' makes one model call and must give
+    up after the timeout it is passed. With hedge_after > 0, a second call
+    starts if the first is still running after hedge_after seconds, and the
+    first successful result is returned; if both fail, the last error is
+    raised. DeadlineExceeded is raised if nothing has succeeded in time.
+    """
+    if not hedge_after or hedge_after >= timeout:
+        return func(timeout)
+
+    deadline = time.monotonic() + timeout
+    executor = _get_executor()
+    pending = {executor.submit(func, timeout)}
+    done, pending = wait(pending, timeout=hedge_after)
+    if not done:
+        pending.add(executor.submit(func, max(deadline - time.monotonic(), 0.001)))
+
+    error = None
+    while True:
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+        if not pending:
+            raise error
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"No model response within {timeout:g}s")
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+
+
+async def call_with_deadline_async(func, timeout=DEFAULT_TIMEOUT, hedge_after=0):
+    """Async equivalent of call_with_deadline(); 'func(timeout)' returns an awaitable."""
+    if not hedge_after or hedge_after >= timeout:
+        try:
+            return await asyncio.wait_for(func(timeout), timeout)
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(f"No model response within {timeout:g}s") from None
+
+    deadline = time.monotonic() + timeout
+    pending = {asyncio.ensure_future(func(timeout))}
+    done, pending = await asyncio.wait(pending, timeout=hedge_after)
+    if not done:
+        pending.add(asyncio.ensure_future(func(max(deadline - time.monotonic(), 0.001))))
+
+    error = None
+    try:
+        while True:
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if not pending:
+                raise error
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"No model response within {timeout:g}s")
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,381 @@
+"""
+Declarative diagnostic rules (diagnostic_rules.json) and their compiler.
+
+The rules file lists the derived values (FAI, HOMA-IR, ...), the exclusion
+checks, the Rotterdam criteria with their thresholds, how many criteria make
+a diagnosis, and the phenotype decision tree (first matching entry wins; the
+last entry must have no conditions and acts as the fallback).
+
+compile_rules() validates the file and flattens it into one ordered list of
+steps in which every input, derived value and comparison appears exactly
+once. The same plan drives both execution paths:
+
+  * RulePlan.evaluate(data) / RulePlan.diagnose(data) - generated Python
+    functions for one patient, returning a tuple with one value per step
+    (see RulePlan.slots) or the finished diagnosis report (the *_record
+    variants unpack a PatientRecord instead of reading dict keys);
+  * RulePlan.evaluate_columns(arrays) - NumPy evaluation over a cohort.
+
+Conditions are written as [value, op, threshold] (op one of > >= < <= == !=)
+or as [name] for an earlier exclusion or criterion.
+"""
+import hashlib
+import json
+import math
+import operator
+import re
+
+COMPARISONS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+DERIVED_OPS = ("ratio", "product", "max")
+
+# Names of the fixed outputs every plan produces
+REVIEW_NEEDED = "review_needed"
+CRITERIA_COUNT = "criteria_count"
+DIAGNOSIS = "diagnosis"
+PHENOTYPE_MATCH = "phenotype_match"
+PHENOTYPE_CODE = "phenotype_code"
+
+_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+class RuleSchemaError(ValueError):
+    pass
+
+
+def _is_number(value):
+    # Values are written into generated source, where inf and nan are not defined
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def validate_rules(data, inputs):
+    """Returns the list of problems in a parsed rules file (empty if valid)."""
+    if not isinstance(data, dict):
+        return ["top level must be an object"]
+
+    errors = []
+    numeric = set(inputs)
+    flags = set()
+    reserved = {REVIEW_NEEDED, CRITERIA_COUNT, DIAGNOSIS, PHENOTYPE_MATCH, PHENOTYPE_CODE}
+
+    def check_name(where, name):
+        if not isinstance(name, str) or not _NAME.match(name):
+            errors.append(f"{where}: 'id' must be a lowercase identifier")
+        elif name in numeric or name in flags or name in reserved:
+            errors.append(f"{where}: '{name}' is already defined")
+        else:
+            return True
+        return False
+
+    def check_conditions(where, conditions, allow_empty=False):
+        if not isinstance(conditions, list) or (not conditions and not allow_empty):
+            errors.append(f"{where}: conditions must be a {'' if allow_empty else 'non-empty '}list")
+            return
+        for j, condition in enumerate(conditions):
+            at = f"{where}, condition {j}"
+            if not isinstance(condition, list) or len(condition) not in (1, 3):
+                errors.append(f"{at}: must be [name] or [value, op, threshold]")
+            elif len(condition) == 1:
+                if condition[0] not in flags:
+                    errors.append(f"{at}: unknown exclusion or criterion '{condition[0]}'")
+            else:
+                value, op, threshold = condition
+                if value not in numeric:
+                    errors.append(f"{at}: unknown value '{value}'")
+                if op not in COMPARISONS:
+                    errors.append(f"{at}: unknown comparison '{op}'")
+                if not _is_number(threshold):
+                    errors.append(f"{at}: threshold must be a finite number")
+
+    for i, entry in enumerate(data.get("derived", [])):
+        where = f"derived {i}"
+        if not isinstance(entry, dict):
+            errors.append(f"{where}: must be an object")
+            continue
+        op, args = entry.get("op"), entry.get("of")
+        if op not in DERIVED_OPS:
+            errors.append(f"{where}: 'op' must be one of {', '.join(DERIVED_OPS)}")
+        if not isinstance(args, list) or not args or any(arg not in numeric for arg in args):
+            errors.append(f"{where}: 'of' must list known values")
+        elif op in ("ratio", "product") and len(args) != 2:
+            errors.append(f"{where}: '{op}' takes exactly two values")
+        for key in ("multiply_by", "divide_by"):
+            if key in entry and not _is_number(entry[key]):
+                errors.append(f"{where}: '{key}' must be a finite number")
+        if entry.get("divide_by") == 0:
+            errors.append(f"{where}: 'divide_by' must not be zero")
+        if check_name(where, entry.get("id")):
+            numeric.add(entry["id"])
+
+    for section in ("exclusions", "criteria"):
+        entries = data.get(section)
+        if not isinstance(entries, list) or (section == "criteria" and not entries):
+            errors.append(f"'{section}' must be a {'non-empty ' if section == 'criteria' else ''}list")
+            continue
+        for i, entry in enumerate(entries):
+            where = f"{section} {i}"
+            if not isinstance(entry, dict):
+                errors.append(f"{where}: must be an object")
+                continue
+            if not isinstance(entry.get("label"), str) or not entry["label"].strip():
+                errors.append(f"{where}: 'label' must be a non-empty string")
+            check_conditions(where, entry.get("any"))
+            if check_name(where, entry.get("id")):
+                flags.add(entry["id"])
+
+    min_criteria = data.get("min_criteria")
+    if not isinstance(min_criteria, int) or isinstance(min_criteria, bool) or min_criteria < 1:
+        errors.append("'min_criteria' must be a positive integer")
+
+    phenotypes = data.get("phenotypes")
+    if not isinstance(phenotypes, list) or not phenotypes:
+        errors.append("'phenotypes' must be a non-empty list")
+    else:
+        for i, entry in enumerate(phenotypes):
+            where = f"phenotype {i}"
+            if not isinstance(entry, dict):
+                errors.append(f"{where}: must be an object")
+                continue
+            for key in ("phenotype", "protocol"):
+                if not isinstance(entry.get(key), str) or not entry[key].strip():
+                    errors.append(f"{where}: '{key}' must be a non-empty string")
+            check_conditions(where, entry.get("when"), allow_empty=True)
+        if isinstance(phenotypes[-1], dict) and phenotypes[-1].get("when"):
+            errors.append("the last phenotype is the fallback and must have no conditions")
+
+    return errors
+
+
+class RulePlan:
+    """
+    A compiled rules file. 'steps' is the flat evaluation order, one
+    (name, op, args) per computed value; 'slots' maps each name to its
+    position in the tuples returned by evaluate().
+    """
+
+    def __init__(self, steps, exclusions, criteria, phenotypes, version):
+        self.steps = tuple(steps)
+        self.slots = {name: i for i, (name, _, _) in enumerate(self.steps)}
+        # (id, label) pairs in report order
+        self.exclusions = tuple(exclusions)
+        self.criteria = tuple(criteria)
+        # (phenotype, lifestyle_protocol), indexed by phenotype codes
+        self.phenotypes = tuple(phenotypes)
+        self.version = version
+        generated = self._generate_scalar()
+        self.evaluate = generated["evaluate"]
+        self.diagnose = generated["diagnose"]
+        # Same, for sequences holding every input in order (PatientRecord)
+        self.evaluate_record = generated["evaluate_record"]
+        self.diagnose_record = generated["diagnose_record"]
+
+    def _step_lines(self, var, unpack):
+        if unpack:
+            inputs = [var[name] for name, op, _ in self.steps if op == "input"]
+            lines = [f"    {', '.join(inputs)}, = data"]
+        else:
+            lines = ["    get = data.get"]
+        for name, op, args in self.steps:
+            target = var[name]
+            if op == "input":
+                if not unpack:
+                    field, default = args
+                    lines.append(f"    {target} = get({field!r}, {default!r})")
+            elif op == "ratio":
+                (a, b), scale = args
+                scaled = f" * {scale!r}" if scale is not None else ""
+                lines.append(f"    {target} = ({var[a]} / {var[b]}){scaled} if {var[b]} else 0")
+            elif op == "product":
+                (a, b), divisor = args
+                divided = f" / {divisor!r}" if divisor is not None else ""
+                lines.append(f"    {target} = ({var[a]} * {var[b]}){divided}")
+            elif op == "max":
+                lines.append(f"    {target} = max({', '.join(var[a] for a in args)})")
+            elif op == "compare":
+                value, comparison, threshold = args
+                lines.append(f"    {target} = {var[value]} {comparison} {threshold!r}")
+            elif op == "any":
+                lines.append(f"    {target} = {' or '.join(var[a] for a in args) or 'False'}")
+            elif op == "count":
+                lines.append(f"    {target} = {' + '.join(var[a] for a in args)} + 0")
+            elif op == "diagnosis":
+                review, count, minimum = args
+                lines.append(f"    {target} = not {var[review]} and {var[count]} >= {minimum!r}")
+            elif op == "select":
+                for code, conditions in enumerate(args):
+                    test = " and ".join(var[c] for c in conditions) or "True"
+                    lines.append(f"    {'if' if code == 0 else 'elif'} {test}:")
+                    lines.append(f"        {target} = {code}")
+            elif op == "mask":
+                match, diagnosis = args
+                lines.append(f"    {target} = {var[match]} if {var[diagnosis]} else -1")
+        return lines
+
+    def _generate_scalar(self):
+        """
+        Generates evaluate(data), returning every step's value as a tuple,
+        and diagnose(data), returning the run_diagnosis() report directly,
+        each in two flavours: reading a dict with .get(field, default), and
+        unpacking a sequence that holds every input in order (PatientRecord).
+        Only validated identifiers and numbers reach the generated source.
+        """
+        var = {name: f"v{i}" for name, i in self.slots.items()}
+        lines = []
+        for suffix, unpack in (("", False), ("_record", True)):
+            steps = self._step_lines(var, unpack)
+            lines += [f"def evaluate{suffix}(data):"] + steps
+            lines.append(f"    return ({', '.join(var[name] for name, _, _ in self.steps)},)")
+            lines += ["", f"def diagnose{suffix}(data):"] + steps + self._report_lines(var) + [""]
+
+        namespace = {
+            "EXCLUSIONS": tuple(label for _, label in self.exclusions),
+            "CRITERIA": tuple(label for _, label in self.criteria),
+            "PHENOTYPES": self.phenotypes,
+        }
+        exec(compile("\n".join(lines), f"<diagnostic rules {self.version[:12]}>", "exec"), namespace)
+        return namespace
+
+    def _report_lines(self, var):
+        """Body of diagnose(): builds the run_diagnosis() report from the step variables."""
+        lines = [f"    if {var[REVIEW_NEEDED]}:", "        alerts = []"]
+        for i, (name, _) in enumerate(self.exclusions):
+            lines.append(f"        if {var[name]}: alerts.append(EXCLUSIONS[{i}])")
+        lines.append('        return {"status": "Review Needed", "alerts": alerts}')
+        lines.append("    criteria = []")
+        for i, (name, _) in enumerate(self.criteria):
+            lines.append(f"    if {var[name]}: criteria.append(CRITERIA[{i}])")
+        lines.append(f"    if {var[DIAGNOSIS]}:")
+        lines.append(f"        phenotype, protocol = PHENOTYPES[{var[PHENOTYPE_MATCH]}]")
+        lines.append("    else:")
+        lines.append('        phenotype, protocol = "Unknown", "Generic Healthy Living"')
+        lines.append(
+            f'    return {{"criteria_met": criteria, "diagnosis": {var[DIAGNOSIS]},'
+            ' "phenotype": phenotype, "lifestyle_protocol": protocol}'
+        )
+        return lines
+
+    def evaluate_columns(self, arrays):
+        """
+        Runs the plan over equal-length NumPy arrays, one per input, and
+        returns every computed value by name.
+        """
+        import numpy as np
+
+        size = len(next(iter(arrays.values()))) if arrays else 0
+        values = {}
+        for name, op, args in self.steps:
+            if op == "input":
+                values[name] = arrays[args[0]]
+            elif op == "ratio":
+                (a, b), scale = args
+                out = np.zeros(size)
+                np.divide(values[a], values[b], out=out, where=values[b] != 0)
+                if scale is not None:
+                    out *= scale
+                values[name] = out
+            elif op == "product":
+                (a, b), divisor = args
+                out = values[a] * values[b]
+                values[name] = out / divisor if divisor is not None else out
+            elif op == "max":
+                out = values[args[0]]
+                for a in args[1:]:
+                    out = np.maximum(out, values[a])
+                values[name] = out
+            elif op == "compare":
+                value, comparison, threshold = args
+                values[name] = COMPARISONS[comparison](values[value], threshold)
+            elif op == "any":
+                values[name] = np.logical_or.reduce([values[a] for a in args]) if args else np.zeros(size, dtype=bool)
+            elif op == "count":
+                out = np.zeros(size, dtype=np.int8)
+                for a in args:
+                    out += values[a]
+                values[name] = out
+            elif op == "diagnosis":
+                review, count, minimum = args
+                values[name] = ~values[review] & (values[count] >= minimum)
+            elif op == "select":
+                # The last branch is the unconditional fallback
+                conditions = [
+                    np.logical_and.reduce([values[c] for c in branch]) if branch else np.ones(size, dtype=bool)
+                    for branch in args[:-1]
+                ]
+                values[name] = np.select(conditions, range(len(conditions)), default=len(conditions)).astype(np.int8)
+            elif op == "mask":
+                match, diagnosis = args
+                out = values[match].copy()
+                out[~values[diagnosis]] = -1
+                values[name] = out
+        return values
+
+
+def compile_rules(data, inputs, version=""):
+    """Validates a parsed rules file and compiles it into a RulePlan."""
+    errors = validate_rules(data, inputs)
+    if errors:
+        raise RuleSchemaError("; ".join(errors))
+
+    steps = [(field, "input", (field, default)) for field, default in inputs.items()]
+    for entry in data.get("derived", []):
+        if entry["op"] == "ratio":
+            args = (tuple(entry["of"]), entry.get("multiply_by"))
+        elif entry["op"] == "product":
+            args = (tuple(entry["of"]), entry.get("divide_by"))
+        else:
+            args = tuple(entry["of"])
+        steps.append((entry["id"], entry["op"], args))
+
+    # Each distinct comparison becomes one step, however many rules use it
+    comparisons = {}
+
+    def condition_slot(condition):
+        if len(condition) == 1:
+            return condition[0]
+        key = tuple(condition)
+        if key not in comparisons:
+            comparisons[key] = f"_cmp{len(comparisons)}"
+            steps.append((comparisons[key], "compare", key))
+        return comparisons[key]
+
+    for entry in data["exclusions"]:
+        steps.append((entry["id"], "any", tuple(condition_slot(c) for c in entry["any"])))
+    steps.append((REVIEW_NEEDED, "any", tuple(entry["id"] for entry in data["exclusions"])))
+
+    for entry in data["criteria"]:
+        steps.append((entry["id"], "any", tuple(condition_slot(c) for c in entry["any"])))
+    steps.append((CRITERIA_COUNT, "count", tuple(entry["id"] for entry in data["criteria"])))
+    steps.append((DIAGNOSIS, "diagnosis", (REVIEW_NEEDED, CRITERIA_COUNT, data["min_criteria"])))
+
+    branches = tuple(tuple(condition_slot(c) for c in entry["when"]) for entry in data["phenotypes"])
+    steps.append((PHENOTYPE_MATCH, "select", branches))
+    steps.append((PHENOTYPE_CODE, "mask", (PHENOTYPE_MATCH, DIAGNOSIS)))
+
+    return RulePlan(
+        steps,
+        exclusions=[(entry["id"], entry["label"]) for entry in data["exclusions"]],
+        criteria=[(entry["id"], entry["label"]) for entry in data["criteria"]],
+        phenotypes=[(entry["phenotype"], entry["protocol"]) for entry in data["phenotypes"]],
+        version=version,
+    )
+
+
+def load_rules(path, inputs):
+    """Reads, validates and compiles a rules file; raises RuleSchemaError if it is invalid."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    try:
+        data = json.loads(raw)
+    except ValueError as e:
+        raise RuleSchemaError(f"{path}: {e}") from e
+    try:
+        return compile_rules(data, inputs, version=hashlib.sha256(raw).hexdigest())
+    except RuleSchemaError as e:
+        raise RuleSchemaError(f"{path}: {e}") from e
@@ -0,0 +1,258 @@
+"""
+Offline cohort screening for `python manage.py screen_cohort`.
+
+A registry file (CSV, or Parquet if pyarrow is installed) is read
+CHUNK_SIZE rows at a time. Each chunk is diagnosed through
+PCOSDiagnosticEngine.run_batch in a worker process, and the results are
+appended to the output file in input order, one NDJSON line per row: the
+same "diagnosis" report the APIs return, or an "error" for rows that fail
+validation. Only a few chunks per worker are held in memory at any time.
+
+After every chunk written, a checkpoint next to the output
+(<output>.checkpoint) records how many rows and output bytes are complete;
+a run started with resume=True discards anything written after the last
+checkpoint and carries on from there.
+"""
+import csv
+import io
+import json
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .engine import INPUT_DEFAULTS, PCOSDiagnosticEngine, _form_number
+
+CHUNK_SIZE = 5000
+PARQUET_SUFFIXES = (".parquet", ".pq")
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+
+def _iter_csv(path, chunk_size, skip):
+    # Chunks stay unparsed text (header, lines) so the workers do the CSV
+    # parsing; a record is only split where its quotes are balanced.
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        header = next(csv.reader([f.readline()]), None)
+        if not header:
+            return
+        chunk = []
+        record = ""
+        for line in f:
+            record += line
+            if record.count('"') % 2:
+                continue
+            if skip:
+                skip -= 1
+            elif record.strip():
+                chunk.append(record)
+                if len(chunk) >= chunk_size:
+                    yield header, "".join(chunk), len(chunk)
+                    chunk = []
+            record = ""
+        if record.strip() and not skip:
+            chunk.append(record)
+        if chunk:
+            yield header, "".join(chunk), len(chunk)
+
+
+def _iter_parquet(path, chunk_size, skip, columns):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Reading Parquet files requires pyarrow") from None
+
+    parquet = pq.ParquetFile(path)
+    columns = [name for name in columns if name in parquet.schema_arrow.names]
+    for batch in parquet.iter_batches(batch_size=chunk_size, columns=columns):
+        if skip >= batch.num_rows:
+            skip -= batch.num_rows
+            continue
+        if skip:
+            batch, skip = batch.slice(skip), 0
+        yield None, batch, batch.num_rows
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE, skip=0, id_column=None):
+    """
+    Yields (header, data, rows) chunks of a CSV or Parquet file, leaving
+    out the first 'skip' rows; rows_of() turns a chunk into row dicts.
+    """
+    if path.lower().endswith(PARQUET_SUFFIXES):
+        return _iter_parquet(path, chunk_size, skip, list(INPUT_DEFAULTS) + ([id_column] if id_column else []))
+    return _iter_csv(path, chunk_size, skip)
+
+
+def rows_of(header, data):
+    """Row dicts of a chunk from read_chunks()."""
+    if header is None:
+        return data.to_pylist()
+    return list(csv.DictReader(io.StringIO(data, newline=""), fieldnames=header))
+
+
+def _row_error(row):
+    """(values, error) for one row; values are the 13 inputs as numbers."""
+    # Fast path: every field present and a finite, non-negative number. A
+    # NaN or infinity makes the sum non-finite (as can a huge but valid
+    # value, which the slow path then accepts).
+    try:
+        values = [float(row[name]) for name in INPUT_DEFAULTS]
+    except (KeyError, TypeError, ValueError):
+        pass
+    else:
+        if min(values) >= 0 and math.isfinite(sum(values)):
+            return values, None
+
+    values = []
+    missing_fields = []
+    invalid_fields = []
+    for name in INPUT_DEFAULTS:
+        value = row.get(name)
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == '':
+            missing_fields.append(name)
+            continue
+        if isinstance(value, str):
+            value = _form_number(value)
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or not 0 <= value < math.inf:
+            invalid_fields.append(name)
+        values.append(value)
+
+    if missing_fields:
+        return None, f"Missing or empty required fields: {', '.join(missing_fields)}"
+    if invalid_fields:
+        return None, f"Invalid values for fields (must be positive numbers): {', '.join(invalid_fields)}"
+    return values, None
+
+
+def screen_chunk(start, header, data, id_column=None):
+    """
+    Diagnoses one chunk from read_chunks() whose first row is row number
+    'start'. Returns (ndjson, diagnosed, errors); runs in a worker process.
+    """
+    rows = rows_of(header, data)
+    parsed = [_row_error(row) for row in rows]
+    valid = [values for values, error in parsed if error is None]
+    reports = []
+    if valid:
+        columns = {name: [values[i] for values in valid] for i, name in enumerate(INPUT_DEFAULTS)}
+        reports = PCOSDiagnosticEngine.run_batch(columns)
+    reports = iter(reports)
+
+    lines = []
+    for offset, (row, (values, error)) in enumerate(zip(rows, parsed)):
+        line = {"row": start + offset}
+        if id_column:
+            line["id"] = row.get(id_column)
+        if error is None:
+            line["diagnosis"] = next(reports)
+        else:
+            line["error"] = error
+        lines.append(json.dumps(line, default=str))
+    lines.append("")
+    return "\n".join(lines), len(valid), len(rows) - len(valid)
+
+
+def checkpoint_path(output_path):
+    return output_path + CHECKPOINT_SUFFIX
+
+
+def load_checkpoint(output_path, input_path):
+    """The checkpoint of an earlier run over the same, unchanged input file, or None."""
+    try:
+        with open(checkpoint_path(output_path)) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    stat = os.stat(input_path)
+    if (checkpoint.get("input"), checkpoint.get("input_size"), checkpoint.get("input_mtime")) != (
+            os.path.abspath(input_path), stat.st_size, stat.st_mtime):
+        return None
+    if not os.path.exists(output_path) or os.path.getsize(output_path) < checkpoint["output_bytes"]:
+        return None
+    return checkpoint
+
+
+def _save_checkpoint(output_path, checkpoint):
+    path = checkpoint_path(output_path)
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+
+def screen_file(input_path, output_path, workers=None, chunk_size=CHUNK_SIZE, id_column=None,
+                resume=False, progress=None):
+    """
+    Screens 'input_path' into 'output_path' with 'workers' processes
+    (default: one per CPU; 0 runs every chunk in this process).
+    'progress', if given, is called as progress(rows_done, seconds) after
+    each chunk. Returns a summary: rows, diagnosed, errors, resumed_from,
+    seconds and rows_per_sec (for the rows screened by this run).
+    """
+    stat = os.stat(input_path)
+    checkpoint = load_checkpoint(output_path, input_path) if resume else None
+    if checkpoint is None:
+        checkpoint = {
+            "input": os.path.abspath(input_path),
+            "input_size": stat.st_size,
+            "input_mtime": stat.st_mtime,
+            "rows": 0, "diagnosed": 0, "errors": 0, "output_bytes": 0, "complete": False,
+        }
+    resumed_from = checkpoint["rows"]
+
+    started = time.perf_counter()
+    screened = 0
+    if workers is None:
+        workers = os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=workers) if workers else None
+    max_pending = workers * 2
+
+    with open(output_path, "r+b" if checkpoint["output_bytes"] else "wb") as out:
+        out.truncate(checkpoint["output_bytes"])
+        out.seek(checkpoint["output_bytes"])
+
+        def write(result, rows):
+            nonlocal screened
+            text, diagnosed, errors = result
+            out.write(text.encode("utf-8"))
+            out.flush()
+            screened += rows
+            checkpoint["rows"] += rows
+            checkpoint["diagnosed"] += diagnosed
+            checkpoint["errors"] += errors
+            checkpoint["output_bytes"] = out.tell()
+            _save_checkpoint(output_path, checkpoint)
+            if progress:
+                progress(checkpoint["rows"], time.perf_counter() - started)
+
+        try:
+            pending = deque()
+            start = checkpoint["rows"]
+            for header, data, rows in read_chunks(input_path, chunk_size, skip=start, id_column=id_column):
+                if pool is None:
+                    write(screen_chunk(start, header, data, id_column), rows)
+                else:
+                    pending.append((pool.submit(screen_chunk, start, header, data, id_column), rows))
+                    while len(pending) >= max_pending:
+                        future, size = pending.popleft()
+                        write(future.result(), size)
+                start += rows
+            while pending:
+                future, size = pending.popleft()
+                write(future.result(), size)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+    checkpoint["complete"] = True
+    _save_checkpoint(output_path, checkpoint)
+    seconds = time.perf_counter() - started
+    return {
+        "rows": checkpoint["rows"],
+        "diagnosed": checkpoint["diagnosed"],
+        "errors": checkpoint["errors"],
+        "resumed_from": resumed_from,
+        "seconds": seconds,
+        "rows_per_sec": screened / seconds if seconds else 0.0,
+    }
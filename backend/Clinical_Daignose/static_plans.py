@@ -0,0 +1,178 @@
+"""
+Pre-rendered static care plans, served when the model cannot produce one.
+
+`python manage.py build_static_plans` renders
+templates/Clinical_Daignose/static_plan.html for the generic protocol entry
+of every phenotype_id in pcos_protocols.json and writes <id>.html,
+<id>.html.gz and <id>.html.br plus a manifest.json into
+PCOS_STATIC_PLAN_DIR (default: the static_plans folder next to this file).
+The build is deterministic, so unchanged rules give byte-identical files.
+
+At runtime StaticPlanStore reads the artifacts into memory once, and the
+views hand out the stored bytes without rendering or compressing anything.
+A phenotype missing from the build, or a build made from another version of
+the protocols file, is rendered in memory on first use instead.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+STATIC_PLAN_DIR = os.getenv(
+    "PCOS_STATIC_PLAN_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "static_plans")
+)
+TEMPLATE = "Clinical_Daignose/static_plan.html"
+MANIFEST = "manifest.json"
+
+IDENTITY = "identity"
+GZIP = "gzip"
+BROTLI = "br"
+# Encoding -> file suffix, in the order the server prefers them
+SUFFIXES = {BROTLI: ".html.br", GZIP: ".html.gz", IDENTITY: ".html"}
+
+
+class StaticPlan:
+    __slots__ = ("phenotype_id", "html", "bodies", "etag")
+
+    def __init__(self, phenotype_id, bodies):
+        self.phenotype_id = phenotype_id
+        self.bodies = bodies
+        self.html = bodies[IDENTITY].decode("utf-8")
+        self.etag = '"' + hashlib.sha256(bodies[IDENTITY]).hexdigest()[:32] + '"'
+
+    def body(self, encoding):
+        return self.bodies[encoding]
+
+
+def render_static_plan(rule):
+    """HTML fragment for one ProtocolRule."""
+    from django.template.loader import render_to_string
+
+    return render_to_string(TEMPLATE, {
+        "rule": rule,
+        "exercise": rule.raw.get("exercise_rules", {}),
+        "supplements": rule.raw.get("supplement_rules", {}).get("core_stack", []),
+        "avoids": rule.raw.get("lifestyle_avoids", []),
+    })
+
+
+def compress(html):
+    """{encoding: bytes} for an HTML string, at maximum compression."""
+    import brotli
+
+    data = html.encode("utf-8")
+    return {
+        IDENTITY: data,
+        GZIP: gzip.compress(data, compresslevel=9, mtime=0),
+        BROTLI: brotli.compress(data, quality=11),
+    }
+
+
+def phenotype_ids(snapshot):
+    """Every phenotype_id with a generic (region- and language-free) protocol entry."""
+    return sorted(pid for pid, region, language in snapshot.index if region is None and language is None)
+
+
+def build_static_plans(snapshot, directory=STATIC_PLAN_DIR):
+    """Writes the artifacts for every phenotype in a ProtocolSnapshot; returns the manifest."""
+    os.makedirs(directory, exist_ok=True)
+    manifest = {"protocols_version": snapshot.version, "plans": {}}
+    for phenotype_id in phenotype_ids(snapshot):
+        bodies = compress(render_static_plan(snapshot.get(phenotype_id)))
+        for encoding, suffix in SUFFIXES.items():
+            with open(os.path.join(directory, phenotype_id + suffix), "wb") as f:
+                f.write(bodies[encoding])
+        manifest["plans"][phenotype_id] = {
+            encoding: len(body) for encoding, body in bodies.items()
+        }
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write("\n")
+    return manifest
+
+
+def choose_encoding(accept_encoding):
+    """The preferred encoding in SUFFIXES that an Accept-Encoding header allows."""
+    accepted = set()
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        params = params.strip()
+        try:
+            if params.startswith("q=") and float(params[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    for encoding in (BROTLI, GZIP):
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return IDENTITY
+
+
+class StaticPlanStore:
+    def __init__(self, protocols, directory=STATIC_PLAN_DIR):
+        self.protocols = protocols
+        self.directory = directory
+        self._plans = {}
+        self._lock = threading.Lock()
+        self._manifest = None
+
+    def get(self, phenotype_id):
+        """StaticPlan for the phenotype under the current protocols, or None if it has no protocol."""
+        version = self.protocols.version
+        plan = self._plans.get((phenotype_id, version))
+        if plan is None:
+            with self._lock:
+                plan = self._plans.get((phenotype_id, version))
+                if plan is None:
+                    plan = self._load(phenotype_id, version)
+                    if plan is not None:
+                        self._plans[(phenotype_id, version)] = plan
+        return plan
+
+    def _built_version(self):
+        if self._manifest is None:
+            try:
+                with open(os.path.join(self.directory, MANIFEST)) as f:
+                    self._manifest = json.load(f)
+            except (OSError, ValueError):
+                self._manifest = {}
+        return self._manifest.get("protocols_version")
+
+    def _load(self, phenotype_id, version):
+        if self._built_version() == version and phenotype_id in self._manifest.get("plans", {}):
+            try:
+                bodies = {}
+                for encoding, suffix in SUFFIXES.items():
+                    with open(os.path.join(self.directory, phenotype_id + suffix), "rb") as f:
+                        bodies[encoding] = f.read()
+                return StaticPlan(phenotype_id, bodies)
+            except OSError as e:
+                logger.warning("Static plan for %s unreadable, rendering it instead: %s", phenotype_id, e)
+
+        rule = self.protocols.get(phenotype_id)
+        if rule is None:
+            return None
+        logger.info("No current static plan build for %s; rendering it in memory", phenotype_id)
+        return StaticPlan(phenotype_id, compress(render_static_plan(rule)))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_static_plan_store():
+    """Returns the process-wide StaticPlanStore, backed by the recommendation engine's protocols."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                from .rag_engine import get_recommendation_engine
+
+                _store = StaticPlanStore(get_recommendation_engine().protocols)
+    return _store
@@ -0,0 +1,45 @@
+"""
+Short-lived tokens for streamed care plans.
+
+pcos_diagnosis_api (?plan=stream) stores what to stream - phenotype, plan
+region and patient name - in Django's cache under a random token and only
+hands the client the token, so the EventSource URL carries no patient data
+and the stream endpoint only generates plans that a diagnosis asked for.
+
+Settings:
+    PCOS_STREAM_TOKEN_TTL     seconds a token stays valid (default 300, the
+                              idempotency replay window, so a replayed
+                              response can still be streamed)
+    PCOS_STREAM_TOKEN_CACHE   Django cache alias (default "default"); with
+                              several worker processes it must be shared
+"""
+import os
+import secrets
+
+DEFAULT_TTL = 5 * 60
+
+_KEY_PREFIX = "pcos_stream:"
+
+
+def _cache():
+    from django.core.cache import caches
+
+    return caches[os.getenv("PCOS_STREAM_TOKEN_CACHE", "default")]
+
+
+def issue_stream_token(phenotype_id, region, patient_name):
+    """Returns a new token for streaming this plan."""
+    token = secrets.token_urlsafe(24)
+    _cache().set(
+        _KEY_PREFIX + token,
+        (phenotype_id, region, patient_name),
+        timeout=float(os.getenv("PCOS_STREAM_TOKEN_TTL", DEFAULT_TTL))
+    )
+    return token
+
+
+def redeem_stream_token(token):
+    """(phenotype_id, region, patient_name) for a live token, or None."""
+    if not token or len(token) > 64:
+        return None
+    return _cache().get(_KEY_PREFIX + token)
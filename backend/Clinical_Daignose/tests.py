@@ -1,3 +1,1617 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.http import QueryDict
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from . import lab_reports, metrics, rag_engine
+from .benchmarks import (
+    BRANCH_PATIENTS, HOST_KEY, IMPORT_TIME_BUDGET_US, LAZY_MODULES, SAMPLE_PATIENT, compare_to_baseline, host_info,
+    load_baseline, make_cohort, make_lab_report_pdf, make_plan_markdown, make_ultrasound_frame, measure_imports,
+    save_baseline, to_columns,
+)
+from .bulk import diagnose_stream, iter_json_array, iter_ndjson
+from .engine import INPUT_DEFAULTS, RULES_PATH, PCOSDiagnosticEngine, PatientRecord, _form_number
+from .fake_llm import ERROR, SLOW, FakeModelServer, use_fake_model
+from .history import HistoryRecorder, input_hash
+from .idempotency import COALESCED, COMPUTED, REPLAYED, IdempotencyStore
+from .jobs import LEASE_SECONDS, PlanJobQueue, SQLiteJobStore
+from .logs import REDACTED, AsyncQueueHandler, JsonFormatter, SamplingFilter
+from .models import CarePlan, DiagnosisResult, PatientSubmission
+from .plan_cache import MemoryPlanCache, SQLitePlanCache
+from .protocols import ProtocolSchemaError, ProtocolStore, validate_protocols
+from .regions import FUZZY, RegionGazetteerError, RegionIndex, canonical_region
+from .rendering import render_markdown
+from .resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from .rules import RuleSchemaError, compile_rules
+from .screening import screen_file
+from .ultrasound import measure_frame, measure_patients
+from .stream_tokens import issue_stream_token, redeem_stream_token
+from .static_plans import StaticPlanStore, build_static_plans, choose_encoding, get_static_plan_store, phenotype_ids
+from .views import FALLBACK_NOTE, PHENOTYPE_IDS
+
+
+def use_fresh_idempotency_store(test):
+    """Stops identical submissions in other tests from being replayed into 'test'."""
+    patcher = patch("Clinical_Daignose.idempotency._store", IdempotencyStore())
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+SECTIONS = len(rag_engine.PLAN_SECTIONS)
+
+
+def assembled(section):
+    """The plan made of every section answered with 'section' by the fake model."""
+    return rag_engine.SECTION_SEPARATOR.join([section] * SECTIONS)
+
+
+class BatchDiagnosisTests(SimpleTestCase):
+    def test_run_batch_matches_run_diagnosis(self):
+        patients = make_cohort(5000, seed=42)
+        expected = [PCOSDiagnosticEngine(p).run_diagnosis() for p in patients]
+
+        self.assertEqual(PCOSDiagnosticEngine.run_batch(to_columns(patients)), expected)
+
+    def test_batch_covers_every_branch(self):
+        masks = PCOSDiagnosticEngine.evaluate_batch(to_columns(make_cohort(5000, seed=42)))
+
+        self.assertTrue(masks["review_needed"].any())
+        self.assertTrue((~masks["diagnosis"] & ~masks["review_needed"]).any())
+        # Code 4 (adrenal) is unreachable: without androgens or morphology
+        # at most one Rotterdam criterion can be met.
+        self.assertEqual(set(masks["phenotype_code"].tolist()), {-1, 0, 1, 2, 3})
+
+    def test_missing_columns_use_scalar_defaults(self):
+        patient = {"cycle_length_days": 50, "total_testosterone": 60}
+
+        self.assertEqual(
+            PCOSDiagnosticEngine.run_batch({k: [v] for k, v in patient.items()}),
+            [PCOSDiagnosticEngine(patient).run_diagnosis()],
+        )
+
+
+@override_settings(PCOS_RECORD_HISTORY=False)
+class BulkDiagnosisApiTests(SimpleTestCase):
+    def setUp(self):
+        self.patients = [dict(p, region="Pune", patient_name=f"P{i}") for i, p in enumerate(make_cohort(30, seed=7))]
+
+    def _post(self, body, content_type):
+        response = self.client.post(reverse("pcos_bulk_api"), data=body, content_type=content_type)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        return [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+
+    def test_json_array_body(self):
+        lines = self._post(json.dumps(self.patients), "application/json")
+
+        self.assertEqual([line["index"] for line in lines], list(range(30)))
+        for line, patient in zip(lines, self.patients):
+            self.assertEqual(line["patient_name"], patient["patient_name"])
+            self.assertEqual(line["diagnosis"], PCOSDiagnosticEngine(patient).run_diagnosis())
+
+    def test_ndjson_body_with_invalid_rows(self):
+        self.patients[3].pop("tsh")
+        self.patients[5]["shbg"] = "abc"
+        del self.patients[8]["region"]
+        body = "\n".join(json.dumps(p) for p in self.patients)
+
+        with patch("Clinical_Daignose.bulk.CHUNK_SIZE", 4):
+            lines = self._post(body, "application/x-ndjson")
+
+        self.assertEqual(len(lines), 30)
+        self.assertEqual(lines[3]["error"], "Missing or empty required fields: tsh")
+        self.assertIn("shbg", lines[5]["error"])
+        self.assertEqual(lines[8]["error"], "Region is required")
+        self.assertEqual(lines[9]["diagnosis"], PCOSDiagnosticEngine(self.patients[9]).run_diagnosis())
+
+    def test_truncated_array_reports_error(self):
+        lines = self._post(json.dumps(self.patients[:2])[:-40], "application/json")
+
+        self.assertEqual(lines[0]["index"], 0)
+        self.assertEqual(lines[-1]["index"], 1)
+        self.assertIn("Invalid request body", lines[-1]["error"])
+
+    def test_non_finite_numbers_are_rejected(self):
+        body = json.dumps(self.patients[:3]).replace('"tsh": ', '"tsh": 1e999, "x": ', 1)
+        lines = self._post(body, "application/json")
+        self.assertIn("tsh", lines[0]["error"])
+        self.assertIn("diagnosis", lines[1])
+
+        for content_type in ("application/json", "application/x-ndjson"):
+            patients = [dict(p) for p in self.patients[:2]]
+            patients[1]["crp"] = float("nan")
+            body = json.dumps(patients) if content_type == "application/json" else "\n".join(map(json.dumps, patients))
+            lines = self._post(body, content_type)
+
+            self.assertIn("diagnosis", lines[0])
+            self.assertEqual(lines[1]["index"], 1)
+            self.assertIn("NaN is not a valid JSON number", lines[1]["error"])
+
+    def test_array_elements_must_be_comma_separated(self):
+        body = json.dumps(self.patients[:3])
+        body = body.replace("}, {", "} {", 1)
+        lines = self._post(body, "application/json")
+
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]["index"], 0)
+        self.assertIn("expected ',' or ']'", lines[1]["error"])
+
+    def test_malformed_element_fails_without_reading_the_rest(self):
+        body = ("[" + json.dumps(self.patients[0]) + ', {"tsh": x' + " " * (4 * 1024 * 1024) + "}]").encode()
+        stream = io.BytesIO(body)
+
+        with self.assertRaisesRegex(ValueError, "Malformed JSON array element"):
+            list(iter_json_array(stream))
+        self.assertLess(stream.tell(), len(body) // 4)
+
+    def test_overlong_ndjson_line_fails_without_reading_the_rest(self):
+        body = (json.dumps(self.patients[0]) + '\n{"tsh": 1' + " " * (4 * 1024 * 1024) + "}").encode()
+        stream = io.BytesIO(body)
+
+        lines = [json.loads(line) for line in diagnose_stream(iter_ndjson(stream), lambda patient: None)]
+        self.assertIn("diagnosis", lines[0])
+        self.assertEqual(lines[1]["index"], 1)
+        self.assertIn("NDJSON lines are limited", lines[1]["error"])
+        self.assertLess(stream.tell(), len(body) // 4)
+
+    def test_diagnosis_errors_are_not_reported_as_bad_bodies(self):
+        def record(*args):
+            raise ValueError("database is down")
+
+        lines = diagnose_stream(iter(self.patients[:3]), lambda patient: None, record=record)
+        with self.assertRaisesRegex(ValueError, "database is down"):
+            list(lines)
+
+
+class RecommendationEngineSingletonTests(SimpleTestCase):
+    def setUp(self):
+        patcher = patch.object(rag_engine, "_engine", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_engine_is_built_once_across_threads(self):
+        with patch.object(rag_engine, "ProtocolStore") as load_rules:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                engines = list(pool.map(lambda _: rag_engine.get_recommendation_engine(), range(32)))
+
+        self.assertEqual(len({id(engine) for engine in engines}), 1)
+        self.assertEqual(load_rules.call_count, 1)
+
+    def test_rules_load_from_app_directory(self):
+        phenotype_ids = [rule["phenotype_id"] for rule in rag_engine.get_recommendation_engine().rules]
+
+        self.assertIn("insulin_resistant", phenotype_ids)
+
+
+@override_settings(PCOS_RECORD_HISTORY=False)
+class PlanCacheTests(SimpleTestCase):
+    def test_memory_cache_evicts_least_recently_used(self):
+        cache = MemoryPlanCache(max_entries=2)
+        cache.set("a", "A")
+        cache.set("b", "B")
+        cache.get("a")
+        cache.set("c", "C")
+
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), ("A", None, "C"))
+
+    def test_memory_cache_expires_entries(self):
+        cache = MemoryPlanCache(ttl=10)
+        with patch("Clinical_Daignose.plan_cache.time.monotonic", return_value=100):
+            cache.set("a", "A")
+        with patch("Clinical_Daignose.plan_cache.time.monotonic", return_value=111):
+            self.assertIsNone(cache.get("a"))
+
+    def test_sqlite_cache_round_trip_and_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = SQLitePlanCache(os.path.join(tmp, "plans.sqlite3"), max_entries=2)
+            for key in "abc":
+                cache.set(key, key.upper())
+
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.get("c"), "C")
+            self.assertEqual(SQLitePlanCache(cache.path).get("b"), "B")
+
+    def test_plan_sections_are_generated_once_per_prompt_and_personalised(self):
+        engine = rag_engine.PCOSRecommendationEngine()
+        engine.plan_cache = MemoryPlanCache()
+        plan = f"Hello {rag_engine.PATIENT_PLACEHOLDER}, eat well."
+
+        with patch.object(engine, "_call_gemini", return_value=plan) as call:
+            first = engine.generate_comprehensive_plan("insulin_resistant", "Pune", "Asha")
+            second = engine.generate_comprehensive_plan("insulin_resistant", "Pune", "Meera")
+            self.assertEqual(call.call_count, SECTIONS)
+            engine.generate_comprehensive_plan("insulin_resistant", "Delhi", "Meera")
+
+        self.assertEqual((first, second), (assembled("Hello Asha, eat well."), assembled("Hello Meera, eat well.")))
+        prompts = [c.args[0] for c in call.call_args_list]
+        self.assertFalse(any("Asha" in prompt for prompt in prompts))
+        # A new city only regenerates the sections that mention it
+        regional = [name for name, instructions in rag_engine.PLAN_SECTIONS if "{region}" in instructions]
+        self.assertEqual(regional, ["red_list", "green_list"])
+        self.assertEqual(len(prompts), SECTIONS + len(regional))
+        self.assertTrue(all("Delhi" in prompt for prompt in prompts[SECTIONS:]))
+
+    def test_sections_are_generated_concurrently(self):
+        engine = rag_engine.PCOSRecommendationEngine()
+        engine.plan_cache = MemoryPlanCache()
+
+        def call(prompt):
+            time.sleep(0.2)
+            return prompt.split("\n\n")[2].split("\n")[0]
+
+        start = time.perf_counter()
+        with patch.object(engine, "_call_gemini", side_effect=call):
+            plan = engine.generate_comprehensive_plan("adrenal", "Pune", "Asha")
+
+        self.assertLess(time.perf_counter() - start, 0.2 * SECTIONS / 2)
+        self.assertTrue(plan.startswith("1. **DIAGNOSIS EXPLAINED**\n\n2. **THE \"RED LIST\" (AVOID)**"))
+        self.assertTrue(plan.endswith("6. **LIFESTYLE WARNINGS**"))
+
+    def test_one_failed_section_fails_the_plan_but_keeps_the_others(self):
+        engine = rag_engine.PCOSRecommendationEngine()
+        engine.plan_cache = MemoryPlanCache()
+
+        def call(prompt):
+            return "AI Error: timeout" if "MOVEMENT PLAN" in prompt else "ok"
+
+        with patch.object(engine, "_call_gemini", side_effect=call) as failing:
+            self.assertEqual(engine.generate_comprehensive_plan("adrenal", "Pune", "Asha"), "AI Error: timeout")
+        with patch.object(engine, "_call_gemini", return_value="ok") as retry:
+            self.assertEqual(engine.generate_comprehensive_plan("adrenal", "Pune", "Asha"), assembled("ok"))
+
+        self.assertEqual((failing.call_count, retry.call_count), (SECTIONS, 1))
+
+    def test_errors_are_not_cached(self):
+        engine = rag_engine.PCOSRecommendationEngine()
+        engine.plan_cache = MemoryPlanCache()
+
+        with patch.object(engine, "_call_gemini", return_value="AI Error: timeout") as call:
+            engine.generate_comprehensive_plan("adrenal", "Pune", "Asha")
+            engine.generate_comprehensive_plan("adrenal", "Pune", "Asha")
+
+        self.assertEqual(call.call_count, 2 * SECTIONS)
+
+
+@override_settings(PCOS_RECORD_HISTORY=False)
+class PlanJobTests(SimpleTestCase):
+    def setUp(self):
+        use_fresh_idempotency_store(self)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = SQLiteJobStore(os.path.join(tmp.name, "jobs.sqlite3"))
+
+    def _start_queue(self, generate):
+        queue = PlanJobQueue(self.store, generate, workers=2)
+        self.addCleanup(queue.stop)
+        patcher = patch("Clinical_Daignose.jobs._queue", queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return queue
+
+    def _wait_for(self, job_id):
+        for _ in range(200):
+            job = self.store.get(job_id)
+            if job["status"] in ("done", "failed"):
+                return job
+            time.sleep(0.01)
+        self.fail(f"Job {job_id} did not finish")
+
+    def test_api_returns_job_and_plan_is_polled(self):
+        release = threading.Event()
+
+        def generate(phenotype_id, region, patient_name):
+            release.wait(5)
+            return f"# Plan for {patient_name}\n{phenotype_id} in {region}"
+
+        self._start_queue(generate)
+        response = self.client.post(reverse("pcos_api"), SAMPLE_PATIENT, content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["diagnosis"]["phenotype"], "Insulin-Resistant PCOS")
+        status_url = response.json()["plan_status_url"]
+        self.assertEqual(self.client.get(status_url).status_code, 202)
+
+        release.set()
+        self._wait_for(response.json()["plan_job_id"])
+        finished = self.client.get(status_url)
+
+        self.assertEqual(finished.status_code, 200)
+        self.assertEqual(finished.json()["status"], "done")
+        self.assertIn("<h1>Plan for Asha</h1>", finished.json()["recommendation"])
+
+    def test_failed_generation_is_reported(self):
+        def generate(*args):
+            raise RuntimeError("AI Error: quota exceeded")
+
+        queue = self._start_queue(generate)
+        job = self._wait_for(queue.submit("adrenal", "Pune", "Asha"))
+
+        self.assertEqual((job["status"], job["error"]), ("failed", "AI Error: quota exceeded"))
+        response = self.client.get(reverse("pcos_plan_status", args=[job["id"]])).json()
+        self.assertEqual(response["error"], "AI Error: quota exceeded")
+        self.assertEqual(response["recommendation"], get_static_plan_store().get("adrenal").html)
+        self.assertEqual((response["recommendation_format"], response["note"]), ("html", FALLBACK_NOTE))
+
+    def test_unknown_job_is_404(self):
+        self._start_queue(lambda *args: "")
+
+        self.assertEqual(self.client.get(reverse("pcos_plan_status", args=["missing"])).status_code, 404)
+
+    def test_worker_survives_store_errors(self):
+        claim_next = self.store.claim_next
+        failures = [sqlite3.OperationalError("database is locked")]
+
+        def flaky_claim():
+            if failures:
+                raise failures.pop()
+            return claim_next()
+
+        with patch.object(self.store, "claim_next", flaky_claim), patch("Clinical_Daignose.jobs.ERROR_BACKOFF", 0.01), \
+                self.assertLogs("Clinical_Daignose.jobs", "ERROR"):
+            queue = PlanJobQueue(self.store, lambda *args: "# Plan", workers=1)
+            self.addCleanup(queue.stop)
+            job = self._wait_for(queue.submit("adrenal", "Pune", "Asha"))
+
+        self.assertEqual((job["status"], job["result"]), ("done", "# Plan"))
+
+    def test_expired_lease_is_reclaimed(self):
+        job_id = self.store.create("adrenal", "Pune", "Asha")
+        self.store.claim_next()
+        self.assertIsNone(self.store.claim_next())
+
+        with patch("Clinical_Daignose.jobs.time.time", return_value=time.time() + LEASE_SECONDS + 1):
+            self.assertEqual(self.store.claim_next()["id"], job_id)
+
+
+@override_settings(PCOS_RECORD_HISTORY=False)
+class AsyncViewTests(SimpleTestCase):
+    def setUp(self):
+        use_fresh_idempotency_store(self)
+        self.server = FakeModelServer(reply=f"# Plan for {rag_engine.PATIENT_PLACEHOLDER}").start()
+        self.addCleanup(self.server.stop)
+        fake = use_fake_model(self.server)
+        fake.__enter__()
+        self.addCleanup(fake.__exit__, None, None, None)
+
+    async def test_async_api_returns_diagnosis_and_plan(self):
+        response = await self.async_client.post(reverse("pcos_api_async"), SAMPLE_PATIENT, content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["diagnosis"], PCOSDiagnosticEngine(SAMPLE_PATIENT).run_diagnosis())
+        self.assertEqual(response.json()["recommendation"], render_markdown(assembled("# Plan for Asha")))
+
+    async def test_async_api_validates_like_sync_api(self):
+        payload = dict(SAMPLE_PATIENT, tsh=None)
+        response = await self.async_client.post(reverse("pcos_api_async"), payload, content_type="application/json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Missing or empty required fields: tsh")
+
+    async def test_async_duplicates_share_one_computation(self):
+        import asyncio
+
+        url = reverse("pcos_api_async")
+        responses = await asyncio.gather(*(
+            self.async_client.post(url, SAMPLE_PATIENT, content_type="application/json") for _ in range(3)
+        ))
+        sync = await sync_to_async(self.client.post)(
+            reverse("pcos_api") + "?plan=sync", SAMPLE_PATIENT, content_type="application/json"
+        )
+
+        self.assertEqual(sorted(response.get("Idempotent-Replayed", "") for response in responses), ["", "true", "true"])
+        self.assertEqual(sync["Idempotent-Replayed"], "true")
+        self.assertEqual(sync.json(), responses[0].json())
+        self.assertEqual(self.server.request_count, SECTIONS)
+
+    def test_async_routes_are_measured(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        for _ in range(2):
+            self.client.post(reverse("pcos_api_async"), SAMPLE_PATIENT, content_type="application/json")
+            self.client.post(reverse("pcos_form_async"), SAMPLE_PATIENT)
+
+        self.assertEqual((metrics.REQUEST_SECONDS.count("api_async"), metrics.REQUEST_SECONDS.count("form_async")), (2, 2))
+        self.assertEqual(metrics.STAGE_SECONDS.count("validation"), 4)
+        self.assertEqual(metrics.STAGE_SECONDS.count("diagnosis"), 2)
+        self.assertEqual(metrics.CACHE_REQUESTS.value("idempotency", "hit"), 2)
+        self.assertEqual(metrics.IN_FLIGHT.value("request"), 0)
+
+    def test_async_plans_use_the_cache_off_the_event_loop(self):
+        import asyncio
+
+        on_loop = []
+
+        def called_on_loop():
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return False
+            return True
+
+        class LoopCheckingCache(MemoryPlanCache):
+            def get(self, key):
+                on_loop.append(called_on_loop())
+                return super().get(key)
+
+            def set(self, key, value):
+                on_loop.append(called_on_loop())
+                super().set(key, value)
+
+        engine = rag_engine.get_recommendation_engine()
+        engine.plan_cache = LoopCheckingCache()
+
+        async def generate():
+            try:
+                plan = await engine.generate_comprehensive_plan_async("adrenal", "Pune", "Asha")
+                client = engine._get_async_client()
+            finally:
+                await engine.aclose()
+            return plan, client
+
+        plan, client = asyncio.run(generate())
+        self.assertEqual(plan, assembled("# Plan for Asha"))
+        self.assertTrue(client.is_closed)
+        self.assertEqual(on_loop, [False] * 2 * SECTIONS)
+
+    def test_sync_and_async_paths_produce_the_same_plan(self):
+        sync = self.client.post(reverse("pcos_api") + "?plan=sync", SAMPLE_PATIENT, content_type="application/json")
+        form = self.client.post(reverse("pcos_form_async"), SAMPLE_PATIENT)
+
+        self.assertEqual(sync.json()["recommendation"], render_markdown(assembled("# Plan for Asha")))
+        self.assertContains(form, "<h1>Plan for Asha</h1>", count=SECTIONS)
+        self.assertEqual(self.server.request_count, 2 * SECTIONS)
+
+
+@override_settings(PCOS_RECORD_HISTORY=False)
+class PlanStreamTests(SimpleTestCase):
+    def setUp(self):
+        use_fresh_idempotency_store(self)
+        reply = f"# Plan for {rag_engine.PATIENT_PLACEHOLDER}\n\nEat well, {rag_engine.PATIENT_PLACEHOLDER}."
+        self.server = FakeModelServer(reply=reply, stream_chunks=9).start()
+        self.addCleanup(self.server.stop)
+        fake = use_fake_model(self.server)
+        self.engine = fake.__enter__()
+        self.addCleanup(fake.__exit__, None, None, None)
+
+    def _events(self, response):
+        body = b"".join(response.streaming_content).decode()
+        return [
+            (block.split("\n")[0][len("event: "):], json.loads(block.split("\n")[1][len("data: "):]))
+            for block in body.strip().split("\n\n")
+        ]
+
+    def test_placeholder_split_across_chunks_is_personalised(self):
+        chunks = ["Hi [[PATIENT", "_NAME]], and [", "[PATIENT_NAME]]!"]
+
+        self.assertEqual("".join(rag_engine.personalise_stream(chunks, "Asha")), "Hi Asha, and Asha!")
+
+    def test_api_returns_stream_url_and_plan_streams_as_events(self):
+        response = self.client.post(reverse("pcos_api") + "?plan=stream", SAMPLE_PATIENT, content_type="application/json")
+        stream = self.client.get(response.json()["plan_stream_url"])
+
+        self.assertEqual(stream["Content-Type"], "text/event-stream")
+        events = self._events(stream)
+        self.assertGreater(len(events), 2)
+        self.assertEqual(events[-1], ("done", {}))
+        self.assertEqual("".join(data["text"] for _, data in events[:-1]), assembled("# Plan for Asha\n\nEat well, Asha."))
+
+    def test_streamed_plan_is_cached(self):
+        self.engine.plan_cache = MemoryPlanCache()
+        url = reverse("pcos_plan_stream") + "?token=" + issue_stream_token("adrenal", "Pune", "Meera")
+
+        self._events(self.client.get(url))
+        events = self._events(self.client.get(url))
+
+        self.assertEqual(events, [("chunk", {"text": assembled("# Plan for Meera\n\nEat well, Meera.")}), ("done", {})])
+        self.assertEqual(self.server.request_count, SECTIONS)
+
+    def test_model_failure_ends_the_stream_with_the_static_plan(self):
+        self.server.faults = [ERROR] * SECTIONS
+        url = reverse("pcos_plan_stream") + "?token=" + issue_stream_token("adrenal", "Pune", "Meera")
+
+        event, data = self._events(self.client.get(url))[-1]
+
+        self.assertEqual(event, "error")
+        self.assertTrue(data["error"].startswith(rag_engine.LLM_ERROR_PREFIXES))
+        self.assertEqual(data["recommendation"], get_static_plan_store().get("adrenal").html)
+        self.assertEqual(data["note"], FALLBACK_NOTE)
+
+    def test_stream_url_carries_only_a_token(self):
+        response = self.client.post(reverse("pcos_api") + "?plan=stream", SAMPLE_PATIENT, content_type="application/json")
+        url = response.json()["plan_stream_url"]
+
+        self.assertNotIn("Asha", url)
+        self.assertNotIn("Pune", url)
+        token = QueryDict(url.split("?", 1)[1])["token"]
+        self.assertEqual(redeem_stream_token(token), ("insulin_resistant", "Maharashtra", "Asha"))
+
+    def test_unknown_or_missing_token_is_rejected(self):
+        for query in ("?token=nope", "?phenotype_id=adrenal&region=Pune&patient_name=Meera"):
+            response = self.client.get(reverse("pcos_plan_stream") + query)
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.server.request_count, 0)
+
+
+class ImportTimeTests(SimpleTestCase):
+    """Regression gate for worker cold starts."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.timings, cls.stdout = measure_imports("Clinical_Daignose.views")
+
+    def test_import_has_no_output(self):
+        self.assertEqual(self.stdout, "")
+
+    def test_heavy_modules_are_loaded_lazily(self):
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, self.timings)
+
+    def test_import_time_within_budget(self):
+        for module, budget in IMPORT_TIME_BUDGET_US.items():
+            self.assertLess(self.timings[module], budget, module)
+
+
+class ProtocolStoreTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "protocols.json")
+        self.entries = [
+            {"phenotype_id": "adrenal", "name": "Adrenal PCOS", "lifestyle_avoids": ["HIIT", "Fasting"],
+             "supplement_rules": {"core_stack": ["Magnesium", "Vitamin C"]}},
+            {"phenotype_id": "adrenal", "name": "Adrenal PCOS (Pune)", "region": "Pune"},
+        ]
+        self._write(self.entries)
+
+    def _write(self, entries, mtime=None):
+        with open(self.path, "w") as f:
+            json.dump(entries, f)
+        if mtime:
+            os.utime(self.path, (mtime, mtime))
+
+    def _wait_for_reload(self, store, version):
+        for _ in range(200):
+            store.get("adrenal")
+            if store.version != version:
+                return
+            time.sleep(0.01)
+        self.fail("Store did not reload")
+
+    def test_lookup_uses_region_variant_and_prerendered_fragments(self):
+        store = ProtocolStore(self.path)
+
+        self.assertEqual(store.get("adrenal", region=" PUNE ").name, "Adrenal PCOS (Pune)")
+        generic = store.get("adrenal", region="Delhi")
+        self.assertEqual((generic.avoids, generic.supplements), ("HIIT, Fasting", "Magnesium, Vitamin C"))
+        self.assertIsNone(store.get("unknown"))
+
+    def test_schema_errors_are_reported(self):
+        errors = validate_protocols([{"phenotype_id": "x"}, {"phenotype_id": "y", "name": "Y", "lifestyle_avoids": "tea"}])
+
+        self.assertEqual(errors, [
+            "entry 0: 'name' must be a non-empty string",
+            "entry 1: 'lifestyle_avoids' must be a list",
+        ])
+        self._write([{"phenotype_id": "x", "name": "X"}, {"phenotype_id": "x", "name": "X again"}])
+        with self.assertRaises(ProtocolSchemaError):
+            ProtocolStore(self.path)
+
+    def test_reloads_in_background_when_file_changes(self):
+        store = ProtocolStore(self.path, check_interval=0)
+        version = store.version
+
+        self._write([dict(self.entries[0], name="Adrenal PCOS v2")], mtime=time.time() + 10)
+        self._wait_for_reload(store, version)
+
+        self.assertEqual(store.get("adrenal", region="Pune").name, "Adrenal PCOS v2")
+
+    def test_invalid_file_keeps_previous_snapshot(self):
+        store = ProtocolStore(self.path, check_interval=0)
+
+        self._write([{"phenotype_id": "adrenal"}], mtime=time.time() + 10)
+        for _ in range(20):
+            store.get("adrenal")
+            time.sleep(0.01)
+
+        self.assertEqual(store.get("adrenal").name, "Adrenal PCOS")
+
+    def test_missing_or_removed_file_keeps_previous_snapshot(self):
+        with self.assertLogs("Clinical_Daignose.protocols", "ERROR"):
+            self.assertIsNone(ProtocolStore(self.path + ".missing").get("adrenal"))
+
+        store = ProtocolStore(self.path, check_interval=0)
+        os.remove(self.path)
+        # Removed between _maybe_reload() seeing a change and the reload
+        store._reloading.acquire()
+        with self.assertLogs("Clinical_Daignose.protocols", "ERROR"):
+            store._reload()
+
+        self.assertEqual(store.get("adrenal").name, "Adrenal PCOS")
+        self.assertTrue(store._reloading.acquire(blocking=False))
+
+
+class DiagnosisHistoryTests(TestCase):
+    def setUp(self):
+        use_fresh_idempotency_store(self)
+        # No writer thread: records are written by flush() inside the test transaction
+        self.recorder = HistoryRecorder(start=False)
+        patcher = patch("Clinical_Daignose.history._recorder", self.recorder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _login_staff(self):
+        from django.contrib.auth.models import User
+
+        self.client.force_login(User.objects.create_user("clinician", is_staff=True))
+
+    def test_api_diagnosis_is_recorded_off_the_request_path(self):
+        response = self.client.post(reverse("pcos_api") + "?plan=stream", SAMPLE_PATIENT, content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(DiagnosisResult.objects.exists())
+        self.assertEqual(self.recorder.flush(), 1)
+
+        result = DiagnosisResult.objects.select_related("submission").get()
+        self.assertEqual((result.status, result.phenotype, result.region), ("diagnosed", "Insulin-Resistant PCOS", "Pune"))
+        self.assertEqual(result.submission.patient_name, "Asha")
+        self.assertEqual(result.submission.input_hash, input_hash(SAMPLE_PATIENT, "pune"))
+
+    def test_bulk_diagnoses_are_written_in_batches(self):
+        patients = [dict(patient, region="Pune") for patient in make_cohort(120, seed=3)]
+        self.client.post(reverse("pcos_bulk_api"), json.dumps(patients), content_type="application/json").getvalue()
+        self.recorder.batch_size = 50
+
+        self.assertEqual(self.recorder.flush(), 120)
+        self.assertEqual(PatientSubmission.objects.count(), 120)
+        self.assertEqual(DiagnosisResult.objects.count(), 120)
+
+    def test_bad_record_does_not_lose_its_batch(self):
+        result = PCOSDiagnosticEngine(SAMPLE_PATIENT).run_diagnosis()
+        self.recorder.record_diagnosis(dict(SAMPLE_PATIENT, cycle_length_days=float("nan")), "Pune", "NaN", result)
+        self.recorder.record_diagnosis(SAMPLE_PATIENT, "x" * 500, "Long region", result)
+        self.recorder.record_diagnosis(dict(SAMPLE_PATIENT, follicle_count_left=1e30), "Pune", "Overflow", result)
+        self.recorder.record_diagnosis(SAMPLE_PATIENT, "Pune", "Asha", result)
+
+        self.assertEqual(self.recorder.flush(), 2)
+        self.assertEqual(
+            sorted(PatientSubmission.objects.values_list("patient_name", "region")),
+            [("Asha", "Pune"), ("Long region", "x" * 100)]
+        )
+
+    def test_generated_plans_are_stored_once(self):
+        for _ in range(2):
+            rag_engine.plan_generated.send(sender=None, phenotype_id="inflammatory", region="Pune", plan="# Plan")
+        self.recorder.flush()
+
+        self.assertEqual(list(CarePlan.objects.values_list("phenotype_id", "markdown")), [("inflammatory", "# Plan")])
+
+    def test_history_is_keyset_paginated_newest_first(self):
+        for i in range(5):
+            self.recorder.record_diagnosis(SAMPLE_PATIENT, "Pune", f"P{i}", PCOSDiagnosticEngine(SAMPLE_PATIENT).run_diagnosis())
+        self.recorder.record_diagnosis(SAMPLE_PATIENT, "Delhi", "Other", PCOSDiagnosticEngine(SAMPLE_PATIENT).run_diagnosis())
+        self.recorder.flush()
+
+        self._login_staff()
+        names = []
+        cursor = None
+        while True:
+            params = {"region": "Pune", "phenotype_id": "insulin_resistant", "limit": 2, "include_names": "true"}
+            if cursor:
+                params["cursor"] = cursor
+            page = self.client.get(reverse("pcos_history_api"), params).json()
+            names += [row["patient_name"] for row in page["results"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+
+        self.assertEqual(names, ["P4", "P3", "P2", "P1", "P0"])
+
+    def test_history_is_staff_only_and_leaves_names_out_by_default(self):
+        from django.contrib.auth.models import User
+
+        self.recorder.record_diagnosis(SAMPLE_PATIENT, "Pune", "Asha", PCOSDiagnosticEngine(SAMPLE_PATIENT).run_diagnosis())
+        self.recorder.flush()
+
+        self.assertEqual(self.client.get(reverse("pcos_history_api")).status_code, 403)
+        self.client.force_login(User.objects.create_user("patient"))
+        self.assertEqual(self.client.get(reverse("pcos_history_api")).status_code, 403)
+        self._login_staff()
+        [row] = self.client.get(reverse("pcos_history_api")).json()["results"]
+        self.assertNotIn("patient_name", row)
+        self.assertEqual(row["region"], "Pune")
+
+    def test_bad_history_query_is_400(self):
+        self._login_staff()
+        for params in ({"cursor": "nope"}, {"since": "yesterday"}, {"phenotype_id": "unknown"}, {"limit": "0"}):
+            self.assertEqual(self.client.get(reverse("pcos_history_api"), params).status_code, 400, params)
+
+
+@override_settings(PCOS_RECORD_HISTORY=False)
+class IdempotencyTests(SimpleTestCase):
+    def test_concurrent_duplicates_share_one_computation(self):
+        store = IdempotencyStore()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return {"diagnosis": True}
+
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            futures = [pool.submit(store.run, "key", compute) for _ in range(5)]
+            time.sleep(0.1)
+            release.set()
+            hows = sorted(future.result()[1] for future in futures)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(hows, sorted([COMPUTED] + [COALESCED] * 4))
+        self.assertEqual(store.run("key", compute), ({"diagnosis": True}, REPLAYED))
+
+    def test_failures_and_rejected_results_are_not_stored(self):
+        store = IdempotencyStore()
+
+        def fail():
+            raise RuntimeError("boom")
+
+        with self.assertRaises(RuntimeError):
+            store.run("key", fail)
+        self.assertEqual(store.run("key", lambda: "partial", keep=lambda result: False), ("partial", COMPUTED))
+        self.assertEqual(store.run("key", lambda: "full"), ("full", COMPUTED))
+        self.assertEqual(store.run("key", lambda: "other"), ("full", REPLAYED))
+
+    def test_resubmitted_form_reuses_result_and_plan(self):
+        use_fresh_idempotency_store(self)
+        server = FakeModelServer(reply=f"# Plan for {rag_engine.PATIENT_PLACEHOLDER}").start()
+        self.addCleanup(server.stop)
+        with use_fake_model(server):
+            url = reverse("pcos_api") + "?plan=sync"
+            first = self.client.post(url, SAMPLE_PATIENT, content_type="application/json")
+            # Same values, different key order and int/float form
+            resubmitted = dict(reversed(list(SAMPLE_PATIENT.items())), cycle_length_days=50.0)
+            second = self.client.post(url, resubmitted, content_type="application/json")
+            other = self.client.post(url, dict(SAMPLE_PATIENT, patient_name="Meera"), content_type="application/json")
+
+        self.assertEqual(first.json(), second.json())
+        self.assertNotIn("Idempotent-Replayed", first)
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(other.json()["recommendation"], render_markdown(assembled("# Plan for Meera")))
+        self.assertEqual(server.request_count, 2 * SECTIONS)
+
+
+class DiagnosticRulesTests(SimpleTestCase):
+    def setUp(self):
+        with open(RULES_PATH) as f:
+            self.rules = json.load(f)
+
+    def test_each_comparison_is_compiled_once(self):
+        self.rules["phenotypes"][2]["when"] = [["total_testosterone", ">", 45]]
+        plan = compile_rules(self.rules, INPUT_DEFAULTS)
+        comparisons = [args for _, op, args in plan.steps if op == "compare"]
+
+        self.assertEqual(len(comparisons), len(set(comparisons)))
+        self.assertEqual(comparisons.count(("total_testosterone", ">", 45)), 1)
+
+    def test_tuned_thresholds_drive_scalar_and_batch_paths(self):
+        # SAMPLE_PATIENT (testosterone 60, FAI 150) is no longer hyperandrogenic
+        self.rules["criteria"][1]["any"] = [["total_testosterone", ">", 70], ["fai", ">", 200]]
+        self.rules["min_criteria"] = 3
+        plan = compile_rules(self.rules, INPUT_DEFAULTS)
+        patients = make_cohort(500, seed=9) + [SAMPLE_PATIENT]
+
+        report = PCOSDiagnosticEngine(SAMPLE_PATIENT, rules=plan).run_diagnosis()
+        self.assertEqual((report["diagnosis"], report["phenotype"]), (False, "Unknown"))
+        self.assertEqual(
+            PCOSDiagnosticEngine.run_batch(to_columns(patients), rules=plan),
+            [PCOSDiagnosticEngine(p, rules=plan).run_diagnosis() for p in patients],
+        )
+
+    def test_helpers_read_the_compiled_values(self):
+        engine = PCOSDiagnosticEngine(SAMPLE_PATIENT)
+
+        self.assertEqual(engine.calculate_fai(), 150.0)
+        self.assertEqual(engine.calculate_homa_ir(), 15 * 95 / 405)
+        self.assertEqual(
+            (engine.check_irregular_periods(), engine.check_hyperandrogenism(), engine.check_polycystic_morphology()),
+            (True, True, True),
+        )
+        self.assertEqual(PCOSDiagnosticEngine({"shbg": 0, "total_testosterone": 50}).calculate_fai(), 0)
+
+    def test_invalid_rules_are_rejected(self):
+        self.rules["criteria"][0]["any"][0] = ["cycle_length_days", "=>", 35]
+        self.rules["phenotypes"][1]["when"] = [["unknown_flag"]]
+        self.rules["phenotypes"][-1]["when"] = [["crp", ">", "3"]]
+
+        with self.assertRaises(RuleSchemaError) as raised:
+            compile_rules(self.rules, INPUT_DEFAULTS)
+        message = str(raised.exception)
+        self.assertIn("criteria 0, condition 0: unknown comparison '=>'", message)
+        self.assertIn("phenotype 1, condition 0: unknown exclusion or criterion 'unknown_flag'", message)
+        self.assertIn("phenotype 4, condition 0: threshold must be a finite number", message)
+        self.assertIn("the last phenotype is the fallback", message)
+
+    def test_non_finite_thresholds_are_rejected(self):
+        rules = json.loads(json.dumps(self.rules).replace("35", "Infinity", 1))
+        rules["derived"][0]["multiply_by"] = float("nan")
+
+        with self.assertRaises(RuleSchemaError) as raised:
+            compile_rules(rules, INPUT_DEFAULTS)
+        message = str(raised.exception)
+        self.assertIn("threshold must be a finite number", message)
+        self.assertIn("derived 0: 'multiply_by' must be a finite number", message)
+
+
+class BenchmarkBaselineTests(SimpleTestCase):
+    def test_branch_patients_reach_their_branch(self):
+        outcomes = {}
+        for branch, patient in BRANCH_PATIENTS.items():
+            result = PCOSDiagnosticEngine(patient).run_diagnosis()
+            outcomes[branch] = result.get("status") or (result["phenotype"] if result["diagnosis"] else "Not PCOS")
+
+        self.assertEqual(outcomes, {
+            "review_needed": "Review Needed",
+            "not_pcos": "Not PCOS",
+            "insulin_resistant": "Insulin-Resistant PCOS",
+            "inflammatory": "Inflammatory PCOS",
+            "hyperandrogenic": "Hyperandrogenic PCOS",
+            "post_pill": "Post-Pill / Mild PCOS",
+        })
+
+    def test_only_regressions_beyond_threshold_are_reported(self):
+        baseline = {"api": {"latency_us": 100.0, "rows_per_sec": 1000.0}}
+
+        self.assertEqual(compare_to_baseline({"api": {"latency_us": 120.0, "rows_per_sec": 800.0}}, baseline, 0.25), [])
+        self.assertEqual(compare_to_baseline({"api": {"latency_us": 10.0, "rows_per_sec": 9000.0}}, baseline, 0.25), [])
+        regressions = compare_to_baseline({"api": {"latency_us": 130.0, "rows_per_sec": 700.0}}, baseline, 0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn("api.latency_us", regressions[0])
+        self.assertEqual(compare_to_baseline({"other": {"latency_us": 1e9}}, baseline), [])
+
+    def test_baseline_is_scaled_to_this_host(self):
+        baseline = {"api": {"latency_us": 100.0, "rows_per_sec": 1000.0}, HOST_KEY: {"calibration_us": 10.0}}
+        # This host runs the calibration twice as slowly
+        slower = {"api": {"latency_us": 190.0, "rows_per_sec": 450.0}}
+
+        self.assertEqual(compare_to_baseline(slower, baseline, 0.25, calibration_us=20.0), [])
+        self.assertEqual(len(compare_to_baseline(slower, baseline, 0.25)), 2)
+        self.assertEqual(len(compare_to_baseline(slower, baseline, 0.25, calibration_us=5.0)), 2)
+
+    def test_save_merges_timing_metrics_only(self):
+        path = os.path.join(tempfile.mkdtemp(), "baselines.json")
+        self.addCleanup(os.remove, path)
+        save_baseline({"a": {"x_us": 1.0, "rows": 5}, "b": {"y_per_sec": 2.0}}, path)
+        save_baseline({"a": {"x_us": 3.0}, "c": {"label": "n/a"}}, path)
+
+        self.assertEqual(load_baseline(path), {"a": {"x_us": 3.0}, "b": {"y_per_sec": 2.0}})
+
+        save_baseline({"a": {"x_us": 2.0}}, path, host=host_info(12.5))
+        self.assertEqual(load_baseline(path)["a"], {"x_us": 2.0})
+        self.assertEqual(load_baseline(path)[HOST_KEY]["calibration_us"], 12.5)
+
+
+@override_settings(PCOS_RECORD_HISTORY=False)
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        use_fresh_idempotency_store(self)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = metrics.Histogram("t_seconds", "Test.", labels=("stage",), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, "x")
+
+        self.assertEqual(histogram.render()[2:], [
+            't_seconds_bucket{stage="x",le="0.1"} 1',
+            't_seconds_bucket{stage="x",le="1"} 2',
+            't_seconds_bucket{stage="x",le="+Inf"} 3',
+            't_seconds_sum{stage="x"} 5.55',
+            't_seconds_count{stage="x"} 3',
+        ])
+
+    def test_api_request_stages_and_cache_ratios_are_exposed(self):
+        server = FakeModelServer(reply=f"# Plan for {rag_engine.PATIENT_PLACEHOLDER}").start()
+        self.addCleanup(server.stop)
+        with use_fake_model(server):
+            for _ in range(2):
+                self.client.post(reverse("pcos_api") + "?plan=sync", SAMPLE_PATIENT, content_type="application/json")
+
+        for stage in ("validation", "diagnosis", "prompt", "llm", "markdown"):
+            expected = {"validation": 2, "llm": SECTIONS}.get(stage, 1)
+            self.assertEqual(metrics.STAGE_SECONDS.count(stage), expected, stage)
+        self.assertEqual(metrics.REQUEST_SECONDS.count("api"), 2)
+        self.assertEqual(metrics.LLM_CALLS.value("sync"), SECTIONS)
+        self.assertEqual(metrics.IN_FLIGHT.value("request"), 0)
+
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('pcos_cache_hit_ratio{cache="idempotency"} 0.5', body)
+        self.assertIn(f'pcos_llm_calls_total{{mode="sync"}} {SECTIONS}', body)
+
+    def test_llm_errors_are_counted(self):
+        engine = rag_engine.PCOSRecommendationEngine()
+        with patch.object(rag_engine, "api_key", None):
+            engine._call_gemini("prompt")
+
+        self.assertEqual(metrics.LLM_ERRORS.value("missing_key"), 1)
+
+    @override_settings(PCOS_METRICS=False)
+    def test_disabled_metrics_record_nothing(self):
+        self.client.post(reverse("pcos_api") + "?plan=stream", SAMPLE_PATIENT, content_type="application/json")
+
+        self.assertEqual(metrics.STAGE_SECONDS.count("diagnosis"), 0)
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+
+
+@override_settings(PCOS_RECORD_HISTORY=False)
+class StructuredLoggingTests(SimpleTestCase):
+    def test_patient_fields_are_redacted(self):
+        record = logging.makeLogRecord({
+            "name": "t", "levelno": logging.INFO, "levelname": "INFO", "msg": "Served %s", "args": ("ok",),
+            "fields": {"region": "Pune", "patient_name": "Asha", "batch": [{"tsh": 8.0, "id": 1}]},
+        })
+        entry = json.loads(JsonFormatter().format(record))
+
+        self.assertEqual(entry["msg"], "Served ok")
+        self.assertEqual((entry["region"], entry["patient_name"]), ("Pune", REDACTED))
+        self.assertEqual(entry["batch"], [{"tsh": REDACTED, "id": 1}])
+
+    def test_sampling_never_drops_warnings(self):
+        sampler = SamplingFilter(rate=0)
+        info, warning = (logging.makeLogRecord({"levelno": level}) for level in (logging.INFO, logging.WARNING))
+
+        self.assertEqual((sampler.filter(info), sampler.filter(warning)), (False, True))
+
+    def test_async_handler_writes_json_lines_off_thread(self):
+        out = io.StringIO()
+        handler = AsyncQueueHandler(logging.StreamHandler(out))
+        handler.setFormatter(JsonFormatter())
+        logger = logging.Logger("async-test")
+        logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        payload = {"n": 1}
+
+        logger.info("payload %s", payload, extra={"fields": {"patient_name": "Asha"}})
+        payload["n"] = 2
+        handler.flush()
+
+        entry = json.loads(out.getvalue())
+        self.assertEqual((entry["msg"], entry["patient_name"]), ("payload {'n': 1}", REDACTED))
+
+    def test_async_handler_copies_records_and_drops_tracebacks(self):
+        out = io.StringIO()
+        handler = AsyncQueueHandler(logging.StreamHandler(out))
+        handler.setFormatter(JsonFormatter())
+        self.addCleanup(handler.close)
+        try:
+            raise ValueError("bad value")
+        except ValueError:
+            record = logging.makeLogRecord({
+                "levelno": logging.ERROR, "levelname": "ERROR", "msg": "Failed %s", "args": ("job",),
+                "exc_info": sys.exc_info(),
+            })
+
+        queued = handler.prepare(record)
+        self.assertEqual((record.msg, record.args), ("Failed %s", ("job",)))
+        self.assertIsNotNone(record.exc_info)
+        self.assertIsNone(queued.exc_info)
+
+        handler.handle(record)
+        handler.flush()
+        entry = json.loads(out.getvalue())
+        self.assertEqual(entry["msg"], "Failed job")
+        self.assertIn("ValueError: bad value", entry["exc"])
+
+    def test_api_logs_no_patient_details(self):
+        use_fresh_idempotency_store(self)
+        with self.assertLogs("Clinical_Daignose.views", level="INFO") as logs:
+            self.client.post(reverse("pcos_api") + "?plan=stream", SAMPLE_PATIENT, content_type="application/json")
+
+        line = JsonFormatter().format(logs.records[0])
+        self.assertNotIn("Asha", line)
+        self.assertNotIn('"tsh"', line)
+        self.assertIn('"region": "Pune"', line)
+
+
+@override_settings(PCOS_RECORD_HISTORY=False)
+class ModelResilienceTests(SimpleTestCase):
+    def setUp(self):
+        use_fresh_idempotency_store(self)
+
+    def _serve(self, **faults):
+        server = FakeModelServer(reply=f"# Plan for {rag_engine.PATIENT_PLACEHOLDER}", **faults).start()
+        self.addCleanup(server.stop)
+        fake = use_fake_model(server)
+        engine = fake.__enter__()
+        self.addCleanup(fake.__exit__, None, None, None)
+        return server, engine
+
+    def test_breaker_opens_on_error_rate_and_probes_after_cooldown(self):
+        breaker = CircuitBreaker(error_rate=0.5, window=4, min_calls=4, cooldown=10)
+        with patch("Clinical_Daignose.resilience.time.monotonic", return_value=100):
+            for success in (True, False, True, False):
+                self.assertTrue(breaker.allow())
+                breaker.record(success)
+            self.assertEqual((breaker.state, breaker.allow()), (OPEN, False))
+
+        with patch("Clinical_Daignose.resilience.time.monotonic", return_value=110):
+            self.assertEqual((breaker.allow(), breaker.allow(), breaker.state), (True, False, HALF_OPEN))
+            breaker.record(True)
+            self.assertEqual(breaker.state, CLOSED)
+
+    def test_cancelled_probe_lets_the_next_call_probe(self):
+        import asyncio
+
+        server, engine = self._serve(latency=2)
+        engine.breaker = CircuitBreaker(window=1, min_calls=1, cooldown=0)
+        engine.breaker.record(False)
+
+        async def cancel_probe():
+            task = asyncio.ensure_future(engine._call_gemini_async("prompt"))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(cancel_probe())
+
+        self.assertEqual(engine.breaker.state, HALF_OPEN)
+        self.assertTrue(engine.breaker.allow())
+
+    def test_stream_closed_before_its_first_chunk_frees_the_probe(self):
+        server, engine = self._serve()
+        engine.breaker = CircuitBreaker(window=1, min_calls=1, cooldown=0)
+        engine.breaker.record(False)
+
+        with patch.object(engine.model, "generate_content", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                next(engine._call_gemini_stream("prompt"))
+
+        self.assertTrue(engine.breaker.allow())
+
+    def test_slow_model_call_is_cut_at_the_deadline(self):
+        server, engine = self._serve(faults=[SLOW], slow_latency=2)
+        start = time.perf_counter()
+        with patch.object(rag_engine, "LLM_TIMEOUT", 0.2):
+            plan = engine._call_gemini("prompt")
+
+        self.assertTrue(plan.startswith("AI Error:"))
+        self.assertLess(time.perf_counter() - start, 1.5)
+        self.assertEqual(engine.breaker.state, CLOSED)
+
+    def test_hedged_call_returns_the_fast_response(self):
+        server, engine = self._serve(faults=[SLOW], slow_latency=2)
+        start = time.perf_counter()
+        with patch.object(rag_engine, "LLM_HEDGE_AFTER", 0.1):
+            plan = engine._call_gemini("prompt")
+
+        self.assertTrue(plan.startswith("# Plan for"))
+        self.assertLess(time.perf_counter() - start, 1.5)
+        self.assertEqual(server.request_count, 2)
+
+    def test_open_circuit_fails_fast_to_the_static_plan(self):
+        server, engine = self._serve(error_rate=1.0)
+        engine.breaker = CircuitBreaker(window=4, min_calls=2, cooldown=60)
+        url = reverse("pcos_api") + "?plan=sync"
+
+        responses = [
+            self.client.post(url, dict(SAMPLE_PATIENT, region=f"Region {i}"), content_type="application/json").json()
+            for i in range(5)
+        ]
+
+        # The first plan's sections are in flight together, so some may all
+        # reach the model before the breaker opens; later plans never do.
+        self.assertLessEqual(server.request_count, SECTIONS)
+        self.assertEqual(engine.breaker.state, OPEN)
+        for data in responses:
+            self.assertEqual(data["note"], FALLBACK_NOTE)
+            self.assertIn("Myo-Inositol", data["recommendation"])
+
+
+class StaticPlanTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.protocols = ProtocolStore(rag_engine.PCOSRecommendationEngine().json_path)
+
+    def test_build_is_complete_and_deterministic(self):
+        import brotli
+
+        first = build_static_plans(self.protocols.snapshot, self.tmp)
+        html = open(os.path.join(self.tmp, "adrenal.html"), "rb").read()
+        second_dir = tempfile.mkdtemp()
+        build_static_plans(self.protocols.snapshot, second_dir)
+
+        self.assertEqual(sorted(first["plans"]), phenotype_ids(self.protocols.snapshot))
+        self.assertEqual(set(first["plans"]), {pid for pid in PHENOTYPE_IDS.values() if self.protocols.get(pid)})
+        self.assertEqual(gzip.decompress(open(os.path.join(self.tmp, "adrenal.html.gz"), "rb").read()), html)
+        self.assertEqual(brotli.decompress(open(os.path.join(self.tmp, "adrenal.html.br"), "rb").read()), html)
+        for name in os.listdir(self.tmp):
+            self.assertEqual(open(os.path.join(self.tmp, name), "rb").read(),
+                             open(os.path.join(second_dir, name), "rb").read(), name)
+
+    def test_store_serves_built_artifacts_and_renders_missing_ones(self):
+        build_static_plans(self.protocols.snapshot, self.tmp)
+        with open(os.path.join(self.tmp, "adrenal.html"), "ab") as f:
+            f.write(b"<!-- built -->")
+        store = StaticPlanStore(self.protocols, self.tmp)
+
+        self.assertTrue(store.get("adrenal").html.endswith("<!-- built -->"))
+        self.assertIn("Myo-Inositol", StaticPlanStore(self.protocols, os.path.join(self.tmp, "none")).get("insulin_resistant").html)
+        self.assertIsNone(store.get("unknown"))
+
+    def test_accept_encoding_negotiation(self):
+        self.assertEqual(choose_encoding("gzip, deflate, br"), "br")
+        self.assertEqual(choose_encoding("gzip, br;q=0"), "gzip")
+        self.assertEqual(choose_encoding("identity"), "identity")
+        self.assertEqual(choose_encoding(None), "identity")
+
+    def test_endpoint_serves_precompressed_plan(self):
+        url = reverse("pcos_static_plan", args=["inflammatory"])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn(b"NAC", gzip.decompress(response.content))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+        self.assertEqual(self.client.get(reverse("pcos_static_plan", args=["nope"])).status_code, 404)
+
+
+@override_settings(PCOS_RECORD_HISTORY=False)
+class BatchPlanTests(SimpleTestCase):
+    def test_patients_sharing_a_plan_section_share_one_model_call(self):
+        server = FakeModelServer(reply=f"# Plan for {rag_engine.PATIENT_PLACEHOLDER}").start()
+        self.addCleanup(server.stop)
+        requests = [
+            ("adrenal", "Pune", "Asha"), ("inflammatory", "Pune", "Meera"), ("adrenal", "Pune", "Riya"),
+            ("adrenal", "Goa", "Tara"), ("inflammatory", "Pune", "Zoya"),
+        ]
+        with use_fake_model(server) as engine:
+            plans, stats = engine.generate_plans(requests, max_concurrency=2)
+
+        self.assertEqual(plans, [assembled(f"# Plan for {name}") for _, _, name in requests])
+        # adrenal and inflammatory in full, plus adrenal's two regional sections for Goa
+        calls = 2 * SECTIONS + 2
+        self.assertEqual(server.request_count, calls)
+        self.assertEqual((stats["patients"], stats["distinct_plans"], stats["model_calls"]), (5, 3, calls))
+
+
+@override_settings(PCOS_RECORD_HISTORY=False)
+class MarkdownRenderingTests(SimpleTestCase):
+    def test_untrusted_markup_is_neutralised(self):
+        html = render_markdown(
+            "hi <script>alert(1)</script> [a](javascript:alert(1)){: onclick=\"x\"} "
+            "[b](&#106;avascript:alert(1)) [c](https://example.com)\n\n"
+            "<div onclick=1>raw</div>\n\n![i](data:text/html,x)"
+        )
+
+        self.assertIn("&lt;script&gt;", html)
+        self.assertIn("&lt;div onclick=1&gt;", html)
+        self.assertIn("<a>a</a> <a>b</a> <a href=\"https://example.com\">c</a>", html)
+        self.assertIn('<img alt="i" />', html)
+        self.assertNotIn("onclick=\"", html)
+
+    def test_plans_render_like_before_and_are_memoized(self):
+        import markdown
+
+        text = make_plan_markdown(3)
+        html = render_markdown(text)
+
+        self.assertEqual(html, markdown.markdown(text, extensions=["extra", "tables"]))
+        self.assertIs(render_markdown(text), html)
+
+    def test_api_can_return_markdown(self):
+        use_fresh_idempotency_store(self)
+        server = FakeModelServer(reply=f"# Plan for {rag_engine.PATIENT_PLACEHOLDER}").start()
+        self.addCleanup(server.stop)
+        url = reverse("pcos_api") + "?plan=sync"
+        with use_fake_model(server):
+            as_markdown = self.client.post(url + "&plan_format=markdown", SAMPLE_PATIENT, content_type="application/json").json()
+            as_html = self.client.post(url, SAMPLE_PATIENT, content_type="application/json").json()
+            invalid = self.client.post(url + "&plan_format=pdf", SAMPLE_PATIENT, content_type="application/json")
+
+        self.assertEqual((as_markdown["recommendation"], as_markdown["recommendation_format"]), (assembled("# Plan for Asha"), "markdown"))
+        self.assertEqual((as_html["recommendation"], as_html["recommendation_format"]), (render_markdown(assembled("# Plan for Asha")), "html"))
+        self.assertEqual(invalid.status_code, 400)
+
+
+@override_settings(PCOS_RECORD_HISTORY=False)
+class RegionTests(SimpleTestCase):
+    def _index(self, regions):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "regions.json")
+        with open(path, "w") as f:
+            json.dump({"version": 1, "regions": regions}, f)
+        return RegionIndex(path)
+
+    def test_spellings_of_a_place_share_one_region(self):
+        for text in ("Pune", "pune ", "Pune, Maharashtra", "PUNE", "Poona", "Puné", "Kothrud Pune", "India, Mumbai"):
+            self.assertEqual(canonical_region(text), "Maharashtra", text)
+        self.assertEqual(canonical_region("Banglore"), "Karnataka")
+        self.assertEqual(canonical_region("india"), "India")
+        self.assertEqual(canonical_region("  springfield   IL "), "Springfield Il")
+
+    def test_fuzzy_ties_between_regions_do_not_match(self):
+        index = self._index({
+            "a": {"label": "A", "places": {"Salem": []}},
+            "b": {"label": "B", "places": {"Salam": [], "Kolkata": []}},
+        })
+
+        self.assertIsNone(index.resolve("Salom"))
+        self.assertEqual((index.resolve("Kolkatta").label, index.resolve("Kolkatta").match), ("B", FUZZY))
+        with self.assertRaises(RegionGazetteerError):
+            self._index({"a": {"label": "A", "places": {"Salem": []}}, "b": {"label": "B", "aliases": ["salem"]}})
+
+    def test_spellings_share_one_plan(self):
+        engine = rag_engine.PCOSRecommendationEngine()
+        engine.plan_cache = MemoryPlanCache()
+
+        with patch.object(engine, "_call_gemini", return_value="ok") as call:
+            for region in ("Pune", "pune ", "Pune, Maharashtra", "Poona", "Mumbai"):
+                engine.generate_comprehensive_plan("adrenal", region, "Asha")
+
+        self.assertEqual(call.call_count, SECTIONS)
+        prompts = "".join(c.args[0] for c in call.call_args_list)
+        self.assertIn("common Maharashtra foods", prompts)
+        self.assertNotIn("Pune", prompts)
+
+    def test_api_reports_the_plan_region(self):
+        use_fresh_idempotency_store(self)
+        response = self.client.post(
+            reverse("pcos_api") + "?plan=stream", dict(SAMPLE_PATIENT, region=" poona"), content_type="application/json"
+        ).json()
+
+        self.assertEqual((response["region"], response["plan_region"]), (" poona", "Maharashtra"))
+        token = QueryDict(response["plan_stream_url"].split("?", 1)[1])["token"]
+        self.assertEqual(redeem_stream_token(token)[1], "Maharashtra")
+
+    def test_long_regions_are_bounded(self):
+        index = self._index({"a": {"label": "A", "places": {"Salem": []}}})
+        start = time.perf_counter()
+        self.assertIsNone(index.resolve("salam kolkata " * 1500))
+        self.assertEqual(index.resolve("lorem ipsum " * 100 + "salem").label, "A")
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertEqual(canonical_region("x" * 6000), "X" + "x" * 99)
+
+        use_fresh_idempotency_store(self)
+        for path in ("pcos_api", "pcos_api_async"):
+            response = self.client.post(reverse(path), dict(SAMPLE_PATIENT, region="Pune " * 30), content_type="application/json")
+            self.assertEqual(response.status_code, 400, path)
+            self.assertIn("at most 100 characters", response.json()["error"])
+        bulk = self.client.post(reverse("pcos_bulk_api"), json.dumps([dict(SAMPLE_PATIENT, region=["Pune"])]),
+                                content_type="application/json")
+        self.assertIn("at most 100 characters", json.loads(b"".join(bulk.streaming_content))["error"])
+
+
+class CohortScreeningTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.input = os.path.join(self.dir, "cohort.csv")
+        cohort = make_cohort(25, seed=4)
+        with open(self.input, "w", newline="") as f:
+            writer = csv.DictWriter(f, ["mrn"] + list(INPUT_DEFAULTS), extrasaction="ignore")
+            writer.writeheader()
+            for i, patient in enumerate(cohort):
+                invalid = {3: {"shbg": ""}, 5: {"crp": "nan"}, 9: {"tsh": "inf"}}.get(i, {})
+                writer.writerow(dict(patient, mrn=f"M{i}\nward 2" if i == 7 else f"M{i}", **invalid))
+        self.expected = PCOSDiagnosticEngine.run_batch(to_columns(cohort))
+
+    def _lines(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_rows_are_screened_in_order_by_the_pool(self):
+        output = os.path.join(self.dir, "out.ndjson")
+        summary = screen_file(self.input, output, workers=2, chunk_size=10, id_column="mrn")
+        lines = self._lines(output)
+
+        self.assertEqual((summary["rows"], summary["diagnosed"], summary["errors"]), (25, 22, 3))
+        self.assertEqual([line["row"] for line in lines], list(range(25)))
+        self.assertEqual(lines[7]["id"], "M7\nward 2")
+        self.assertIn("shbg", lines[3]["error"])
+        self.assertIn("crp", lines[5]["error"])
+        self.assertIn("tsh", lines[9]["error"])
+        self.assertEqual(lines[4]["diagnosis"], self.expected[4])
+
+    def test_parquet_batches_are_screened(self):
+        # A stand-in for pyarrow.parquet serving the cohort in record batches.
+        class Batch:
+            def __init__(self, rows):
+                self.rows = rows
+                self.num_rows = len(rows)
+
+            def slice(self, offset):
+                return Batch(self.rows[offset:])
+
+            def to_pylist(self):
+                return self.rows
+
+        with open(self.input, newline="") as f:
+            rows = list(csv.DictReader(f))
+
+        class ParquetFile:
+            schema_arrow = type("Schema", (), {"names": ["mrn"] + list(INPUT_DEFAULTS)})
+
+            def __init__(self, path):
+                pass
+
+            def iter_batches(self, batch_size, columns):
+                for i in range(0, len(rows), batch_size):
+                    yield Batch([{name: row[name] for name in columns} for row in rows[i:i + batch_size]])
+
+        parquet = type(sys)("pyarrow.parquet")
+        parquet.ParquetFile = ParquetFile
+        pyarrow = type(sys)("pyarrow")
+        pyarrow.parquet = parquet
+        path = os.path.join(self.dir, "cohort.parquet")
+        open(path, "wb").close()
+        output = os.path.join(self.dir, "out.ndjson")
+        with patch.dict(sys.modules, {"pyarrow": pyarrow, "pyarrow.parquet": parquet}):
+            summary = screen_file(path, output, workers=0, chunk_size=10, id_column="mrn")
+
+        self.assertEqual((summary["rows"], summary["diagnosed"], summary["errors"]), (25, 22, 3))
+        self.assertEqual(self._lines(output), self._lines(self._screen_csv()))
+
+    def _screen_csv(self):
+        output = os.path.join(self.dir, "csv.ndjson")
+        screen_file(self.input, output, workers=0, chunk_size=10, id_column="mrn")
+        return output
+
+    def test_interrupted_run_resumes_from_checkpoint(self):
+        complete = os.path.join(self.dir, "complete.ndjson")
+        output = os.path.join(self.dir, "out.ndjson")
+        screen_file(self.input, complete, workers=0, chunk_size=10)
+
+        def interrupt(rows, seconds):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            screen_file(self.input, output, workers=0, chunk_size=10, progress=interrupt)
+        with open(output, "a") as f:
+            f.write('{"row": 10, "partial')
+        summary = screen_file(self.input, output, workers=0, chunk_size=10, resume=True)
+
+        self.assertEqual(summary["resumed_from"], 10)
+        self.assertEqual(self._lines(output), self._lines(complete))
+
+
+class LabReportTests(SimpleTestCase):
+    def setUp(self):
+        patcher = patch.object(lab_reports, "_cache", MemoryPlanCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_values_are_found_and_converted_to_rule_units(self):
+        details = lab_reports.extract_values([
+            "Free Testosterone  2.1 pg/mL\nTestosterone (LC-MS/MS): 1.9 nmol/L\nGlucose, Random 140 mg/dL\n",
+            "Glucose Fasting 5.6 mmol / L\nInsulin 12.5 µIU/mL\nTSH (3rd Gen) 2.1\nC-Reactive Protein <0.5 mg/dL",
+        ])
+
+        self.assertEqual(details["total_testosterone"]["value"], 54.796)
+        self.assertEqual((details["fasting_glucose"]["value"], details["fasting_glucose"]["page"]), (100.89, 2))
+        self.assertEqual(details["fasting_insulin"]["value"], 12.5)
+        self.assertEqual((details["tsh"]["value"], details["tsh"]["unit"]), (2.1, None))
+        self.assertEqual(details["crp"]["value"], 5.0)
+        self.assertNotIn("prolactin", details)
+
+    def test_each_value_on_a_line_takes_its_own_unit(self):
+        details = lab_reports.extract_values(["Total Testosterone 50 ng/dL   SHBG 30 nmol/L\nProlactin 12 mmol/L"])
+
+        self.assertEqual((details["total_testosterone"]["value"], details["total_testosterone"]["unit"]), (50, "ng/dl"))
+        self.assertEqual((details["shbg"]["value"], details["shbg"]["unit"]), (30, "nmol/l"))
+        self.assertNotIn("prolactin", details)
+
+    def test_upload_extracts_values_and_caches_by_file_hash(self):
+        def post(body, name="report.pdf"):
+            upload = io.BytesIO(body)
+            upload.name = name
+            return self.client.post(reverse("pcos_lab_report_api"), {"file": upload})
+
+        report = make_lab_report_pdf(2)
+        first = post(report).json()
+        second = post(report).json()
+
+        self.assertEqual(first["page_sources"], ["text", "text"])
+        self.assertEqual(first["values"]["fasting_insulin"], 16.0)
+        self.assertEqual(first["missing"], [])
+        self.assertFalse(first["cached"])
+        self.assertTrue(second["cached"])
+        self.assertEqual(second["values"], first["values"])
+        self.assertEqual(post(b"not a report", "notes.txt").status_code, 400)
+
+    def test_broken_ocr_pool_is_replaced(self):
+        from concurrent.futures import Future
+        from concurrent.futures.process import BrokenProcessPool
+
+        class BrokenPool:
+            def __init__(self, fail_on_submit):
+                self.fail_on_submit = fail_on_submit
+
+            def submit(self, *args):
+                if self.fail_on_submit:
+                    raise BrokenProcessPool("A child process terminated abruptly")
+                future = Future()
+                future.set_exception(BrokenProcessPool("A child process terminated abruptly"))
+                return future
+
+            def shutdown(self, **kwargs):
+                pass
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "report.pdf")
+        with open(path, "wb") as f:
+            f.write(make_lab_report_pdf())
+
+        with patch.object(lab_reports, "_pool", BrokenPool(fail_on_submit=False)):
+            result = lab_reports.read_lab_report(path, cache=None)
+            self.assertEqual(result["errors"][0]["page"], 1)
+            self.assertIsNone(lab_reports._pool)
+
+        with patch.object(lab_reports, "_pool", BrokenPool(fail_on_submit=True)):
+            result = lab_reports.read_lab_report(path, cache=None)
+            self.addCleanup(lab_reports._pool.shutdown)
+            self.assertEqual((result["page_sources"], result["errors"]), (["text"], []))
+
+    def test_rasterized_pages_are_limited(self):
+        from PIL import Image
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "scan.png")
+        Image.new("L", (300, 200), 255).save(path)
+
+        with patch.object(lab_reports, "MAX_PIXELS", 100 * 100), patch.object(Image, "MAX_IMAGE_PIXELS", Image.MAX_IMAGE_PIXELS):
+            with self.assertRaisesRegex(ValueError, "10000 pixels"):
+                lab_reports.read_lab_report(path, workers=0, cache=None)
+            # An A4 page (595 x 842 points) is rendered below 300 DPI to fit
+            scale = lab_reports.render_scale(595, 842, 300)
+            self.assertLessEqual(595 * 842 * scale * scale, 100 * 100 + 1)
+        self.assertEqual(lab_reports.render_scale(595, 842, 300), 300 / 72)
+
+    @skipUnless(shutil.which("tesseract"), "tesseract is not installed")
+    def test_scanned_report_is_ocred(self):
+        import pypdfium2 as pdfium
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "scan.png")
+        pdf = pdfium.PdfDocument(make_lab_report_pdf())
+        pdf[0].render(scale=300 / 72, grayscale=True).to_pil().save(path)
+        pdf.close()
+
+        result = lab_reports.read_lab_report(path, workers=0, cache=MemoryPlanCache())
+        self.assertEqual(result["page_sources"], ["ocr"])
+        self.assertEqual(result["values"]["prolactin"], 18.5)
+
+
+class UltrasoundTests(SimpleTestCase):
+    def test_follicles_and_ovary_size_are_measured(self):
+        for follicles, seed in ((5, 1), (24, 2)):
+            frame, truth = make_ultrasound_frame(follicles, seed=seed)
+            measured = measure_frame(frame)
+
+            self.assertEqual(measured["follicle_count"], truth["follicle_count"])
+            self.assertAlmostEqual(measured["ovary_length_mm"], truth["ovary_length_mm"], delta=1.0)
+            self.assertAlmostEqual(measured["ovary_width_mm"], truth["ovary_width_mm"], delta=1.0)
+
+    def test_memory_mapped_stacks_fill_the_engine_fields(self):
+        import numpy as np
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        paths, truth = [], []
+        for side, requested in (("left", (3, 22, 9)), ("right", (12, 6, 25))):
+            frames = [make_ultrasound_frame(n, seed=n) for n in requested]
+            paths.append(os.path.join(tmp.name, side + ".npy"))
+            np.save(paths[-1], np.stack([frame for frame, _ in frames]))
+            truth.append([expected["follicle_count"] for _, expected in frames])
+
+        fields = measure_patients(*paths, workers=2, batch_size=2)
+        self.assertEqual(fields, measure_patients(*paths, workers=0))
+        self.assertEqual([(p["follicle_count_left"], p["follicle_count_right"]) for p in fields], list(zip(*truth)))
+        self.assertEqual(set(fields[0]), {name for name in INPUT_DEFAULTS if name.startswith(("follicle", "ovarian"))})
+
+    def test_upload_returns_engine_fields(self):
+        import cv2
+
+        frames = {side: make_ultrasound_frame(n, seed=n) for side, n in (("left", 21), ("right", 8))}
+
+        def png(side):
+            upload = io.BytesIO(cv2.imencode(".png", frames[side][0])[1].tobytes())
+            upload.name = side + ".png"
+            return upload
+
+        response = self.client.post(reverse("pcos_ultrasound_api"), {"left": png("left"), "right": png("right")})
+        self.assertEqual(response.status_code, 200)
+        values = response.json()["values"]
+        self.assertEqual((values["follicle_count_left"], values["follicle_count_right"]),
+                         (frames["left"][1]["follicle_count"], frames["right"][1]["follicle_count"]))
+        self.assertGreater(values["ovarian_volume_left"], 0)
+        self.assertEqual(self.client.post(reverse("pcos_ultrasound_api"), {"left": png("left")}).status_code, 400)
+
+    def test_upload_limits(self):
+        import cv2
+        import numpy as np
+
+        frame, _ = make_ultrasound_frame(8, seed=8)
+
+        def post(image=frame, **data):
+            uploads = {}
+            for side in ("left", "right"):
+                uploads[side] = io.BytesIO(cv2.imencode(".png", image)[1].tobytes())
+                uploads[side].name = side + ".png"
+            return self.client.post(reverse("pcos_ultrasound_api"), dict(uploads, **data))
+
+        for spacing in ("nan", "inf", "-1", "1e-9", "abc"):
+            self.assertEqual(post(mm_per_pixel=spacing).status_code, 400, spacing)
+        for spacing in ([1], {}):
+            response = self.client.post(reverse("pcos_ultrasound_api"), {"mm_per_pixel": spacing},
+                                        content_type="application/json")
+            self.assertEqual(response.status_code, 400, spacing)
+        self.assertEqual(post(image=np.zeros((16, 16), np.uint8), mm_per_pixel="0.01").status_code, 200)
+        with patch("Clinical_Daignose.ultrasound.MAX_PIXELS", 100 * 100):
+            self.assertEqual(post().status_code, 413)
+        with patch("Clinical_Daignose.views.ULTRASOUND_MAX_BYTES", 100):
+            self.assertEqual(post().status_code, 413)
+
+
+class PatientRecordTests(SimpleTestCase):
+    def test_record_diagnoses_like_the_dict(self):
+        patients = make_cohort(500, seed=11)
+        records = [PatientRecord.parse(p)[0] for p in patients]
+
+        self.assertEqual(
+            [PCOSDiagnosticEngine(r).run_diagnosis() for r in records],
+            [PCOSDiagnosticEngine(p).run_diagnosis() for p in patients],
+        )
+        self.assertEqual(PCOSDiagnosticEngine(records[0]).calculate_fai(), PCOSDiagnosticEngine(patients[0]).calculate_fai())
+
+    def test_parse_reports_every_bad_field_in_one_pass(self):
+        payload = dict(SAMPLE_PATIENT, tsh=None, crp="", shbg=-1, prolactin="12")
+        del payload["cycles_per_year"]
+
+        self.assertEqual(
+            PatientRecord.parse(payload),
+            (None, ["cycles_per_year", "tsh", "crp"], ["shbg", "prolactin"]),
+        )
+
+    def test_form_encoded_values_are_converted(self):
+        form = QueryDict(mutable=True)
+        form.update({name: str(value) for name, value in SAMPLE_PATIENT.items()})
+        record, missing_fields, invalid_fields = PatientRecord.parse(form)
+
+        self.assertEqual((missing_fields, invalid_fields), ([], []))
+        self.assertEqual(record, PatientRecord.parse(SAMPLE_PATIENT)[0])
+        form["crp"] = "high"
+        self.assertEqual(PatientRecord.parse(form)[2], ["crp"])
+        for text in ("nan", "inf", "-Infinity", "1e999"):
+            form["crp"] = text
+            self.assertIsNone(_form_number(text), text)
+            self.assertEqual(PatientRecord.parse(form)[2], ["crp"], text)
+
+    @override_settings(PCOS_RECORD_HISTORY=False)
+    def test_api_accepts_form_encoded_posts(self):
+        use_fresh_idempotency_store(self)
+        response = self.client.post(reverse("pcos_api") + "?plan=stream", SAMPLE_PATIENT)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["diagnosis"], PCOSDiagnosticEngine(SAMPLE_PATIENT).run_diagnosis())
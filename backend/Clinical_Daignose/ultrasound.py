@@ -0,0 +1,184 @@
+"""
+Follicle counts and ovarian volumes for PCOSDiagnosticEngine from
+grayscale ultrasound frames, with classical (CPU-only) OpenCV.
+
+For each frame, after a median filter against speckle:
+
+  ovary      Otsu separates the brighter stroma from the background; a
+             closing wider than the largest follicle fills the follicles
+             in, and the largest filled region is the ovary. An ellipse
+             fitted to its outline gives the length and width, and the
+             volume is that of a prolate ellipsoid (pi/6 * L * W * W, the
+             depth taken to equal the width).
+  follicles  Inside the ovary, Otsu on the ovary's own pixels separates
+             the anechoic follicles from the stroma. Round components
+             FOLLICLE_MIN_MM to FOLLICLE_MAX_MM across are counted.
+
+Sizes come from the pixel spacing ('mm_per_pixel', default
+PCOS_ULTRASOUND_MM_PER_PIXEL, between MIN_MM_PER_PIXEL and
+MAX_MM_PER_PIXEL). Uploaded images are limited to MAX_BYTES
+(PCOS_ULTRASOUND_MAX_BYTES) and MAX_PIXELS (PCOS_ULTRASOUND_MAX_PIXELS),
+checked from the image header before it is decoded. Batches are .npy stacks of frames
+(frames x height x width, uint8): measure_stack() memory-maps the file and
+hands BATCH_SIZE-frame slices to a process pool, whose workers map the
+file themselves, so no pixel data is copied between processes.
+"""
+import io
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+MM_PER_PIXEL = float(os.getenv("PCOS_ULTRASOUND_MM_PER_PIXEL", "0.125"))
+MIN_MM_PER_PIXEL = 0.01
+MAX_MM_PER_PIXEL = 1.0
+MAX_BYTES = int(os.getenv("PCOS_ULTRASOUND_MAX_BYTES", str(10 * 1024 * 1024)))
+MAX_PIXELS = int(os.getenv("PCOS_ULTRASOUND_MAX_PIXELS", str(4096 * 4096)))
+BATCH_SIZE = 16
+
+# Antral follicles as counted for polycystic ovarian morphology
+FOLLICLE_MIN_MM = 2.0
+FOLLICLE_MAX_MM = 9.0
+# Area over that of the bounding box's inscribed ellipse
+MIN_ROUNDNESS = 0.6
+# Resolution the ovary is outlined at
+OUTLINE_PX_PER_MM = 2
+
+NOT_FOUND = {"follicle_count": 0, "ovary_length_mm": 0.0, "ovary_width_mm": 0.0, "ovarian_volume": 0.0, "found": False}
+
+
+def _odd(pixels):
+    pixels = max(int(round(pixels)), 1)
+    return pixels if pixels % 2 else pixels + 1
+
+
+def measure_frame(frame, mm_per_pixel=MM_PER_PIXEL):
+    """
+    Measures one grayscale uint8 frame. Returns a dict with
+    follicle_count, ovary_length_mm, ovary_width_mm, ovarian_volume (mL)
+    and 'found' (False, with zeros, when no ovary could be outlined).
+    """
+    import cv2
+    import numpy as np
+
+    smooth = cv2.medianBlur(np.ascontiguousarray(frame, dtype=np.uint8), 5)
+    px_per_mm = 1 / mm_per_pixel
+
+    # Ovary: bright stroma with the (dark) follicles closed over. The outline
+    # only needs ~OUTLINE_PX_PER_MM, and the closing is far cheaper there.
+    scale = max(min(int(px_per_mm / OUTLINE_PX_PER_MM), *smooth.shape[:2]), 1)
+    coarse = cv2.resize(smooth, (smooth.shape[1] // scale, smooth.shape[0] // scale), interpolation=cv2.INTER_AREA)
+    coarse = cv2.GaussianBlur(coarse, (0, 0), sigmaX=max(px_per_mm / scale * 0.4, 1))
+    _, stroma = cv2.threshold(coarse, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    closing = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (_odd(FOLLICLE_MAX_MM * px_per_mm / scale * 1.2),) * 2)
+    stroma = cv2.morphologyEx(stroma, cv2.MORPH_CLOSE, closing)
+    contours, _ = cv2.findContours(stroma, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    outline = max(contours, key=cv2.contourArea) if contours else ()
+    if len(outline) < 5:
+        return dict(NOT_FOUND)
+    outline = outline * scale + scale // 2
+    ovary = np.zeros_like(smooth)
+    cv2.drawContours(ovary, [outline], -1, 255, thickness=cv2.FILLED)
+    _, axes, _ = cv2.fitEllipse(outline)
+    length_mm, width_mm = max(axes) * mm_per_pixel, min(axes) * mm_per_pixel
+
+    # Follicles: the dark class of the ovary's own pixels
+    inside = ovary > 0
+    level, _ = cv2.threshold(smooth[inside].reshape(1, -1), 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    dark = ((smooth <= level) & inside).astype(np.uint8)
+    dark = cv2.morphologyEx(dark, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+    count, _, stats, _ = cv2.connectedComponentsWithStats(dark, connectivity=8)
+
+    follicles = 0
+    for _, _, width, height, area in stats[1:].tolist():
+        diameter_mm = 2 * math.sqrt(area / math.pi) * mm_per_pixel
+        if FOLLICLE_MIN_MM <= diameter_mm <= FOLLICLE_MAX_MM and area >= MIN_ROUNDNESS * math.pi * width * height / 4:
+            follicles += 1
+
+    return {
+        "follicle_count": follicles,
+        "ovary_length_mm": round(length_mm, 1),
+        "ovary_width_mm": round(width_mm, 1),
+        "ovarian_volume": round(math.pi / 6 * (length_mm / 10) * (width_mm / 10) ** 2, 2),
+        "found": True,
+    }
+
+
+def decode_frame(data):
+    """
+    The grayscale frame in an encoded image ('data' bytes), or None if it is
+    not an image. Raises ValueError for an image over MAX_PIXELS.
+    """
+    import cv2
+    import numpy as np
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+    except UnidentifiedImageError:
+        return None
+    except Image.DecompressionBombError:
+        width = height = MAX_PIXELS
+    if width * height > MAX_PIXELS:
+        raise ValueError(f"Images are limited to {MAX_PIXELS} pixels")
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+
+
+def ultrasound_fields(left, right):
+    """The four engine inputs from the measurements of the left and right ovary."""
+    return {
+        "follicle_count_left": left["follicle_count"],
+        "follicle_count_right": right["follicle_count"],
+        "ovarian_volume_left": left["ovarian_volume"],
+        "ovarian_volume_right": right["ovarian_volume"],
+    }
+
+
+def _init_worker():
+    import cv2
+
+    # One process per core already; OpenCV's own threads would oversubscribe
+    cv2.setNumThreads(1)
+
+
+def measure_batch(path, start, stop, mm_per_pixel=MM_PER_PIXEL):
+    """Measurements of frames start..stop of a .npy stack; runs in a worker process."""
+    import numpy as np
+
+    frames = np.load(path, mmap_mode="r")
+    return [measure_frame(frames[index], mm_per_pixel) for index in range(start, stop)]
+
+
+def measure_stack(path, workers=None, batch_size=BATCH_SIZE, mm_per_pixel=MM_PER_PIXEL):
+    """
+    Measurements for every frame of a .npy stack, in order, on 'workers'
+    processes (default: one per CPU; 0 measures in this process).
+    """
+    import numpy as np
+
+    frames = np.load(path, mmap_mode="r")
+    if frames.ndim != 3:
+        raise ValueError(f"Expected a frames x height x width stack, got shape {frames.shape}")
+    batches = [(start, min(start + batch_size, len(frames))) for start in range(0, len(frames), batch_size)]
+
+    if not batches:
+        return []
+    if workers == 0:
+        results = [measure_batch(path, start, stop, mm_per_pixel) for start, stop in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            results = pool.map(measure_batch, *zip(*((path, start, stop, mm_per_pixel) for start, stop in batches)))
+            results = list(results)
+    return [measurement for batch in results for measurement in batch]
+
+
+def measure_patients(left_path, right_path, workers=None, batch_size=BATCH_SIZE, mm_per_pixel=MM_PER_PIXEL):
+    """
+    The four ultrasound inputs for each patient, from two aligned stacks
+    holding every patient's left and right ovary frame.
+    """
+    left = measure_stack(left_path, workers, batch_size, mm_per_pixel)
+    right = measure_stack(right_path, workers, batch_size, mm_per_pixel)
+    if len(left) != len(right):
+        raise ValueError(f"Left and right stacks differ in length ({len(left)} and {len(right)} frames)")
+    return [ultrasound_fields(l, r) for l, r in zip(left, right)]
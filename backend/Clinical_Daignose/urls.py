@@ -1,7 +1,22 @@
 from django.urls import path
-from .views import pcos_form_view, pcos_diagnosis_api
+from .views import (
+    pcos_form_view, pcos_diagnosis_api, pcos_bulk_diagnosis_api, pcos_plan_status_api, pcos_plan_stream_api,
+    pcos_history_api, pcos_static_plan_api, pcos_lab_report_api, pcos_ultrasound_api,
+    pcos_form_view_async, pcos_diagnosis_api_async,
+)
 
 urlpatterns = [
     path("", pcos_form_view, name="pcos_form"),
     path("api/", pcos_diagnosis_api, name="pcos_api"),
+    path("api/bulk/", pcos_bulk_diagnosis_api, name="pcos_bulk_api"),
+    path("api/history/", pcos_history_api, name="pcos_history_api"),
+    path("api/lab-reports/", pcos_lab_report_api, name="pcos_lab_report_api"),
+    path("api/ultrasound/", pcos_ultrasound_api, name="pcos_ultrasound_api"),
+    path("api/plans/stream/", pcos_plan_stream_api, name="pcos_plan_stream"),
+    path("api/plans/static/<str:phenotype_id>/", pcos_static_plan_api, name="pcos_static_plan"),
+    path("api/plans/<str:job_id>/", pcos_plan_status_api, name="pcos_plan_status"),
+
+    # Async variants, for deployments served through PCOS_Intelligence.asgi
+    path("async/", pcos_form_view_async, name="pcos_form_async"),
+    path("api/async/", pcos_diagnosis_api_async, name="pcos_api_async"),
 ]
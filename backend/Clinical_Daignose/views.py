@@ -1,79 +1,203 @@
-from .engine import PCOSDiagnosticEngine
-from .rag_engine import PCOSRecommendationEngine
+from .engine import INPUT_DEFAULTS, PCOSDiagnosticEngine, PatientRecord
+from .rag_engine import LLM_ERROR_PREFIXES, get_recommendation_engine
+from .regions import MAX_REGION_CHARS, canonical_region
 from .forms import PCOSInputForm
+from .bulk import diagnose_stream, iter_patients
+from .jobs import DONE, FAILED, get_plan_queue
+from .history import MAX_PAGE_SIZE, DEFAULT_PAGE_SIZE, get_history_recorder, list_diagnoses
+from .idempotency import COMPUTED, get_idempotency_store, request_key
+from .stream_tokens import issue_stream_token, redeem_stream_token
+from .static_plans import IDENTITY, choose_encoding, get_static_plan_store
+from .rendering import HTML, PLAN_FORMATS, render_markdown
+from .lab_reports import MAX_BYTES as LAB_REPORT_MAX_BYTES, read_lab_report
+from .ultrasound import (
+    MAX_BYTES as ULTRASOUND_MAX_BYTES, MAX_MM_PER_PIXEL, MIN_MM_PER_PIXEL, MM_PER_PIXEL,
+    decode_frame, measure_frame, ultrasound_fields,
+)
+from . import metrics
+from .metrics import instrument_view, record_cache, record_llm_fallback, timed
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
-from rest_framework.decorators import api_view
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_date
+from django.urls import reverse
+from urllib.parse import urlencode
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework import status
-import markdown
+import datetime
+import json
+import logging
+import os
+import tempfile
 
+logger = logging.getLogger(__name__)
 
+
+REQUIRED_FIELDS = list(INPUT_DEFAULTS)
+
+
+# Engine phenotype name -> phenotype_id in pcos_protocols.json
+PHENOTYPE_IDS = {
+    "Insulin-Resistant PCOS": "insulin_resistant",
+    "Inflammatory PCOS": "inflammatory",
+    "Hyperandrogenic PCOS": "hyperandrogenic",
+    "Post-Pill / Mild PCOS": "post_pill",
+    "Adrenal/Unspecified PCOS": "adrenal"
+}
+
+
+def validate_diagnostic_data(diagnostic_data):
+    """
+    Checks the 13 required inputs in a single pass.
+    Returns (missing_fields, invalid_fields).
+    """
+    _, missing_fields, invalid_fields = PatientRecord.parse(diagnostic_data)
+    return missing_fields, invalid_fields
+
+
+FALLBACK_NOTE = "AI care plan unavailable - showing the standard protocol plan for this phenotype."
+
+
+def _plan_html(plan, phenotype_id):
+    """
+    Returns (html, fell_back): the generated 'plan' rendered to HTML, or the
+    pre-rendered static plan for the phenotype if the model could not
+    produce one.
+    """
+    recommendation, _, fell_back = _render_plan(plan, phenotype_id)
+    return recommendation, fell_back
+
+
+def _render_plan(plan, phenotype_id, plan_format=HTML):
+    """
+    Returns (recommendation, recommendation_format, fell_back). The plan is
+    rendered to sanitized HTML unless 'plan_format' asks for the markdown
+    as-is; the static fallback plan only exists as HTML.
+    """
+    if plan.startswith(LLM_ERROR_PREFIXES):
+        static_plan = get_static_plan_store().get(phenotype_id)
+        if static_plan is not None:
+            record_llm_fallback()
+            return static_plan.html, HTML, True
+
+    if plan_format != HTML:
+        return plan, plan_format, False
+    with timed("markdown"):
+        return render_markdown(plan), HTML, False
+
+
+def _plan_format_error(plan_format):
+    """Error message for an unsupported ?plan_format=, or None."""
+    if plan_format not in PLAN_FORMATS:
+        return f"plan_format must be one of: {', '.join(PLAN_FORMATS)}"
+    return None
+
+
+def _region_error(region):
+    """Error message for a missing, non-text or over-long region, or None."""
+    if not region:
+        return "Region is required"
+    if not isinstance(region, str) or len(region) > MAX_REGION_CHARS:
+        return f"Region must be text of at most {MAX_REGION_CHARS} characters"
+    return None
+
+
+def _bulk_patient_error(patient):
+    region_error = _region_error(patient.get("region"))
+    if region_error:
+        return region_error
+
+    missing_fields, invalid_fields = validate_diagnostic_data(patient)
+    if missing_fields:
+        return f"Missing or empty required fields: {', '.join(missing_fields)}"
+    if invalid_fields:
+        return f"Invalid values for fields (must be positive numbers): {', '.join(invalid_fields)}"
+    return None
+
+
+def _diagnose(diagnostic_data, region, patient_name):
+    """
+    Runs and records the diagnosis. Returns (diagnosis_result, phenotype_id);
+    phenotype_id is None when there is no plan to generate.
+    """
+    with timed("diagnosis"):
+        diagnostic_engine = PCOSDiagnosticEngine(diagnostic_data)
+        diagnosis_result = diagnostic_engine.run_diagnosis()
+    get_history_recorder().record_diagnosis(diagnostic_data, region, patient_name, diagnosis_result)
+
+    # 🔹 Case 1: Review Needed -> no diagnosis, no plan
+    # 🔹 Case 2: Diagnosis available
+    if not diagnosis_result.get("diagnosis"):
+        return diagnosis_result, None
+    return diagnosis_result, PHENOTYPE_IDS.get(diagnosis_result.get("phenotype"))
+
+
+def _form_diagnosis(data, region, patient_name):
+    """Returns (diagnosis_result, recommendation_html, complete) for pcos_form_view."""
+    diagnosis_result, phenotype_id = _diagnose(data, region, patient_name)
+
+    recommendation_html = None
+    complete = True
+
+    if phenotype_id:
+        rag = get_recommendation_engine()
+
+        # Markdown text from RAG
+        recommendation_md = rag.generate_comprehensive_plan(
+            phenotype_id=phenotype_id,
+            region=canonical_region(region),
+            user_name=patient_name
+        )
+        complete = not recommendation_md.startswith(LLM_ERROR_PREFIXES)
+
+        # ✅ Convert Markdown → HTML (or the static plan if the model is unavailable)
+        recommendation_html, _ = _plan_html(recommendation_md, phenotype_id)
+
+    return diagnosis_result, recommendation_html, complete
+
+
+def _form_result(request, result, region, patient_name):
+    diagnosis_result, recommendation_html, _ = result
+    return render(
+        request,
+        "Clinical_Daignose/result.html",
+        {
+            "result": diagnosis_result,
+            "recommendation": recommendation_html,
+            "region": region,
+            "patient_name": patient_name
+        }
+    )
+
+
+@instrument_view("form")
 def pcos_form_view(request):
     if request.method == "POST":
         form = PCOSInputForm(request.POST)
 
-        if form.is_valid():
+        with timed("validation"):
+            valid = form.is_valid()
+
+        if valid:
             data = form.cleaned_data
 
             region = data.pop("region")
             patient_name = data.pop("patient_name", "Patient")
 
-            diagnostic_engine = PCOSDiagnosticEngine(data)
-            diagnosis_result = diagnostic_engine.run_diagnosis()
-
-            # 🔹 Case 1: Review Needed
-            if diagnosis_result.get("status") == "Review Needed":
-                return render(
-                    request,
-                    "Clinical_Daignose/result.html",
-                    {
-                        "result": diagnosis_result,
-                        "recommendation": None,
-                        "region": region,
-                        "patient_name": patient_name
-                    }
-                )
-
-            recommendation_html = None
-
-            # 🔹 Case 2: Diagnosis available
-            if diagnosis_result.get("diagnosis"):
-                phenotype_map = {
-                    "Insulin-Resistant PCOS": "insulin_resistant",
-                    "Inflammatory PCOS": "inflammatory",
-                    "Hyperandrogenic PCOS": "hyperandrogenic",
-                    "Post-Pill / Mild PCOS": "post_pill",
-                    "Adrenal/Unspecified PCOS": "adrenal"
-                }
-
-                phenotype_id = phenotype_map.get(diagnosis_result.get("phenotype"))
-
-                if phenotype_id:
-                    rag = PCOSRecommendationEngine()
-
-                    # Markdown text from RAG
-                    recommendation_md = rag.generate_comprehensive_plan(
-                        phenotype_id=phenotype_id,
-                        region=region,
-                        user_name=patient_name
-                    )
-
-                    # ✅ Convert Markdown → HTML
-                    recommendation_html = markdown.markdown(
-                        recommendation_md,
-                        extensions=["extra", "tables"]
-                    )
-
-            return render(
-                request,
-                "Clinical_Daignose/result.html",
-                {
-                    "result": diagnosis_result,
-                    "recommendation": recommendation_html,
-                    "region": region,
-                    "patient_name": patient_name
-                }
+            # A refresh re-posts the form; serve the same result again
+            result, how = get_idempotency_store().run(
+                request_key(data, region, patient_name, "form"),
+                lambda: _form_diagnosis(data, region, patient_name),
+                keep=lambda result: result[2]
             )
+            record_cache("idempotency", how != COMPUTED)
+
+            return _form_result(request, result, region, patient_name)
 
     else:
         form = PCOSInputForm()
@@ -85,49 +209,93 @@ def pcos_form_view(request):
     )
 
 
+def _diagnose_and_plan(diagnostic_data, region, patient_name, plan_mode, plan_format=HTML):
+    """
+    Diagnosis plus care-plan handling for pcos_diagnosis_api. Returns
+    (response_data, complete); 'complete' is False when the plan could not
+    be generated, so the response must not be replayed to a retry.
+    """
+    complete = True
+    response_data, phenotype_id = _api_diagnosis(diagnostic_data, region, patient_name)
+    plan_region = response_data["plan_region"]
+
+    # Add recommendations if diagnosis is available
+    if phenotype_id and plan_mode == "stream":
+        # The client opens this URL as an EventSource to stream the plan;
+        # the token keeps the patient's name out of the URL.
+        response_data["plan_stream_url"] = reverse("pcos_plan_stream") + "?" + urlencode({
+            "token": issue_stream_token(phenotype_id, plan_region, patient_name)
+        })
+
+    elif phenotype_id and plan_mode != "sync":
+        # Generate the plan in the background; the client polls for it.
+        job_id = get_plan_queue().submit(phenotype_id, plan_region, patient_name)
+        response_data["plan_job_id"] = job_id
+        response_data["plan_status_url"] = reverse("pcos_plan_status", args=[job_id])
+
+    elif phenotype_id:
+        rag = get_recommendation_engine()
+        recommendation_md = rag.generate_comprehensive_plan(
+            phenotype_id=phenotype_id,
+            region=plan_region,
+            user_name=patient_name
+        )
+        complete = _add_plan(response_data, recommendation_md, phenotype_id, plan_format)
+
+    return response_data, complete
+
+
+def _api_diagnosis(diagnostic_data, region, patient_name):
+    """(response_data, phenotype_id) for the diagnosis APIs, before any plan is added."""
+    diagnosis_result, phenotype_id = _diagnose(diagnostic_data, region, patient_name)
+
+    # Plans are shared by every spelling of a region ("pune ", "Poona", ...)
+    response_data = {
+        "patient_name": patient_name,
+        "region": region,
+        "plan_region": canonical_region(region),
+        "diagnosis": diagnosis_result
+    }
+    return response_data, phenotype_id
+
+
+def _add_plan(response_data, recommendation_md, phenotype_id, plan_format):
+    """
+    Adds a generated plan to 'response_data', or the static plan if the
+    model could not produce one. Returns False in that case.
+    """
+    # Convert Markdown to HTML unless the client asked for markdown
+    (response_data["recommendation"], response_data["recommendation_format"],
+     fell_back) = _render_plan(recommendation_md, phenotype_id, plan_format)
+    if fell_back:
+        response_data["note"] = FALLBACK_NOTE
+    return not recommendation_md.startswith(LLM_ERROR_PREFIXES)
+
+
 @api_view(['POST'])
+@instrument_view("api")
 def pcos_diagnosis_api(request):
     """
     API endpoint for PCOS diagnosis
     """
     try:
         data = request.data
-        print("Received data:", data)  # Debug logging
 
         # Extract patient details
         region = data.get("region")
         patient_name = data.get("patient_name", "Patient")
 
-        if not region:
+        region_error = _region_error(region)
+        if region_error:
             return Response(
-                {"error": "Region is required"},
+                {"error": region_error},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Remove patient details from diagnostic data
-        diagnostic_data = data.copy()
-        diagnostic_data.pop("region", None)
-        diagnostic_data.pop("patient_name", None)
-        print("Diagnostic data after removing patient details:", diagnostic_data)  # Debug logging
-
-        # Validate required fields and ensure they are valid numbers
-        required_fields = [
-            'cycle_length_days', 'cycles_per_year', 'total_testosterone',
-            'shbg', 'fasting_insulin', 'fasting_glucose', 'tsh', 'prolactin',
-            'crp', 'follicle_count_left', 'follicle_count_right',
-            'ovarian_volume_left', 'ovarian_volume_right'
-        ]
-
-        missing_fields = []
-        invalid_fields = []
-
-        for field in required_fields:
-            if field not in diagnostic_data:
-                missing_fields.append(field)
-            elif diagnostic_data[field] is None or diagnostic_data[field] == '':
-                missing_fields.append(field)
-            elif not isinstance(diagnostic_data[field], (int, float)) or diagnostic_data[field] < 0:
-                invalid_fields.append(field)
+        # Validate the 13 fields and copy them into a fixed-schema record
+        # (patient details and any other keys are left behind)
+        with timed("validation"):
+            diagnostic_data, missing_fields, invalid_fields = PatientRecord.parse(data)
 
         if missing_fields:
             return Response(
@@ -141,53 +309,481 @@ def pcos_diagnosis_api(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Run diagnosis
-        diagnostic_engine = PCOSDiagnosticEngine(diagnostic_data)
-        diagnosis_result = diagnostic_engine.run_diagnosis()
-
-        response_data = {
-            "patient_name": patient_name,
+        plan_format = request.query_params.get("plan_format", HTML)
+        format_error = _plan_format_error(plan_format)
+        if format_error:
+            return Response({"error": format_error}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Identical resubmissions (double clicks, retries, refreshes) share one result
+        plan_mode = request.query_params.get("plan")
+        (response_data, _), how = get_idempotency_store().run(
+            request_key(diagnostic_data, region, patient_name, "api", plan_mode, plan_format),
+            lambda: _diagnose_and_plan(diagnostic_data, region, patient_name, plan_mode, plan_format),
+            keep=lambda result: result[1]
+        )
+        record_cache("idempotency", how != COMPUTED)
+        logger.info("Diagnosis served", extra={"fields": {
             "region": region,
-            "diagnosis": diagnosis_result
-        }
-
-        # Add recommendations if diagnosis is available
-        if diagnosis_result.get("diagnosis"):
-            phenotype_map = {
-                "Insulin-Resistant PCOS": "insulin_resistant",
-                "Inflammatory PCOS": "inflammatory",
-                "Hyperandrogenic PCOS": "hyperandrogenic",
-                "Post-Pill / Mild PCOS": "post_pill",
-                "Adrenal/Unspecified PCOS": "adrenal"
-            }
-
-            phenotype_id = phenotype_map.get(diagnosis_result.get("phenotype"))
-
-            if phenotype_id:
-                try:
-                    rag = PCOSRecommendationEngine()
-                    recommendation_md = rag.generate_comprehensive_plan(
-                        phenotype_id=phenotype_id,
-                        region=region,
-                        user_name=patient_name
-                    )
-
-                    # Convert Markdown to HTML
-                    recommendation_html = markdown.markdown(
-                        recommendation_md,
-                        extensions=["extra", "tables"]
-                    )
-
-                    response_data["recommendation"] = recommendation_html
-                except Exception as e:
-                    # Fallback to demo report if AI fails
-                    response_data["recommendation"] = get_demo_report(patient_name, region)
-                    response_data["note"] = "AI diagnosis unavailable - showing demo report. Please configure GOOGLE_API_KEY for real AI analysis."
+            "patient_name": patient_name,
+            "plan_mode": plan_mode,
+            "phenotype": response_data["diagnosis"].get("phenotype"),
+            "idempotency": how,
+        }})
 
-        return Response(response_data, status=status.HTTP_200_OK)
+        response = Response(response_data, status=status.HTTP_200_OK)
+        if how != COMPUTED:
+            response["Idempotent-Replayed"] = "true"
+        return response
 
     except Exception as e:
+        logger.exception("Diagnosis request failed")
         return Response(
             {"error": f"An error occurred: {str(e)}"},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+
+
+@api_view(['GET'])
+def pcos_plan_status_api(request, job_id):
+    """
+    Status of a background care-plan job created by pcos_diagnosis_api.
+    Returns 202 while the plan is pending or running, 200 once finished; a
+    failed job comes with the static plan for its phenotype.
+    """
+    plan_format = request.query_params.get("plan_format", HTML)
+    format_error = _plan_format_error(plan_format)
+    if format_error:
+        return Response({"error": format_error}, status=status.HTTP_400_BAD_REQUEST)
+
+    job = get_plan_queue().get(job_id)
+    if job is None:
+        return Response(
+            {"error": "Unknown plan job"},
+            status=status.HTTP_404_NOT_FOUND
+        )
+
+    response_data = {"job_id": job_id, "status": job["status"]}
+
+    if job["status"] == DONE:
+        if plan_format == HTML:
+            with timed("markdown"):
+                response_data["recommendation"] = render_markdown(job["result"])
+        else:
+            response_data["recommendation"] = job["result"]
+        response_data["recommendation_format"] = plan_format
+        return Response(response_data, status=status.HTTP_200_OK)
+
+    if job["status"] == FAILED:
+        response_data["error"] = job["error"]
+        # Fall back to the static plan, which only exists as HTML
+        static_plan = get_static_plan_store().get(job["phenotype_id"])
+        if static_plan is not None:
+            record_llm_fallback()
+            response_data["recommendation"] = static_plan.html
+            response_data["recommendation_format"] = HTML
+            response_data["note"] = FALLBACK_NOTE
+        return Response(response_data, status=status.HTTP_200_OK)
+
+    return Response(response_data, status=status.HTTP_202_ACCEPTED)
+
+
+@require_GET
+def pcos_metrics(request):
+    """Request metrics in the Prometheus text format (404 when PCOS_METRICS is off)."""
+    if not metrics.enabled():
+        raise Http404("Metrics are disabled")
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@api_view(['POST'])
+@instrument_view("lab_report")
+def pcos_lab_report_api(request):
+    """
+    Reads the blood values from an uploaded lab report (multipart field
+    "file": a PDF or an image). Values are keyed by PCOSInputForm field and
+    given in the units the diagnostic rules use, so they can prefill the
+    form; re-uploads of the same file are answered from the cache.
+    """
+    upload = request.FILES.get("file")
+    if upload is None:
+        return Response(
+            {"error": "Upload a PDF or image of the report as 'file'"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if upload.size > LAB_REPORT_MAX_BYTES:
+        return Response(
+            {"error": f"Reports are limited to {LAB_REPORT_MAX_BYTES // (1024 * 1024)} MB"},
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        )
+
+    # The OCR workers read the report from disk; small uploads are in memory
+    if hasattr(upload, "temporary_file_path"):
+        path, copy = upload.temporary_file_path(), None
+    else:
+        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(upload.name)[1], delete=False) as copy:
+            for chunk in upload.chunks():
+                copy.write(chunk)
+        path = copy.name
+    try:
+        return Response(read_lab_report(path), status=status.HTTP_200_OK)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    finally:
+        if copy is not None:
+            os.unlink(copy.name)
+
+
+@api_view(['POST'])
+@instrument_view("ultrasound")
+def pcos_ultrasound_api(request):
+    """
+    Follicle counts and ovarian volumes from one grayscale ultrasound image
+    of each ovary (multipart fields "left" and "right"), keyed by
+    PCOSInputForm field. "mm_per_pixel" gives the image's pixel spacing.
+    """
+    try:
+        mm_per_pixel = float(request.data.get("mm_per_pixel") or MM_PER_PIXEL)
+    except (TypeError, ValueError):
+        mm_per_pixel = 0
+    if not MIN_MM_PER_PIXEL <= mm_per_pixel <= MAX_MM_PER_PIXEL:  # NaN fails too
+        return Response(
+            {"error": f"mm_per_pixel must be a number from {MIN_MM_PER_PIXEL} to {MAX_MM_PER_PIXEL}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    measurements = {}
+    for side in ("left", "right"):
+        upload = request.FILES.get(side)
+        frame = None
+        if upload is not None:
+            if upload.size > ULTRASOUND_MAX_BYTES:
+                return Response(
+                    {"error": f"Images are limited to {ULTRASOUND_MAX_BYTES // (1024 * 1024)} MB"},
+                    status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+                )
+            try:
+                frame = decode_frame(upload.read())
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        if frame is None:
+            return Response(
+                {"error": f"Upload an image of the {side} ovary as '{side}'"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        with timed("ultrasound"):
+            measurements[side] = measure_frame(frame, mm_per_pixel)
+
+    return Response({
+        "values": ultrasound_fields(measurements["left"], measurements["right"]),
+        "details": measurements,
+    }, status=status.HTTP_200_OK)
+
+
+@require_GET
+def pcos_static_plan_api(request, phenotype_id):
+    """
+    The pre-rendered static care plan for a phenotype, as precompressed
+    HTML (brotli or gzip, whichever the client accepts).
+    """
+    static_plan = get_static_plan_store().get(phenotype_id) if phenotype_id in PHENOTYPE_IDS.values() else None
+    if static_plan is None:
+        raise Http404("Unknown phenotype_id")
+
+    if request.headers.get("If-None-Match") == static_plan.etag:
+        response = HttpResponse(status=304)
+    else:
+        encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+        response = HttpResponse(static_plan.body(encoding), content_type="text/html; charset=utf-8")
+        if encoding != IDENTITY:
+            response["Content-Encoding"] = encoding
+    response["ETag"] = static_plan.etag
+    response["Vary"] = "Accept-Encoding"
+    response["Cache-Control"] = "public, max-age=3600"
+    return response
+
+
+def _parse_when(value):
+    """ISO datetime or date query parameter -> datetime; None if absent, ValueError if malformed."""
+    if not value:
+        return None
+    when = parse_datetime(value)
+    if when is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"Invalid date: {value}")
+        when = datetime.datetime.combine(day, datetime.time.min)
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when)
+    return when
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def pcos_history_api(request):
+    """
+    Past diagnoses, newest first. Staff users only.
+
+    Query parameters (all optional): phenotype_id, region, status
+    (review_needed / diagnosed / not_pcos), since and until (ISO date or
+    datetime), limit, and cursor, taken from the previous page's
+    next_cursor. Patient names are left out unless include_names=true.
+    """
+    params = request.query_params
+    phenotype = None
+    if params.get("phenotype_id"):
+        phenotype = next((name for name, pid in PHENOTYPE_IDS.items() if pid == params["phenotype_id"]), None)
+        if phenotype is None:
+            return Response(
+                {"error": f"Unknown phenotype_id: {params['phenotype_id']}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+    try:
+        limit = min(int(params.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        page, next_cursor = list_diagnoses(
+            phenotype=phenotype,
+            region=params.get("region"),
+            status=params.get("status"),
+            since=_parse_when(params.get("since")),
+            until=_parse_when(params.get("until")),
+            cursor=params.get("cursor"),
+            limit=limit
+        )
+    except ValueError as e:
+        return Response(
+            {"error": str(e)},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    include_names = params.get("include_names", "").lower() in ("1", "true", "yes")
+    results = [
+        {
+            "id": row.pk,
+            "created_at": row.created_at.isoformat(),
+            **({"patient_name": row.submission.patient_name} if include_names else {}),
+            "region": row.region,
+            "status": row.status,
+            "phenotype": row.phenotype or None,
+            "phenotype_id": PHENOTYPE_IDS.get(row.phenotype),
+            "lifestyle_protocol": row.lifestyle_protocol or None,
+            "criteria_met": row.criteria_met,
+            "alerts": row.alerts,
+        }
+        for row in page
+    ]
+    return Response(
+        {"results": results, "next_cursor": next_cursor},
+        status=status.HTTP_200_OK
+    )
+
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+def _plan_error_event(error, phenotype_id):
+    """An "error" event, carrying the static plan for the phenotype when there is one."""
+    payload = {"error": error}
+    static_plan = get_static_plan_store().get(phenotype_id)
+    if static_plan is not None:
+        record_llm_fallback()
+        payload.update(recommendation=static_plan.html, recommendation_format=HTML, note=FALLBACK_NOTE)
+    return _sse_event("error", payload)
+
+
+def _plan_events(phenotype_id, region, patient_name):
+    try:
+        for text in get_recommendation_engine().stream_comprehensive_plan(
+            phenotype_id=phenotype_id,
+            region=region,
+            user_name=patient_name
+        ):
+            if text.startswith(LLM_ERROR_PREFIXES):
+                # The model failed mid-plan; the error is its last chunk
+                yield _plan_error_event(text, phenotype_id)
+                return
+            yield _sse_event("chunk", {"text": text})
+    except Exception as e:
+        yield _plan_error_event(str(e), phenotype_id)
+        return
+    yield _sse_event("done", {})
+
+
+@require_GET
+def pcos_plan_stream_api(request):
+    """
+    Streams a care plan as Server-Sent Events while the model generates it.
+    Each "chunk" event carries the next piece of markdown; "done" ends the
+    stream. If the model fails, an "error" event ends it instead, with the
+    static plan for the phenotype as its recommendation. The only query parameter is the token from the diagnosis
+    response's plan_stream_url.
+    """
+    plan = redeem_stream_token(request.GET.get("token"))
+    if plan is None:
+        return JsonResponse({"error": "Unknown or expired stream token"}, status=404)
+    phenotype_id, region, patient_name = plan
+
+    response = StreamingHttpResponse(
+        _plan_events(phenotype_id, region, patient_name),
+        content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # Stop nginx from buffering the stream
+    return response
+
+
+@csrf_exempt
+@require_POST
+def pcos_bulk_diagnosis_api(request):
+    """
+    Bulk PCOS diagnosis.
+
+    Accepts a JSON array or NDJSON body of patients (same fields as the
+    single-patient API) and streams one NDJSON result line per patient, in
+    input order. Rows that fail validation get an "error" line instead of
+    a diagnosis. Care plans are not generated here.
+    """
+    patients = iter_patients(request, request.content_type or "")
+    return StreamingHttpResponse(
+        diagnose_stream(patients, _bulk_patient_error, record=get_history_recorder().record_diagnosis),
+        content_type="application/x-ndjson"
+    )
+
+
+# --- ASYNC (ASGI) VIEWS ---
+# Same behaviour as the views above, but the care plan is awaited on the
+# event loop instead of blocking a worker thread, so one ASGI process can
+# hold many plan generations in flight. Rendering the plan (which may read
+# the static fallback plan from disk) runs in a thread.
+
+async def _form_diagnosis_async(data, region, patient_name):
+    """_form_diagnosis with the plan generated on the event loop."""
+    diagnosis_result, phenotype_id = _diagnose(data, region, patient_name)
+
+    recommendation_html = None
+    complete = True
+
+    if phenotype_id:
+        recommendation_md = await get_recommendation_engine().generate_comprehensive_plan_async(
+            phenotype_id=phenotype_id,
+            region=canonical_region(region),
+            user_name=patient_name
+        )
+        complete = not recommendation_md.startswith(LLM_ERROR_PREFIXES)
+        recommendation_html, _ = await sync_to_async(_plan_html, thread_sensitive=False)(
+            recommendation_md, phenotype_id
+        )
+
+    return diagnosis_result, recommendation_html, complete
+
+
+async def _diagnose_and_plan_async(diagnostic_data, region, patient_name, plan_format=HTML):
+    """_diagnose_and_plan for ?plan=sync, with the plan generated on the event loop."""
+    complete = True
+    response_data, phenotype_id = _api_diagnosis(diagnostic_data, region, patient_name)
+
+    if phenotype_id:
+        recommendation_md = await get_recommendation_engine().generate_comprehensive_plan_async(
+            phenotype_id=phenotype_id,
+            region=response_data["plan_region"],
+            user_name=patient_name
+        )
+        complete = await sync_to_async(_add_plan, thread_sensitive=False)(
+            response_data, recommendation_md, phenotype_id, plan_format
+        )
+
+    return response_data, complete
+
+
+@instrument_view("form_async")
+async def pcos_form_view_async(request):
+    if request.method != "POST":
+        return render(request, "Clinical_Daignose/form.html", {"form": PCOSInputForm()})
+
+    form = PCOSInputForm(request.POST)
+    with timed("validation"):
+        valid = form.is_valid()
+    if not valid:
+        return render(request, "Clinical_Daignose/form.html", {"form": form})
+
+    data = form.cleaned_data
+    region = data.pop("region")
+    patient_name = data.pop("patient_name", "Patient")
+
+    # Shares results (and in-flight computations) with pcos_form_view
+    result, how = await get_idempotency_store().arun(
+        request_key(data, region, patient_name, "form"),
+        lambda: _form_diagnosis_async(data, region, patient_name),
+        keep=lambda result: result[2]
+    )
+    record_cache("idempotency", how != COMPUTED)
+
+    return _form_result(request, result, region, patient_name)
+
+
+@csrf_exempt
+@require_POST
+@instrument_view("api_async")
+async def pcos_diagnosis_api_async(request):
+    """
+    Async variant of pcos_diagnosis_api: returns the diagnosis and the
+    rendered care plan in one response, like ?plan=sync.
+    """
+    try:
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({"error": "Request body must be valid JSON"}, status=400)
+        if not isinstance(data, dict):
+            return JsonResponse({"error": "Request body must be a JSON object"}, status=400)
+
+        region = data.get("region")
+        patient_name = data.get("patient_name", "Patient")
+
+        region_error = _region_error(region)
+        if region_error:
+            return JsonResponse({"error": region_error}, status=400)
+
+        plan_format = request.GET.get("plan_format", HTML)
+        format_error = _plan_format_error(plan_format)
+        if format_error:
+            return JsonResponse({"error": format_error}, status=400)
+
+        with timed("validation"):
+            record, missing_fields, invalid_fields = PatientRecord.parse(data)
+        if missing_fields:
+            return JsonResponse(
+                {"error": f"Missing or empty required fields: {', '.join(missing_fields)}"},
+                status=400
+            )
+        if invalid_fields:
+            return JsonResponse(
+                {"error": f"Invalid values for fields (must be positive numbers): {', '.join(invalid_fields)}"},
+                status=400
+            )
+
+        # Same key as pcos_diagnosis_api?plan=sync, whose response this matches
+        (response_data, _), how = await get_idempotency_store().arun(
+            request_key(record, region, patient_name, "api", "sync", plan_format),
+            lambda: _diagnose_and_plan_async(record, region, patient_name, plan_format),
+            keep=lambda result: result[1]
+        )
+        record_cache("idempotency", how != COMPUTED)
+        logger.info("Diagnosis served", extra={"fields": {
+            "region": region,
+            "patient_name": patient_name,
+            "plan_mode": "async",
+            "phenotype": response_data["diagnosis"].get("phenotype"),
+            "idempotency": how,
+        }})
+
+        response = JsonResponse(response_data)
+        if how != COMPUTED:
+            response["Idempotent-Replayed"] = "true"
+        return response
+
+    except Exception as e:
+        logger.exception("Async diagnosis request failed")
+        return JsonResponse({"error": f"An error occurred: {str(e)}"}, status=500)
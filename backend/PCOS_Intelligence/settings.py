@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from dotenv import load_dotenv
 import os
+import sys
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -132,6 +133,47 @@ STATIC_URL = "static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Store every diagnosis and generated plan (see Clinical_Daignose.history)
+PCOS_RECORD_HISTORY = os.getenv("PCOS_RECORD_HISTORY", "1") != "0"
+
+# Collect request metrics and serve them at /metrics (see Clinical_Daignose.metrics)
+PCOS_METRICS = os.getenv("PCOS_METRICS", "1") != "0"
+
+# App logs: JSON lines with patient fields redacted, written to stderr from a
+# background thread (see Clinical_Daignose.logs). PCOS_LOG_SAMPLE_RATE keeps
+# that fraction of DEBUG/INFO records. "manage.py test" only logs critical
+# records unless PCOS_LOG_LEVEL says otherwise; tests that check logs
+# capture them with assertLogs.
+TESTING = sys.argv[1:2] == ["test"]
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "filters": {
+        "sample": {
+            "()": "Clinical_Daignose.logs.SamplingFilter",
+            "rate": float(os.getenv("PCOS_LOG_SAMPLE_RATE", "1.0")),
+        },
+    },
+    "formatters": {
+        "json": {"()": "Clinical_Daignose.logs.JsonFormatter"},
+    },
+    "handlers": {
+        "async": {
+            "class": "Clinical_Daignose.logs.AsyncQueueHandler",
+            "formatter": "json",
+            "filters": ["sample"],
+        },
+    },
+    "loggers": {
+        "Clinical_Daignose": {
+            "handlers": ["async"],
+            "level": os.getenv("PCOS_LOG_LEVEL", "CRITICAL" if TESTING else "INFO"),
+            "propagate": False,
+        },
+    },
+}
+
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
@@ -2,6 +2,8 @@ from django.contrib import admin
 from django.urls import path, include
 from django.shortcuts import redirect
 
+from Clinical_Daignose.views import pcos_metrics
+
 def home(request):
     return redirect("pcos_form")
 
@@ -9,4 +11,5 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("", home),              # 👈 root redirect
     path("pcos/", include("Clinical_Daignose.urls")),
+    path("metrics", pcos_metrics, name="metrics"),    # Prometheus scrape target
 ]
@@ -1,5 +1,6 @@
 import { useEffect, useState } from "react";
 import { marked } from "marked";
+import { sanitizeHtml } from "@/lib/sanitize-html";
 import { Card, CardContent, CardHeader, CardTitle } from "@/components/ui/card";
 import { Badge } from "@/components/ui/badge";
 import { Separator } from "@/components/ui/separator";
@@ -28,7 +29,8 @@ const DiagnosticReport = ({ report, patientName }: DiagnosticReportProps) => {
         gfm: true,
       });
       const parsed = await marked.parse(report);
-      setHtmlContent(parsed);
+      // The plan is model output: never insert it unsanitized
+      setHtmlContent(sanitizeHtml(parsed));
     };
     parseMarkdown();
   }, [report]);
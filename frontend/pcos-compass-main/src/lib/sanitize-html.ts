@@ -0,0 +1,51 @@
+// Care plans come from a language model, so the HTML rendered from them is
+// untrusted. Mirrors the backend renderer (Clinical_Daignose/rendering.py):
+// only markdown's own elements survive, each keeps only ALLOWED_ATTRIBUTES,
+// and href/src values with a scheme outside ALLOWED_SCHEMES are removed.
+
+const ALLOWED_TAGS = new Set([
+  "a", "abbr", "b", "blockquote", "br", "code", "dd", "del", "div", "dl", "dt", "em",
+  "h1", "h2", "h3", "h4", "h5", "h6", "hr", "i", "img", "li", "ol", "p", "pre", "span",
+  "strong", "sub", "sup", "table", "tbody", "td", "tfoot", "th", "thead", "tr", "ul",
+]);
+// Removed together with their contents; any other element is unwrapped
+const DROPPED_TAGS = new Set([
+  "script", "style", "iframe", "frame", "object", "embed", "template", "noscript",
+  "svg", "math", "form", "textarea", "select", "title", "head",
+]);
+const ALLOWED_ATTRIBUTES = new Set(["href", "src", "alt", "title", "align", "id", "class"]);
+const URL_ATTRIBUTES = new Set(["href", "src"]);
+const ALLOWED_SCHEMES = new Set(["http", "https", "mailto"]);
+
+export const isSafeUrl = (url: string): boolean => {
+  // Browsers ignore control characters and spaces anywhere in a scheme ("java\tscript:")
+  const match = /^([a-z][a-z0-9+.-]*):/.exec(url.replace(/[\x00-\x20\x7f]+/g, "").toLowerCase());
+  return match === null || ALLOWED_SCHEMES.has(match[1]);
+};
+
+const clean = (parent: Element) => {
+  for (const element of Array.from(parent.children)) {
+    const tag = element.tagName.toLowerCase();
+    if (DROPPED_TAGS.has(tag)) {
+      element.remove();
+      continue;
+    }
+    clean(element);
+    if (!ALLOWED_TAGS.has(tag)) {
+      element.replaceWith(...Array.from(element.childNodes));
+      continue;
+    }
+    for (const { name, value } of Array.from(element.attributes)) {
+      if (!ALLOWED_ATTRIBUTES.has(name) || (URL_ATTRIBUTES.has(name) && !isSafeUrl(value))) {
+        element.removeAttribute(name);
+      }
+    }
+  }
+};
+
+// Parsed in an inert document, so nothing in 'html' runs or loads
+export const sanitizeHtml = (html: string): string => {
+  const document = new DOMParser().parseFromString(html, "text/html");
+  clean(document.body);
+  return document.body.innerHTML;
+};
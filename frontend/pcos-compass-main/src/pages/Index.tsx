@@ -85,6 +85,54 @@ Based on the provided clinical data and laboratory values, this assessment evalu
 *This report is generated for informational purposes and should be reviewed by a qualified healthcare provider.*
 `;
 
+const API_BASE_URL = 'http://localhost:8000';
+const PLAN_POLL_INTERVAL_MS = 1500;
+
+// Polls a background care-plan job until it finishes; null if generation failed
+const waitForPlan = async (statusUrl: string): Promise<string | null> => {
+  while (true) {
+    const response = await fetch(`${API_BASE_URL}${statusUrl}`);
+    if (!response.ok) {
+      throw new Error(`HTTP error! status: ${response.status}`);
+    }
+
+    const job = await response.json();
+    if (job.status === 'done') return job.recommendation;
+    // A failed job carries the standard plan for the phenotype, if there is one
+    if (job.status === 'failed') return job.recommendation ?? null;
+
+    await new Promise((resolve) => setTimeout(resolve, PLAN_POLL_INTERVAL_MS));
+  }
+};
+
+// Streams a care plan over Server-Sent Events, calling onText with the
+// markdown received so far; resolves with the full plan once the stream ends,
+// or with the standard plan the server sends if the model fails
+const streamPlan = (streamUrl: string, onText: (text: string) => void): Promise<string> =>
+  new Promise((resolve, reject) => {
+    const source = new EventSource(`${API_BASE_URL}${streamUrl}`);
+    let text = "";
+
+    source.addEventListener("chunk", (event) => {
+      text += JSON.parse((event as MessageEvent).data).text;
+      onText(text);
+    });
+    source.addEventListener("done", () => {
+      source.close();
+      resolve(text);
+    });
+    source.addEventListener("error", (event) => {
+      source.close();
+      const data = (event as MessageEvent).data;
+      const payload = data ? JSON.parse(data) : null;
+      if (payload?.recommendation) {
+        resolve(payload.recommendation);
+      } else {
+        reject(new Error(payload ? payload.error : "Plan stream interrupted"));
+      }
+    });
+  });
+
 const Index = () => {
   const [isLoading, setIsLoading] = useState(false);
   const [report, setReport] = useState<string | null>(null);
@@ -117,7 +165,7 @@ const Index = () => {
       });
 
       // Make API call to Django backend
-      const response = await fetch('http://localhost:8000/pcos/api/', {
+      const response = await fetch(`${API_BASE_URL}/pcos/api/?plan=stream`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -131,9 +179,28 @@ const Index = () => {
 
       const result = await response.json();
 
+      // The care plan is streamed (or generated in the background); wait for it
+      let recommendation = result.recommendation;
+      if (!recommendation && result.plan_stream_url) {
+        let scrolled = false;
+        recommendation = await streamPlan(result.plan_stream_url, (text) => {
+          // Show the report as soon as the first content arrives
+          setReport(text);
+          if (!scrolled) {
+            scrolled = true;
+            setIsLoading(false);
+            setTimeout(() => {
+              reportRef.current?.scrollIntoView({ behavior: "smooth", block: "start" });
+            }, 100);
+          }
+        });
+      } else if (!recommendation && result.plan_status_url) {
+        recommendation = await waitForPlan(result.plan_status_url);
+      }
+
       // Set the report from the API response
-      if (result.recommendation) {
-        setReport(result.recommendation);
+      if (recommendation) {
+        setReport(recommendation);
       } else {
         // Fallback to demo report if no recommendation
         setReport(DEMO_REPORT.replace("Demo Patient", name));
@@ -0,0 +1,30 @@
+import { describe, it, expect } from "vitest";
+import { marked } from "marked";
+import { isSafeUrl, sanitizeHtml } from "@/lib/sanitize-html";
+
+describe("sanitizeHtml", () => {
+  it("keeps markdown output", async () => {
+    const html = await marked.parse("# Plan\n\n| Food | Why |\n|---|---|\n| Oats | fibre |\n\n[Guide](https://example.org)");
+
+    expect(sanitizeHtml(html)).toBe(html);
+  });
+
+  it("removes scripts, event handlers and unsafe links", async () => {
+    const html = await marked.parse(
+      '<script>alert(1)</script><img src=x onerror="alert(1)">\n\n[click](javascript:alert(1)) <a href="java\tscript:alert(1)">x</a> <svg><a href="#">y</a></svg>'
+    );
+    const clean = sanitizeHtml(html);
+
+    expect(clean).not.toMatch(/script|onerror|svg/i);
+    expect(clean).toContain('<img src="x">');
+  });
+
+  it("unwraps unknown elements but keeps their text", () => {
+    expect(sanitizeHtml('<p><font color="red">Eat <b style="x">well</b></font></p>')).toBe("<p>Eat <b>well</b></p>");
+  });
+
+  it("accepts relative and allowed URLs only", () => {
+    expect(["/plans", "#diet", "https://a.org", "mailto:a@b.org"].every(isSafeUrl)).toBe(true);
+    expect(["javascript:alert(1)", " JAVASCRIPT:x", "data:text/html,x", "vbscript:x"].some(isSafeUrl)).toBe(false);
+  });
+});